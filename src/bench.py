@@ -0,0 +1,240 @@
+'''
+Micro benchmarks
+
+    python bench.py clone --count 2000
+
+clone: a soda machine built by SodaMachine.__init__ against one cloned from
+a started prototype with SodaMachine.clone().
+dispatch: HSM.dispatch of events a nested state ignores, handles with an
+activity of its parent, and takes a transition to its sibling on.
+post: the same events through HSM.post, which builds no responses.
+guards: post of an event with 24 guarded transitions whose last one is
+taken, in insertion order against declared exclusive.
+memory: bytes per soda machine, built and cloned, as tracemalloc sees them
+allocated and as FSM.memory_report() adds them up. Keep the output with
+each release to follow the per instance cost.
+spec: loading a JSON spec of --count states with spec.load_file(), and with
+spec.load_flat_file() without and with a warm cache.
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import fsm
+import hsm
+import loadgen
+import soda
+import spec
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def best_of(repeat, count, func):
+    '''best_of(repeat, count, func) -> lowest mean seconds per call of func'''
+    best = None
+    for i in range(repeat):
+        started = clock()
+        for j in range(count):
+            func()
+        elapsed = (clock() - started) / count
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def measure_allocated(func):
+    '''measure_allocated(func) -> (func(), bytes allocated and still held)
+
+    The bytes are None without tracemalloc.'''
+    if tracemalloc is None:
+        return (func(), None)
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        return (result, tracemalloc.get_traced_memory()[0] - before)
+    finally:
+        if started:
+            tracemalloc.stop()
+
+def bench_clone(count = 2000, repeat = 5):
+    '''bench_clone(count, repeat) -> {'build': s, 'clone': s, 'speedup': x}'''
+    ui = loadgen.NullUI()
+    prototype = soda.SodaMachine(ui)
+    prototype.start()
+
+    def build():
+        machine = soda.SodaMachine(ui)
+        machine.start()
+
+    def clone():
+        prototype.clone(ui)
+
+    build_time = best_of(repeat, count, build)
+    clone_time = best_of(repeat, count, clone)
+    return {'build': build_time,
+            'clone': clone_time,
+            'speedup': build_time / clone_time}
+
+class Tick(fsm.Event): pass
+
+
+class Toggle(fsm.Event): pass
+
+
+class Ignored(fsm.Event): pass
+
+
+def build_nested_hsm():
+    left = hsm.SimpleState('left')
+    right = hsm.SimpleState('right')
+    inner = hsm.CompositeState(name='inner')
+    inner.add_states([left, right])
+    inner.set_initial_state(left)
+    outer = hsm.CompositeState(name='outer')
+    outer.add_state(inner)
+    outer.set_initial_state(inner)
+    sm = hsm.HSM()
+    sm.top.add_state(outer)
+    sm.top.set_initial_state(outer)
+    outer.add_activity(Tick, fsm.Activity(fsm.nop))
+    left.add_transition(Toggle, fsm.Transition(right))
+    right.add_transition(Toggle, fsm.Transition(left))
+    return sm
+
+def bench_events(method_name, count, repeat):
+    sm = build_nested_hsm()
+    sm.start()
+    method = getattr(sm, method_name)
+    result = {}
+    for name, event in (('ignored', Ignored()), ('activity', Tick()),
+                        ('transition', Toggle())):
+        result[name] = best_of(repeat, count, lambda: method(event))
+    return result
+
+def bench_dispatch(count = 2000, repeat = 5):
+    '''bench_dispatch(count, repeat) -> seconds per dispatch by event kind'''
+    return bench_events('dispatch', count, repeat)
+
+def bench_post(count = 2000, repeat = 5):
+    '''bench_post(count, repeat) -> seconds per post by event kind'''
+    return bench_events('post', count, repeat)
+
+
+class Reading(fsm.Event):
+
+    def __new__(cls, value):
+        event = fsm.Event.__new__(cls)
+        event.value = value
+        return event
+
+
+def build_guarded_fsm(exclusive, count = 24):
+    '''Idle with count transitions on Reading, one for each value.'''
+    idle = fsm.State('idle')
+    sm = fsm.FSM([idle])
+    if exclusive:
+        idle.set_exclusive_transitions(Reading)
+    for i in range(count):
+        guard = lambda event, i=i: event.value == i
+        idle.add_transition(Reading, fsm.TransitionWithGuard(guard, idle))
+    return sm
+
+def bench_guards(count = 2000, repeat = 5):
+    '''bench_guards(count, repeat) -> seconds per post, plain and exclusive'''
+    result = {}
+    for name, exclusive in (('plain', False), ('exclusive', True)):
+        sm = build_guarded_fsm(exclusive)
+        sm.start()
+        event = Reading(23)
+        result[name] = best_of(repeat, count, lambda: sm.post(event))
+    result['speedup'] = result['plain'] / result['exclusive']
+    return result
+
+def bench_memory(count = 2000, repeat = 5):
+    '''bench_memory(count, repeat) -> bytes per soda machine
+
+    {'build_bytes': b, 'clone_bytes': b, 'report_bytes': b}, repeat unused.'''
+    ui = loadgen.NullUI()
+
+    def build():
+        machines = [soda.SodaMachine(ui) for i in range(count)]
+        for machine in machines:
+            machine.start()
+        return machines
+
+    machines, build_bytes = measure_allocated(build)
+    prototype = machines[0]
+    clones, clone_bytes = measure_allocated(
+            lambda: [prototype.clone(ui) for i in range(count)])
+    result = {'report_bytes': prototype.sm.memory_report()['total']}
+    if build_bytes is not None:
+        result['build_bytes'] = build_bytes // count
+        result['clone_bytes'] = clone_bytes // count
+    return result
+
+
+def build_ring_spec(count):
+    '''A ring of count states, each with an enter activity and a Tick transition.'''
+    states = [{'name': 'S%d' % i, 'enter': ['fsm.nop']} for i in range(count)]
+    transitions = [{'source': 'S%d' % i, 'event': 'bench.Tick',
+                    'target': 'S%d' % ((i + 1) % count), 'effect': 'fsm.nop'}
+                   for i in range(count)]
+    return {'type': 'fsm', 'states': states, 'transitions': transitions}
+
+def bench_spec(count = 2000, repeat = 5):
+    '''bench_spec(count states, repeat) -> seconds per load of the spec'''
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'ring.json')
+        with open(path, 'w') as f:
+            json.dump(build_ring_spec(count), f)
+        cache_dir = os.path.join(directory, 'cache')
+        os.mkdir(cache_dir)
+        spec.load_flat_file(path, cache_dir)
+        result = {'objects': best_of(repeat, 1, lambda: spec.load_file(path)),
+                  'flat': best_of(repeat, 1, lambda: spec.load_flat_file(path)),
+                  'cached': best_of(repeat, 1,
+                                    lambda: spec.load_flat_file(path, cache_dir))}
+    finally:
+        shutil.rmtree(directory)
+    result['speedup'] = result['flat'] / result['cached']
+    return result
+
+
+BENCHMARKS = {'clone': bench_clone,
+              'dispatch': bench_dispatch,
+              'guards': bench_guards,
+              'memory': bench_memory,
+              'post': bench_post,
+              'spec': bench_spec}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    result = BENCHMARKS[args.benchmark](args.count, args.repeat)
+    for key in sorted(result):
+        if key == 'speedup':
+            print('%-10s %.1fx' % (key, result[key]))
+        elif key.endswith('_bytes'):
+            print('%-12s %d B' % (key, result[key]))
+        else:
+            print('%-10s %.2f us' % (key, result[key] * 1e6))
+    return result
+
+
+if __name__ == '__main__':
+    main()
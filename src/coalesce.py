@@ -0,0 +1,105 @@
+'''
+Event coalescing
+
+A Coalescer sits in front of a machine and holds events back for a short
+window. An event of a class with a merge rule is merged into the event held
+just before it when that one is of the same class, so a burst becomes one
+event and one stimulate round. Only adjacent events are merged, the order
+between event classes is kept.
+
+    coalescer = Coalescer(machine.post, max_events=64, max_delay=0.01)
+    coalescer.add_rule(soda.CoinDeposited, sum_field('value'))
+    for event in burst:
+        coalescer.post(event)
+    coalescer.flush()
+
+A rule merge(held, event) returns the merged event, or None to keep both.
+The window closes after max_events posted events or max_delay seconds
+after the first held one, whichever comes first. The delay is checked on
+post() and poll(); there is no background thread.
+'''
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def copy_event(event):
+    '''Shallow copy, without calling the __new__ of the event class.'''
+    other = object.__new__(event.__class__)
+    other.__dict__.update(event.__dict__)
+    return other
+
+def sum_field(name):
+    '''Rule adding up the field name of the merged events.'''
+    def merge(held, event):
+        merged = copy_event(held)
+        setattr(merged, name, getattr(held, name) + getattr(event, name))
+        return merged
+    return merge
+
+def keep_last(held, event):
+    return event
+
+def drop_duplicates(held, event):
+    '''Rule dropping an event equal, field by field, to the held one.'''
+    if held.__dict__ == event.__dict__:
+        return held
+    return None
+
+
+class Coalescer(object):
+
+    def __init__(self, send, max_events = 64, max_delay = None):
+        '''send(event) passes an event on, machine.post for instance.'''
+        object.__init__(self)
+        assert(max_events > 0)
+        self.send = send
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.clock = clock
+        self.rules = {}
+        self.held = []
+        self.held_posts = 0
+        self.first_held_time = None
+        self.posted = 0
+        self.sent = 0
+
+    def add_rule(self, event_cls, merge):
+        self.rules[event_cls] = merge
+
+    def post(self, event):
+        held = self.held
+        if not held and self.max_delay is not None:
+            self.first_held_time = self.clock()
+        merge = self.rules.get(event.__class__)
+        merged = None
+        if merge is not None and held and held[-1].__class__ is event.__class__:
+            merged = merge(held[-1], event)
+        if merged is None:
+            held.append(event)
+        else:
+            held[-1] = merged
+        self.posted += 1
+        self.held_posts += 1
+        if self.held_posts >= self.max_events:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        '''Flush if the delay has passed. For callers that go idle.'''
+        if (self.held and self.max_delay is not None
+                and self.clock() - self.first_held_time >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        held = self.held
+        self.held = []
+        self.held_posts = 0
+        for event in held:
+            self.send(event)
+        self.sent += len(held)
+
+    def get_merge_ratio(self):
+        '''Posted events per event sent on.'''
+        return float(self.posted) / self.sent if self.sent else 0.0
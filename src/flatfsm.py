@@ -0,0 +1,302 @@
+'''
+Array backed Finite State Machine
+
+A compact alternative to fsm.FSM for very large generated machines. States,
+event types and handlers are plain integers. Transitions and activities are
+kept in flat arrays indexed CSR style by source state, and guards, effects and
+actions are ids into a shared function table. No State objects are created.
+
+The run to completion semantics are the ones of fsm.FSM: start(), stimulate()
+and stop() follow the same enter/exit/unnamed transition rules and return
+fsm.StimulusResponse tuples, except that targets are state ids.
+'''
+import array
+import fsm
+
+# Reserved state ids.
+INITIAL = 0
+FINAL = 1
+
+# Reserved event type ids.
+ENTER = 0
+EXIT = 1
+UNNAMED = 2
+
+# Reserved function ids.
+TRUE = 0
+NOP = 1
+
+NO_TARGET = -1
+
+_INDEX_TYPECODE = 'i'
+
+
+class FlatFSMBuilder(object):
+    '''Collects states and handlers in bulk and builds a FlatFSM.'''
+
+    def __init__(self):
+        object.__init__(self)
+        self.num_states = 2
+        self.state_names = {INITIAL: 'InitialState', FINAL: 'FinalState'}
+        self.event_types = [fsm.State.EnterEvent, fsm.State.ExitEvent,
+                            fsm.State.UnnamedEvent]
+        self.event_ids = dict((cls, i) for i, cls in enumerate(self.event_types))
+        self.functions = [fsm.get_true, fsm.nop]
+        self.function_ids = {id(fsm.get_true): TRUE, id(fsm.nop): NOP}
+        self.initial_target = FINAL
+        self.completed_activities = []
+        # Parallel columns, one entry per handler.
+        self.t_source = array.array(_INDEX_TYPECODE)
+        self.t_event = array.array(_INDEX_TYPECODE)
+        self.t_guard = array.array(_INDEX_TYPECODE)
+        self.t_target = array.array(_INDEX_TYPECODE)
+        self.t_effect = array.array(_INDEX_TYPECODE)
+        self.a_state = array.array(_INDEX_TYPECODE)
+        self.a_event = array.array(_INDEX_TYPECODE)
+        self.a_guard = array.array(_INDEX_TYPECODE)
+        self.a_action = array.array(_INDEX_TYPECODE)
+
+    def add_state(self, name = None):
+        state_id = self.num_states
+        self.num_states += 1
+        if name is not None:
+            self.state_names[state_id] = name
+        return state_id
+
+    def add_states(self, count, names = None):
+        '''add_states(count, names) -> id of the first added state'''
+        first = self.num_states
+        self.num_states += count
+        if names is not None:
+            assert(len(names) == count)
+            for i, name in enumerate(names):
+                self.state_names[first + i] = name
+        return first
+
+    def add_event_type(self, event):
+        event_cls = fsm.get_object_class(event)
+        assert(issubclass(event_cls, fsm.Event))
+        if event_cls not in self.event_ids:
+            self.event_ids[event_cls] = len(self.event_types)
+            self.event_types.append(event_cls)
+        return self.event_ids[event_cls]
+
+    def add_function(self, function):
+        if function is None:
+            return None
+        key = id(function)
+        if key not in self.function_ids:
+            self.function_ids[key] = len(self.functions)
+            self.functions.append(function)
+        return self.function_ids[key]
+
+    def add_transition(self, source, event, target, guard = None, effect = None):
+        self._check_state(source)
+        if target is None:
+            target = NO_TARGET
+        else:
+            self._check_state(target)
+        self.t_source.append(source)
+        self.t_event.append(self._event_id(event))
+        self.t_guard.append(self._function_id(guard, TRUE))
+        self.t_target.append(target)
+        self.t_effect.append(self._function_id(effect, NOP))
+
+    def add_unnamed_transition(self, source, target, guard = None, effect = None):
+        self.add_transition(source, UNNAMED, target, guard, effect)
+
+    def add_activity(self, state, event, action, guard = None):
+        self._check_state(state)
+        self.a_state.append(state)
+        self.a_event.append(self._event_id(event))
+        self.a_guard.append(self._function_id(guard, TRUE))
+        self.a_action.append(self._function_id(action, NOP))
+
+    def add_enter_activity(self, state, action, guard = None):
+        self.add_activity(state, ENTER, action, guard)
+
+    def add_exit_activity(self, state, action, guard = None):
+        self.add_activity(state, EXIT, action, guard)
+
+    def add_start_activity(self, action, guard = None):
+        self.add_enter_activity(INITIAL, action, guard)
+
+    def add_stop_activity(self, action, guard = None):
+        self.add_enter_activity(FINAL, action, guard)
+
+    def add_on_transition_completed_activity(self, action, guard = None):
+        self.completed_activities.append((self._function_id(guard, TRUE),
+                                          self._function_id(action, NOP)))
+
+    def set_initial_state(self, state):
+        self._check_state(state)
+        self.initial_target = state
+
+    def build(self):
+        # The initial pseudo state always leaves through one unnamed
+        # transition, added last so it does not move user handlers.
+        self.t_source.append(INITIAL)
+        self.t_event.append(UNNAMED)
+        self.t_guard.append(TRUE)
+        self.t_target.append(self.initial_target)
+        self.t_effect.append(NOP)
+
+        t_offsets, t_order = _csr_index(self.t_source, self.num_states)
+        a_offsets, a_order = _csr_index(self.a_state, self.num_states)
+
+        machine = FlatFSM.__new__(FlatFSM)
+        machine.num_states = self.num_states
+        machine.state_names = dict(self.state_names)
+        machine.event_types = list(self.event_types)
+        machine.event_ids = dict(self.event_ids)
+        machine.functions = list(self.functions)
+        machine.completed_activities = tuple(self.completed_activities)
+        machine.t_offsets = t_offsets
+        machine.t_event = _permute(self.t_event, t_order)
+        machine.t_guard = _permute(self.t_guard, t_order)
+        machine.t_target = _permute(self.t_target, t_order)
+        machine.t_effect = _permute(self.t_effect, t_order)
+        machine.a_offsets = a_offsets
+        machine.a_event = _permute(self.a_event, a_order)
+        machine.a_guard = _permute(self.a_guard, a_order)
+        machine.a_action = _permute(self.a_action, a_order)
+        machine.current = INITIAL
+
+        # Leave the builder reusable.
+        for column in (self.t_source, self.t_event, self.t_guard,
+                       self.t_target, self.t_effect):
+            column.pop()
+        return machine
+
+    def _check_state(self, state):
+        assert(isinstance(state, int) and 0 <= state < self.num_states)
+
+    def _event_id(self, event):
+        if isinstance(event, int):
+            assert(0 <= event < len(self.event_types))
+            return event
+        return self.add_event_type(event)
+
+    def _function_id(self, function, default):
+        if function is None:
+            return default
+        if isinstance(function, int):
+            assert(0 <= function < len(self.functions))
+            return function
+        return self.add_function(function)
+
+
+def _csr_index(keys, num_rows):
+    '''_csr_index(keys, num_rows) -> (offsets, order)
+
+    Stable counting sort of the handler rows by key. Linear in the number of
+    rows and states.'''
+    offsets = array.array(_INDEX_TYPECODE, [0]) * (num_rows + 1)
+    for key in keys:
+        offsets[key + 1] += 1
+    for row in range(num_rows):
+        offsets[row + 1] += offsets[row]
+    fill = array.array(_INDEX_TYPECODE, offsets)
+    order = array.array(_INDEX_TYPECODE, [0]) * len(keys)
+    for i, key in enumerate(keys):
+        order[fill[key]] = i
+        fill[key] += 1
+    return offsets, order
+
+def _permute(column, order):
+    return array.array(_INDEX_TYPECODE, [column[i] for i in order])
+
+
+class FlatFSM(object):
+    '''Built by FlatFSMBuilder.build(). Mirrors the fsm.FSM runtime API.'''
+
+    def start(self):
+        assert(self.current == INITIAL or self.current == FINAL)
+        self.current = INITIAL
+        return self._stimulate(ENTER, fsm.State.EnterEvent)
+
+    def stop(self):
+        if self.current == FINAL:
+            return fsm.NO_RESPONSE
+        response, send_unnamed = self._dispatch_to_current(EXIT, fsm.State.ExitEvent,
+                                                           default_target=FINAL)
+        return self._follow_unnamed(response, send_unnamed, EXIT)
+
+    def reset(self):
+        self.current = INITIAL
+
+    def stimulate(self, event):
+        event_id = self.event_ids.get(fsm.get_object_class(event))
+        if event_id is None:
+            # No state has handlers for this event type.
+            return fsm.NO_RESPONSE
+        return self._stimulate(event_id, event)
+
+    def is_active(self, state):
+        return self.current == state
+
+    def get_state_name(self, state):
+        return self.state_names.get(state, 'State%d' % state)
+
+    def get_event_id(self, event):
+        return self.event_ids.get(fsm.get_object_class(event))
+
+    def _stimulate(self, event_id, event):
+        response, send_unnamed = self._dispatch_to_current(event_id, event)
+        return self._follow_unnamed(response, send_unnamed, event_id)
+
+    def _follow_unnamed(self, response, send_unnamed, event_id):
+        while send_unnamed or event_id == ENTER:
+            event_id = UNNAMED
+            response, send_unnamed = self._dispatch_to_current(UNNAMED,
+                                                               fsm.State.UnnamedEvent)
+        return response
+
+    def _dispatch_to_current(self, event_id, event, default_target = NO_TARGET):
+        current = self.current
+        acted, triggered, target = self._react(current, event_id, event)
+        if not triggered and default_target != NO_TARGET:
+            triggered, target = True, default_target
+
+        requested = triggered and target != NO_TARGET
+        if requested:
+            if self._react(current, EXIT, fsm.State.ExitEvent)[0]:
+                acted = True
+            self.current = target
+            if self._react(target, ENTER, fsm.State.EnterEvent)[0]:
+                acted = True
+            functions = self.functions
+            for guard, action in self.completed_activities:
+                if functions[guard](fsm.Event):
+                    functions[action](fsm.Event)
+
+        if not triggered or target == NO_TARGET:
+            target = None
+        return fsm.StimulusResponse(acted, requested, target), requested
+
+    def _react(self, state, event_id, event):
+        '''_react(state, event_id, event) -> (acted, triggered, target)'''
+        functions = self.functions
+
+        acted = False
+        a_event = self.a_event
+        a_guard = self.a_guard
+        a_action = self.a_action
+        for i in range(self.a_offsets[state], self.a_offsets[state + 1]):
+            if a_event[i] == event_id and functions[a_guard[i]](event):
+                functions[a_action[i]](event)
+                acted = True
+
+        t_event = self.t_event
+        t_guard = self.t_guard
+        for i in range(self.t_offsets[state], self.t_offsets[state + 1]):
+            if t_event[i] == event_id and functions[t_guard[i]](event):
+                functions[self.t_effect[i]](event)
+                return acted, True, self.t_target[i]
+        return acted, False, NO_TARGET
+
+    def name(self):
+        return self.__class__.__name__
+
+    def __repr__(self):
+        return self.name()
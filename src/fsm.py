@@ -1,47 +1,88 @@
 '''
 Finite State Machine
 '''
+import collections
+import copy
+import itertools
+import sys
 import types
 
 def get_object_class(obj):
-    if    isinstance(obj, types.ClassType) \
-       or isinstance(obj, types.TypeType):
+    '''get_object_class(obj) -> obj if obj is a class, else its class'''
+    if isinstance(obj, type):
         return obj
-    elif isinstance(obj, types.NoneType):
-        return types.NoneType
-    else:
-        return obj.__class__
+    return obj.__class__
+
+
+_event_type_ids = {}
+_event_types_by_id = {}
+_next_event_type_id = itertools.count()
+
+def get_event_type_id(event):
+    '''get_event_type_id(event) -> int
+
+    Small integer identifying the class of an event class or instance. Ids
+    are assigned on first use and stay fixed for the life of the process.'''
+    event_cls = event if isinstance(event, type) else event.__class__
+    type_id = _event_type_ids.get(event_cls)
+    if type_id is None:
+        type_id = _event_type_ids.setdefault(event_cls, next(_next_event_type_id))
+        _event_types_by_id[type_id] = event_cls
+    return type_id
+
+def get_event_type(type_id):
+    return _event_types_by_id[type_id]
         
 
+# Event priorities, lanes of the machine inbox.
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+
+
 class Event(object):
     
-    def __new__(cls, name = ''):
+    # Set on the class, or per event when constructed.
+    priority = NORMAL_PRIORITY
+    
+    def __new__(cls, name = '', priority = None):
         obj = object.__new__(cls)
         obj.name = name
+        if priority is not None:
+            obj.priority = priority
         return obj
     
     def get_name(self):
         if self.name != '':
             return self.name
         else:
-            my_cls = get_object_class(self)
-            return my_cls.__name__
+            return self.__class__.__name__
 
     def __repr__(self):
         return self.get_name()
     
     def __eq__(self, other):
-        if not Event.is_event_or_event_type(other):
+        other_cls = other if isinstance(other, type) else other.__class__
+        my_cls = self.__class__
+        if my_cls is other_cls:
+            return True
+        if not issubclass(other_cls, Event):
             return False
-        other_cls = get_object_class(other)
-        my_cls = get_object_class(self)
         return issubclass(my_cls, other_cls) or issubclass(other_cls, my_cls) 
     
+    # Defining __eq__ would make instances unhashable on Python 3.
+    __hash__ = object.__hash__
+    
     @staticmethod
     def is_event_or_event_type(event):
         event_cls = get_object_class(event)
         return issubclass(event_cls, (Event))
 
+    @staticmethod
+    def is_same_type(event, event_type):
+        '''Identity check of the event class, no subclass matching.'''
+        return event is event_type or event.__class__ is event_type
+
 
 def get_true(*args):
     return True
@@ -63,14 +104,29 @@ class EventHandlerWithGuardAndEffect(object):
         handler.effect = effect
         return handler
     
-    def stimulate(self, event):
-        '''stimulate(event) -> Tuple(Boolean)'''
+    def stimulate(self, event, machine = None):
+        '''stimulate(event, machine) -> Tuple(Boolean)
+
+        machine is the one dispatching event, None outside a machine.'''
         assert(Event.is_event_or_event_type(event))
         if self.guard(event):
             self.effect(event)
             return (True,)
         return (False,)
 
+    def fire(self, event, machine = None):
+        '''fire(event, machine) -> True if triggered, stimulate() without the tuple
+
+        Subclasses overriding stimulate() override this as well.'''
+        if self.guard(event):
+            self.effect(event)
+            return True
+        return False
+    
+    def retarget(self, states):
+        '''retarget(states) -> handler with targets mapped through states'''
+        return self
+    
     def get_name(self):
         effect = self.effect.__name__
         guard = self.guard.__name__
@@ -88,12 +144,20 @@ class TransitionWithGuardAndEffect(EventHandlerWithGuardAndEffect):
         transition.target = target
         return transition
     
-    def stimulate(self, event):
-        (triggered,) = EventHandlerWithGuardAndEffect.stimulate(self, event)
+    def stimulate(self, event, machine = None):
+        (triggered,) = EventHandlerWithGuardAndEffect.stimulate(self, event, machine)
         if triggered:
             return (True, self.target)
         return (False, None)
     
+    def retarget(self, states):
+        if self.target not in states:
+            return self
+        transition = object.__new__(self.__class__)
+        transition.__dict__.update(self.__dict__)
+        transition.target = states[self.target]
+        return transition
+    
     def get_name(self):
         name = EventHandlerWithGuardAndEffect.get_name(self)
         if None != self.target:
@@ -125,6 +189,113 @@ class Transition(TransitionWithGuardAndEffect):
         return tran
 
 
+class MachineTransition(TransitionWithGuardAndEffect):
+    '''Transition whose guard and effect also take the machine dispatching
+    the event, guard(machine, event) and effect(machine, event).
+
+    Clones share their handlers, these act on whichever clone runs them.'''
+    
+    def __new__(cls, target, guard = get_true, effect = nop):
+        return TransitionWithGuardAndEffect.__new__(cls, guard=guard,
+                                                    target=target, effect=effect)
+    
+    def stimulate(self, event, machine = None):
+        if self.fire(event, machine):
+            return (True, self.target)
+        return (False, None)
+    
+    def fire(self, event, machine = None):
+        if self.guard(machine, event):
+            self.effect(machine, event)
+            return True
+        return False
+
+
+class EffectDone(Event):
+    '''Sent by TransitionWithAsyncEffect with the result of its effect.'''
+    
+    def __new__(cls, result = None, event = None):
+        done = Event.__new__(cls)
+        done.result = result
+        done.event = event
+        return done
+
+
+class EffectFailed(Event):
+    '''Sent by TransitionWithAsyncEffect with the error of its effect.'''
+    
+    def __new__(cls, error = None, event = None):
+        failed = Event.__new__(cls)
+        failed.error = error
+        failed.event = event
+        return failed
+
+
+class TransitionWithAsyncEffect(TransitionWithGuardAndEffect):
+    '''Transition that starts its effect and completes without waiting.
+
+    The effect runs on executor, anything with submit(fn, *args) -> future
+    such as a concurrent.futures.ThreadPoolExecutor, or without executor
+    returns an awaitable that is scheduled on the running asyncio loop; taken
+    with no loop running, the transition raises RuntimeError. When it
+    finishes, send(done_event(result, event)) or
+    send(failed_event(error, event)) is called, from the executor's thread.
+    A cancelled effect sends failed_event with the CancelledError.
+    Without send, the completion goes to the machine that took the
+    transition, with post_threadsafe() when there is an executor and post()
+    with asyncio, so each clone sharing the transition gets its own.'''
+    
+    def __new__(cls, target, effect, send = None, executor = None, guard = get_true,
+                done_event = EffectDone, failed_event = EffectFailed):
+        transition = TransitionWithGuardAndEffect.__new__(cls, guard=guard,
+                                                          target=target,
+                                                          effect=effect)
+        transition.send = send
+        transition.executor = executor
+        transition.done_event = done_event
+        transition.failed_event = failed_event
+        return transition
+    
+    def stimulate(self, event, machine = None):
+        if self.fire(event, machine):
+            return (True, self.target)
+        return (False, None)
+    
+    def fire(self, event, machine = None):
+        if not self.guard(event):
+            return False
+        self.start(event, machine)
+        return True
+    
+    def start(self, event, machine = None):
+        '''start(event, machine) -> future of the effect'''
+        send = self.send
+        if send is None:
+            assert(machine is not None)
+            send = machine.post if self.executor is None else machine.post_threadsafe
+        if self.executor is None:
+            import asyncio
+            # Raises outside a running loop, where the effect would never run.
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(self.effect(event), loop=loop)
+        else:
+            future = self.executor.submit(self.effect, event)
+        future.add_done_callback(lambda future: self._done(future, event, send))
+        return future
+    
+    def _done(self, future, event, send):
+        try:
+            result = future.result()
+        except BaseException as error:
+            # CancelledError is not an Exception from Python 3.8 on. Other
+            # BaseExceptions are not the effect failing and are passed on.
+            if not isinstance(error, Exception) and not future.cancelled():
+                raise
+            send(self.failed_event(error, event))
+        else:
+            send(self.done_event(result, event))
+
+
 class ActivityWithGuard(EventHandlerWithGuardAndEffect):
     
     def __new__(cls, guard, action):
@@ -140,16 +311,126 @@ class Activity(ActivityWithGuard):
         return activity
 
 
+class MachineActivity(ActivityWithGuard):
+    '''Activity whose guard and action also take the machine dispatching the
+    event, guard(machine, event) and action(machine, event).'''
+    
+    def __new__(cls, action, guard = get_true):
+        return ActivityWithGuard.__new__(cls, guard=guard, action=action)
+    
+    def stimulate(self, event, machine = None):
+        return (self.fire(event, machine),)
+    
+    def fire(self, event, machine = None):
+        if self.guard(machine, event):
+            self.effect(machine, event)
+            return True
+        return False
+
+
+class ActivityFailed(Event):
+    '''Sent by an IndependentActivity left running, with its error.'''
+    
+    def __new__(cls, error = None, event = None):
+        failed = Event.__new__(cls)
+        failed.error = error
+        failed.event = event
+        return failed
+
+
+class IndependentActivity(ActivityWithGuard):
+    '''Activity whose action runs on an executor, concurrently with the
+    other independent activities on the same event.
+
+    executor is anything with submit(fn, *args) -> future, such as a
+    concurrent.futures.ThreadPoolExecutor. The guard runs inline. With wait,
+    the event is not done until the action is, and its error is raised with
+    the others in an ActivityErrors. Without, the action is left running and
+    its error is handed to the dispatching machine as
+    failed_event(error, event) with post_threadsafe(), for its next
+    macrostep or run_queued(). Run outside a machine, the last max_errors
+    errors are kept in errors.'''
+    
+    max_errors = 64
+    
+    def __new__(cls, action, executor, wait = True, guard = get_true,
+                failed_event = ActivityFailed):
+        activity = ActivityWithGuard.__new__(cls, guard=guard, action=action)
+        activity.executor = executor
+        activity.wait = wait
+        activity.failed_event = failed_event
+        activity.errors = collections.deque(maxlen=activity.max_errors)
+        return activity
+    
+    def stimulate(self, event, machine = None):
+        return (self.fire(event, machine),)
+    
+    def fire(self, event, machine = None):
+        future = self.submit(event, machine)
+        if future is NOT_FIRED:
+            return False
+        if future is not None:
+            wait_for_all([future], machine)
+        return True
+    
+    def submit(self, event, machine = None):
+        '''submit(event, machine) -> future to wait for, None or NOT_FIRED if the
+        guard does not hold'''
+        if not self.guard(event):
+            return NOT_FIRED
+        future = self.executor.submit(self.effect, event)
+        if self.wait:
+            return future
+        future.add_done_callback(lambda future: self._done(future, event, machine))
+        return None
+    
+    def _done(self, future, event, machine):
+        error = future.exception()
+        if error is None:
+            return
+        if machine is None:
+            self.errors.append(error)
+        else:
+            machine.post_threadsafe(self.failed_event(error, event))
+
+
+class ActivityErrors(Exception):
+    '''Errors of independent activities, in the order of the activities.'''
+    
+    def __init__(self, errors):
+        Exception.__init__(self, '%d activities failed: %s'
+                           % (len(errors), ', '.join(repr(e) for e in errors)))
+        self.errors = errors
+
+
+def wait_for_all(futures, machine = None):
+    '''Wait for every future, then raise ActivityErrors if any failed.
+
+    In a macrostep of machine, the errors are handed to it instead and raised
+    once the macrostep is complete, so that the transition is finished.'''
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as error:
+            errors.append(error)
+    if errors:
+        if machine is not None and machine._busy:
+            machine._defer_errors(errors)
+        else:
+            raise ActivityErrors(errors)
+
+
 class EventHandlers(object):
     
     def __init__(self, stop_at_first_trigger):
         self.handlers = []
         self.stop_at_first_trigger = stop_at_first_trigger
 
-    def stimulate(self, event):
+    def stimulate(self, event, machine = None):
         last_triggered_tuple = (False,)
         for handler in self.handlers:
-            tuple_res = handler.stimulate(event)
+            tuple_res = handler.stimulate(event, machine)
             assert(isinstance(tuple_res, (tuple)))
             assert(len(tuple_res) >= 1)
             assert(isinstance(tuple_res[0], (bool)))
@@ -167,6 +448,23 @@ class EventHandlers(object):
         assert(isinstance(handler, (EventHandlerWithGuardAndEffect)))
         self.handlers.append(handler)
     
+    def fire(self, event, machine = None):
+        '''fire(event, machine) -> True if any handler triggered'''
+        triggered = False
+        for handler in self.handlers:
+            if handler.fire(event, machine):
+                if self.stop_at_first_trigger:
+                    return True
+                triggered = True
+        return triggered
+    
+    def copy(self, states = {}):
+        '''copy(states) -> list of its own, targets mapped through states'''
+        other = object.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other.handlers = [handler.retarget(states) for handler in self.handlers]
+        return other
+    
     def __iter__(self):
         for handler in self.handlers:
             yield handler
@@ -175,6 +473,10 @@ class EventHandlers(object):
         return self.handlers.__repr__()
 
 
+# Returned by the fire() methods when no handler triggered at all.
+NOT_FIRED = object()
+
+
 class TransitionList(EventHandlers):
     
     def __init__(self, transitions_arg = []):
@@ -182,12 +484,19 @@ class TransitionList(EventHandlers):
         for transition in transitions_arg:
             self.add_transition(transition)
     
-    def stimulate(self, event):
-        tuple_res = EventHandlers.stimulate(self, event)
+    def stimulate(self, event, machine = None):
+        tuple_res = EventHandlers.stimulate(self, event, machine)
         if len(tuple_res) == 1:
             return (False, None)
         else:
             return tuple_res 
+    
+    def fire(self, event, machine = None):
+        '''fire(event, machine) -> target of the triggered transition or NOT_FIRED'''
+        for transition in self.handlers:
+            if transition.fire(event, machine):
+                return transition.target
+        return NOT_FIRED
 
     def add_transition(self, transition):
         assert(isinstance(transition, (TransitionWithGuardAndEffect)))
@@ -198,16 +507,105 @@ class TransitionList(EventHandlers):
         assert(False)
     
 
+class ExclusiveTransitionList(TransitionList):
+    '''Transitions of which at most one guard holds for any one event.
+
+    Declaring that lets the guards be tried in any order, so they are tried
+    most often taken first. The order is recomputed every resort_every
+    lookups, after which the counts are halved so that it follows changes
+    in the traffic. If two guards do hold at once, which transition is
+    taken depends on the traffic seen so far.'''
+    
+    resort_every = 256
+    
+    def __init__(self, transitions_arg = [], resort_every = None):
+        self.hits = []
+        self.lookups = 0
+        if resort_every is not None:
+            self.resort_every = resort_every
+        TransitionList.__init__(self, transitions_arg)
+    
+    def stimulate(self, event, machine = None):
+        self.lookups += 1
+        if self.lookups % self.resort_every == 0:
+            self.resort()
+        for i, transition in enumerate(self.handlers):
+            triggered, target = transition.stimulate(event, machine)
+            if triggered:
+                self.hits[i] += 1
+                return (True, target)
+        return (False, None)
+    
+    def fire(self, event, machine = None):
+        self.lookups += 1
+        if self.lookups % self.resort_every == 0:
+            self.resort()
+        for i, transition in enumerate(self.handlers):
+            if transition.fire(event, machine):
+                self.hits[i] += 1
+                return transition.target
+        return NOT_FIRED
+    
+    def resort(self):
+        '''Order the transitions by hits, ties in their current order.'''
+        hits = self.hits
+        order = sorted(range(len(hits)), key=lambda i: -hits[i])
+        self.handlers = [self.handlers[i] for i in order]
+        self.hits = [hits[i] // 2 for i in order]
+    
+    def add_transition(self, transition):
+        TransitionList.add_transition(self, transition)
+        self.hits.append(0)
+    
+    def copy(self, states = {}):
+        other = TransitionList.copy(self, states)
+        other.hits = list(self.hits)
+        return other
+
+
 class ActivityList(EventHandlers):
     
+    # Number of IndependentActivity handlers.
+    independent = 0
+    
     def __init__(self, activities_arg = []):
         EventHandlers.__init__(self, stop_at_first_trigger=False)
         for activity in activities_arg:
             self.add_activity(activity)
     
+    def stimulate(self, event, machine = None):
+        if self.independent:
+            return (self._run_concurrently(event, machine),)
+        return EventHandlers.stimulate(self, event, machine)
+    
+    def fire(self, event, machine = None):
+        if self.independent:
+            return self._run_concurrently(event, machine)
+        return EventHandlers.fire(self, event, machine)
+    
+    def _run_concurrently(self, event, machine):
+        # Independent activities are submitted in turn with the others run
+        # inline, then waited for together.
+        triggered = False
+        futures = []
+        for handler in self.handlers:
+            if isinstance(handler, IndependentActivity):
+                future = handler.submit(event, machine)
+                if future is NOT_FIRED:
+                    continue
+                if future is not None:
+                    futures.append(future)
+                triggered = True
+            elif handler.fire(event, machine):
+                triggered = True
+        wait_for_all(futures, machine)
+        return triggered
+    
     def add_activity(self, activity):
         assert(isinstance(activity, (ActivityWithGuard)))
         EventHandlers.add_handler(self, handler=activity)
+        if isinstance(activity, IndependentActivity):
+            self.independent += 1
     
     def add_handler(self, handler):
         # Don't use this. Use add_activity instead.
@@ -227,6 +625,12 @@ class EventDictOfHandlerLists(object):
         event_cls = get_object_class(event)
         return event_cls in self.list_dict
     
+    def copy(self, states = {}):
+        other = object.__new__(self.__class__)
+        other.list_dict = dict((event_cls, handlers.copy(states))
+                               for event_cls, handlers in self.list_dict.items())
+        return other
+    
     def __repr__(self):
         return self.list_dict.__repr__()
     
@@ -236,13 +640,17 @@ class EventDictOfTransitions(EventDictOfHandlerLists):
     def __init__(self):
         EventDictOfHandlerLists.__init__(self)
 
-    def stimulate(self, event):
-        if event not in self:
+    def stimulate(self, event, machine = None):
+        transition_list = self.list_dict.get(get_object_class(event))
+        if transition_list is None:
             return (False, None)
-        
-        event_cls = get_object_class(event)
-        transition_list = self.list_dict[event_cls]
-        return transition_list.stimulate(event)
+        return transition_list.stimulate(event, machine)
+
+    def fire(self, event, machine = None):
+        transition_list = self.list_dict.get(get_object_class(event))
+        if transition_list is None:
+            return NOT_FIRED
+        return transition_list.fire(event, machine)
 
     def add_transition(self, event, transition):
         event_cls = get_object_class(event)
@@ -252,6 +660,13 @@ class EventDictOfTransitions(EventDictOfHandlerLists):
         transition_list = self.list_dict[event_cls]
         transition_list.add_transition(transition)
     
+    def set_exclusive(self, event, resort_every = None):
+        '''Make the transitions on event an ExclusiveTransitionList.'''
+        event_cls = get_object_class(event)
+        transition_list = self.list_dict.get(event_cls, ())
+        self.list_dict[event_cls] = ExclusiveTransitionList(transition_list,
+                                                            resort_every)
+    
     def clear(self, event):
         event_cls = get_object_class(event)
         if event_cls in self.list_dict:
@@ -264,13 +679,15 @@ class EventDictOfActivities(EventDictOfHandlerLists):
     def __init__(self):
         EventDictOfHandlerLists.__init__(self)
 
-    def stimulate(self, event):
-        if event not in self:
+    def stimulate(self, event, machine = None):
+        activity_list = self.list_dict.get(get_object_class(event))
+        if activity_list is None:
             return (False,)
-        
-        event_cls = get_object_class(event)
-        transition_list = self.list_dict[event_cls]
-        return transition_list.stimulate(event)
+        return activity_list.stimulate(event, machine)
+
+    def fire(self, event, machine = None):
+        activity_list = self.list_dict.get(get_object_class(event))
+        return activity_list is not None and activity_list.fire(event, machine)
 
     def add_activity(self, event, activity):
         event_cls = get_object_class(event)
@@ -281,6 +698,11 @@ class EventDictOfActivities(EventDictOfHandlerLists):
         activity_list.add_activity(activity)
 
 
+# Response flags, responses of several states aggregate with bitwise or.
+ACTED = 1
+TRANSITION_REQUESTED = 2
+
+
 class StimulusResponse(tuple):
     
     def __new__(cls, activity, transition, target):
@@ -291,6 +713,19 @@ class StimulusResponse(tuple):
         tpl = tuple.__new__(cls, (activity, transition, target))
         return tpl
     
+    @staticmethod
+    def from_flags(flags, target = None):
+        '''from_flags(flags, target) -> response, preallocated when targetless'''
+        if target is None:
+            return _targetless_responses[flags & ACTED]
+        return StimulusResponse(bool(flags & ACTED),
+                                bool(flags & TRANSITION_REQUESTED), target)
+    
+    def get_flags(self):
+        if self[1] and self[2] is not None:
+            return self[0] | TRANSITION_REQUESTED
+        return int(self[0])
+    
     def did_act_or_requested_transition(self):
         return self.did_act() or self.was_transition_requested()
 
@@ -304,6 +739,13 @@ class StimulusResponse(tuple):
         return self[2]
 
 
+# Shared instances for the common outcomes without a transition, which can
+# be recognised by identity.
+NO_RESPONSE = StimulusResponse(False, False, None)
+ACTED_RESPONSE = StimulusResponse(True, False, None)
+_targetless_responses = (NO_RESPONSE, ACTED_RESPONSE)
+
+
 class State(object):
     
     class EnterEvent(Event):
@@ -315,32 +757,60 @@ class State(object):
     class UnnamedEvent(Event):
         pass
     
+    # Handler containers are allocated on first add_activity/add_transition.
+    # Until then the class level None is used, so a state without handlers
+    # carries nothing but its name and active count.
+    activities = None
+    transitions = None
+    
     def __init__(self, name = ''):
         object.__init__(self)
         self.name = name
-        self.activities = EventDictOfActivities()
-        self.transitions = EventDictOfTransitions()
-        self._active = False
+        # Machines in the state, and enter() calls without a machine not yet
+        # followed by exit(). Each machine keeps which states it is in itself.
+        self._active = 0
 
-    def stimulate(self, event):
-        activity_triggered, = self.activities.stimulate(event)
-        transition_triggered, target = self.transitions.stimulate(event)
+    def stimulate(self, event, machine = None):
+        if self.activities is None:
+            activity_triggered = False
+        else:
+            activity_triggered, = self.activities.stimulate(event, machine)
+        if self.transitions is None:
+            transition_triggered = False
+        else:
+            transition_triggered, target = self.transitions.stimulate(event, machine)
+        if not transition_triggered:
+            return ACTED_RESPONSE if activity_triggered else NO_RESPONSE
         return StimulusResponse(activity_triggered, transition_triggered, target)
+    
+    def fire(self, event, machine = None):
+        '''fire(event, machine) -> transition target, None or NOT_FIRED
+
+        stimulate() without the response: the target of the transition taken,
+        None if only activities ran or the transition has no target, and
+        NOT_FIRED if nothing happened.'''
+        acted = self.activities is not None and self.activities.fire(event, machine)
+        if self.transitions is not None:
+            target = self.transitions.fire(event, machine)
+            if target is not NOT_FIRED:
+                return target
+        return None if acted else NOT_FIRED
         
-    def enter(self):
-        self._active = True
-        return State.stimulate(self, State.EnterEvent)
+    def enter(self, machine = None):
+        self._active += 1
+        return State.stimulate(self, State.EnterEvent, machine)
     
-    def exit(self):
-        exit_response = State.stimulate(self, State.ExitEvent)
-        self._active = False
+    def exit(self, machine = None):
+        exit_response = State.stimulate(self, State.ExitEvent, machine)
+        if self._active:
+            self._active -= 1
         return exit_response
     
     def start(self):
-        return StimulusResponse(False, False, None)
+        return NO_RESPONSE
     
     def stop(self):
-        return StimulusResponse(False, False, None)
+        return NO_RESPONSE
     
     def add_enter_activity(self, activity):
         self.add_activity(event=State.EnterEvent, activity=activity)
@@ -349,22 +819,48 @@ class State(object):
         self.add_activity(event=State.ExitEvent, activity=activity)
     
     def add_activity(self, event, activity):
+        if self.activities is None:
+            self.activities = EventDictOfActivities()
         self.activities.add_activity(event, activity)
     
     def add_unnamed_transition(self, transition):
         self.add_transition(State.UnnamedEvent, transition)
     
     def add_transition(self, event, transition):
+        if self.transitions is None:
+            self.transitions = EventDictOfTransitions()
         self.transitions.add_transition(event, transition)
     
+    def set_exclusive_transitions(self, event, resort_every = None):
+        '''Declare that at most one guard of the transitions on event holds
+        at a time, see ExclusiveTransitionList.'''
+        if self.transitions is None:
+            self.transitions = EventDictOfTransitions()
+        self.transitions.set_exclusive(event, resort_every)
+    
+    def clear_transitions(self, event):
+        if self.transitions is not None:
+            self.transitions.clear(event)
+    
     def has_activities_for(self, event):
-        return event in self.activities
+        return self.activities is not None and event in self.activities
     
     def has_transition_for(self, event):
-        return event in self.transitions
+        return self.transitions is not None and event in self.transitions
     
     def is_active(self):
-        return self._active
+        '''is_active() -> True if a machine, or a direct enter(), is in the state
+
+        With clones sharing the state, True as long as any of them is in it;
+        is_state_active(state) of a machine answers for that machine.'''
+        return self._active > 0
+    
+    def _relink(self, states):
+        # A shallow copy made by copy_states() takes its own handler lists.
+        if self.activities is not None:
+            self.activities = self.activities.copy()
+        if self.transitions is not None:
+            self.transitions = self.transitions.copy(states)
     
     def get_name(self):
         if self.name != '':
@@ -380,18 +876,397 @@ class State(object):
         return self.get_name()
 
 
+def copy_states(states):
+    '''copy_states(states) -> {state: copy}
+
+    The copies have their own handler lists and refer to each other where
+    the originals did. Guards, effects and actions are shared. No machine is
+    in the copies yet.'''
+    copies = dict((state, copy.copy(state)) for state in states)
+    for state in copies.values():
+        state._active = 0
+        state._relink(copies)
+    return copies
+
+
 class StateList(list):
     pass
 
 
-class FSM(object):
+class StateIndex(object):
+    '''Ordered registry of states with constant time membership.
+
+    Ids are the positions in the StateList view and never change once given.
+    Name lookup returns the first state registered under a name.'''
+    
+    def __init__(self, states = []):
+        object.__init__(self)
+        self.states = StateList()
+        self.ids = {}
+        self.names = {}
+        self.add_states(states)
+    
+    def add_state(self, state):
+        if state in self.ids:
+            return self.ids[state]
+        state_id = len(self.states)
+        self.states.append(state)
+        self.ids[state] = state_id
+        self.names.setdefault(state.get_name(), state)
+        return state_id
+    
+    def add_states(self, states):
+        for state in states:
+            self.add_state(state)
+    
+    def get_id(self, state):
+        return self.ids[state]
+    
+    def get_state(self, state_id):
+        return self.states[state_id]
+    
+    def find(self, name):
+        return self.names.get(name)
+    
+    def __contains__(self, state):
+        return state in self.ids
+    
+    def __len__(self):
+        return len(self.states)
+    
+    def __iter__(self):
+        return iter(self.states)
+    
+    def __repr__(self):
+        return self.states.__repr__()
+
+
+class Inbox(object):
+    '''A fixed number of FIFO lanes, lane 0 served first.
+
+    An event goes to the lane of its priority, clipped to the lanes there
+    are. Without bursts, lanes are served by strict priority. With bursts,
+    a lane serves at most bursts[lane] events while other lanes have events
+    waiting, then waits until each of them has had its burst or emptied:
+    every lane with events is served within one round of the bursts.'''
+    
+    def __init__(self, lanes = 3, bursts = None):
+        object.__init__(self)
+        assert(lanes > 0)
+        assert(bursts is None or len(bursts) == lanes)
+        self.lanes = [collections.deque() for i in range(lanes)]
+        self.bursts = bursts
+        self.count = 0
+        self.enqueued = [0] * lanes
+        self.max_depths = [0] * lanes
+        # Events each lane may still serve in this round of bursts.
+        self.credits = list(bursts) if bursts is not None else None
+    
+    def append(self, event):
+        lane = min(max(event.priority, 0), len(self.lanes) - 1)
+        events = self.lanes[lane]
+        events.append(event)
+        self.count += 1
+        self.enqueued[lane] += 1
+        if len(events) > self.max_depths[lane]:
+            self.max_depths[lane] = len(events)
+    
+    def popleft(self):
+        lanes = self.lanes
+        for lane, events in enumerate(lanes):
+            if events:
+                break
+        else:
+            raise IndexError('pop from an empty inbox')
+        credits = self.credits
+        if credits is not None:
+            if not credits[lane]:
+                for lower in range(lane + 1, len(lanes)):
+                    if lanes[lower] and credits[lower]:
+                        lane = lower
+                        break
+                else:
+                    # Every waiting lane had its burst, start a new round.
+                    credits[:] = self.bursts
+            credits[lane] -= 1
+        self.count -= 1
+        return lanes[lane].popleft()
+    
+    def clear(self):
+        for events in self.lanes:
+            events.clear()
+        self.count = 0
+        if self.credits is not None:
+            self.credits[:] = self.bursts
+    
+    def get_depths(self):
+        return [len(events) for events in self.lanes]
+    
+    def as_dict(self):
+        return {'depths': self.get_depths(),
+                'max_depths': list(self.max_depths),
+                'enqueued': list(self.enqueued)}
+    
+    def __len__(self):
+        return self.count
+    
+    def __repr__(self):
+        return self.as_dict().__repr__()
+
+
+class EventQueue(object):
+    '''Run to completion for FSM and HSM.
+
+    Events sent to a machine while it runs a macrostep, from its guards,
+    effects and activities, wait in its Inbox until the macrostep completes
+    and then run by priority, FIFO within a priority. enqueue() adds to the
+    inbox from outside and run_queued() runs it. With internal_first, events
+    a machine sends itself with self_post() go before everything else.
+    Other threads hand events over with post_threadsafe(); the machine takes
+    them into the inbox at its next macrostep or run_queued(). A stop()
+    during a macrostep waits for it to complete and goes before the queued
+    events.'''
+    
+    internal_first = False
+    # Inbox configuration, see configure_inbox().
+    inbox_lanes = 3
+    inbox_bursts = None
+    
+    _busy = False
+    _stop_pending = False
+    # Errors of waited for independent activities, see wait_for_all().
+    _activity_errors = None
+    # Allocated together on first use.
+    _internal_events = None
+    _inbox = None
+    # Allocated on the first post_threadsafe().
+    _external_events = None
+    
+    def configure_inbox(self, lanes = 3, bursts = None):
+        assert(not self.get_queued_count())
+        self.inbox_lanes = lanes
+        self.inbox_bursts = bursts
+        self._inbox = None
+    
+    def get_inbox(self):
+        if self._inbox is None:
+            self._add_lanes()
+        return self._inbox
+    
+    def self_post(self, event):
+        '''Queue event to run after the current macrostep.'''
+        if not self._busy:
+            return self.post(event)
+        if self._inbox is None:
+            self._add_lanes()
+        if self.internal_first:
+            self._internal_events.append(event)
+        else:
+            self._inbox.append(event)
+        return self.current
+    
+    def enqueue(self, event):
+        '''Add event to the inbox. It runs with run_queued() or after the
+        next macrostep.'''
+        self._enqueue(event)
+    
+    def post_threadsafe(self, event):
+        '''Hand event over from any thread, for the next macrostep or
+        run_queued().'''
+        events = self._external_events
+        if events is None:
+            # setdefault keeps one deque when threads race here.
+            events = self.__dict__.setdefault('_external_events',
+                                              collections.deque())
+        events.append(event)
+    
+    def run_queued(self):
+        '''run_queued() -> current state once the inbox is empty'''
+        self._take_external()
+        if not self._busy and self.get_queued_count():
+            self._macrostep(self._post, self._next_queued())
+        return self.current
+    
+    def get_queued_count(self):
+        external = len(self._external_events or ())
+        if self._inbox is None:
+            return external
+        return len(self._internal_events) + len(self._inbox) + external
+    
+    def clear_queue(self):
+        self._stop_pending = False
+        if self._external_events is not None:
+            self._external_events.clear()
+        if self._inbox is not None:
+            self._internal_events.clear()
+            self._inbox.clear()
+    
+    def _add_lanes(self):
+        self._internal_events = collections.deque()
+        self._inbox = Inbox(self.inbox_lanes, self.inbox_bursts)
+    
+    def _macrostep(self, step, event):
+        '''step(event) and the queued events after it, or queue event if busy
+
+        post(), stimulate() and dispatch() have this inlined.'''
+        if self._busy:
+            self._enqueue(event)
+            return None
+        self._busy = True
+        try:
+            result = step(event)
+            if self._inbox is not None or self._external_events:
+                self._drain()
+        finally:
+            self._busy = False
+        return result
+    
+    def _enqueue(self, event):
+        if self._inbox is None:
+            self._add_lanes()
+        self._inbox.append(event)
+    
+    def _request_stop(self):
+        # stop() while busy, run by _drain() once the macrostep completes.
+        if self._inbox is None:
+            self._add_lanes()
+        self._stop_pending = True
+    
+    def _next_queued(self):
+        return (self._internal_events or self._inbox).popleft()
+    
+    def _defer_errors(self, errors):
+        if self._activity_errors is None:
+            self._activity_errors = []
+        self._activity_errors.extend(errors)
+        # _drain() raises them at the end of the macrostep.
+        if self._inbox is None:
+            self._add_lanes()
+    
+    def _take_external(self):
+        external = self._external_events
+        if external:
+            while external:
+                self._enqueue(external.popleft())
+    
+    def _drain(self):
+        self._take_external()
+        internal = self._internal_events
+        inbox = self._inbox
+        while True:
+            if self._stop_pending:
+                self._stop_pending = False
+                self._stop(None)
+            elif internal or inbox:
+                self._post((internal or inbox).popleft())
+            elif self._external_events:
+                # Handed over while draining.
+                self._take_external()
+            else:
+                break
+        errors = self._activity_errors
+        if errors is not None:
+            self._activity_errors = None
+            raise ActivityErrors(errors)
+    
+    def _drop_queue(self):
+        # A clone starts with no queue of its own.
+        for name in ('_busy', '_stop_pending', '_activity_errors',
+                     '_internal_events', '_inbox', '_external_events'):
+            self.__dict__.pop(name, None)
+
+
+# Components of memory_report().
+MEMORY_COMPONENTS = ('machine', 'states', 'handler_dicts', 'handler_lists',
+                     'handlers', 'events', 'final_transitions')
+
+
+class MemorySizer(object):
+    '''Adds up sys.getsizeof of the objects of a machine by component.
+
+    Each object counts once, in the component it is first reached from, with
+    its __dict__. Guards, effects, actions, event classes and the context
+    are not counted. States shared with clones count in every clone.
+    final_transitions are ExitEvent transitions to a final state, as
+    FinalState.add_final_transition_to_other() adds; events are the queued
+    ones with the queue.'''
+    
+    def __init__(self):
+        object.__init__(self)
+        # id: object, holding on to the objects so that no id is reused, an
+        # instance __dict__ can be made on access and dropped after.
+        self.seen = {}
+        self.sizes = dict.fromkeys(MEMORY_COMPONENTS, 0)
+    
+    def add(self, component, obj):
+        if id(obj) in self.seen:
+            return
+        self.seen[id(obj)] = obj
+        size = sys.getsizeof(obj)
+        attributes = getattr(obj, '__dict__', None)
+        if attributes is not None and id(attributes) not in self.seen:
+            self.seen[id(attributes)] = attributes
+            size += sys.getsizeof(attributes)
+        self.sizes[component] += size
+    
+    def add_all(self, component, objs):
+        for obj in objs:
+            self.add(component, obj)
+    
+    def add_machine(self, machine, component = 'machine'):
+        self.add(component, machine)
+        index = getattr(machine, 'index', None)
+        if index is not None:
+            self.add_all(component, (index, index.states, index.ids, index.names))
+        self.add_handler_list(machine.state_change_activities)
+        if machine._inbox is not None:
+            inbox = machine._inbox
+            self.add_all('events', [machine._internal_events, inbox, inbox.lanes,
+                                    inbox.enqueued, inbox.max_depths] + inbox.lanes)
+            self.add_all('events', machine._internal_events)
+            for events in inbox.lanes:
+                self.add_all('events', events)
+        if machine._external_events is not None:
+            self.add('events', machine._external_events)
+            self.add_all('events', machine._external_events)
+    
+    def add_state(self, state):
+        self.add('states', state)
+        self.add('states', state.name)
+        for handlers in (state.activities, state.transitions):
+            if handlers is None:
+                continue
+            self.add_all('handler_dicts', (handlers, handlers.list_dict))
+            for event_cls, handler_list in handlers.list_dict.items():
+                if event_cls is State.ExitEvent and all(
+                        isinstance(getattr(handler, 'target', None), FSM.FinalState)
+                        for handler in handler_list):
+                    self.add_handler_list(handler_list, 'final_transitions')
+                else:
+                    self.add_handler_list(handler_list)
+        if isinstance(state, FSM):
+            self.add_machine(state, 'states')
+    
+    def add_handler_list(self, handler_list, component = None):
+        self.add(component or 'handler_lists', handler_list)
+        self.add(component or 'handler_lists', handler_list.handlers)
+        self.add_all(component or 'handlers', handler_list.handlers)
+    
+    def get_report(self):
+        '''get_report() -> {component: bytes, 'total': bytes}'''
+        report = dict(self.sizes)
+        report['total'] = sum(self.sizes.values())
+        return report
+
+
+class FSM(EventQueue):
     
     class InitialState(State):
 
         def set_initial_transition(self, other):
             transition = Transition(target=other)
-            self.transitions.clear(State.UnnamedEvent)
-            self.transitions.add_transition(State.UnnamedEvent, transition)
+            self.clear_transitions(State.UnnamedEvent)
+            self.add_transition(State.UnnamedEvent, transition)
     
     class FinalState(State):
 
@@ -400,9 +1275,25 @@ class FSM(object):
                 to_final = Transition(self)
                 other.add_transition(State.ExitEvent, to_final)
     
-    def __init__(self, states =[], initial = InitialState(), final = FinalState()):
+    # Ids returned by get_state_id() for the pseudo states.
+    INITIAL_ID = -1
+    FINAL_ID = -2
+    
+    # Set by tracing.TransitionTracer.attach().
+    tracer = None
+    
+    # True while the states are shared with a clone, see clone().
+    _shared = False
+    
+    def __init__(self, states =[], initial = None, final = None):
         object.__init__(self)
         self.state_change_activities = ActivityList()
+        # Pseudo states are per machine. Default argument instances would be
+        # shared, and so would their initial transition and activities.
+        if initial is None:
+            initial = FSM.InitialState()
+        if final is None:
+            final = FSM.FinalState()
         self.initial = initial
         self.final = final
         if len(states) > 0 and states[0] != None:
@@ -412,8 +1303,12 @@ class FSM(object):
         else:
             set_inital_state = False
         
-        self.states = StateList(states)
+        self.index = StateIndex()
+        self.states = self.index.states
+        self.add_states(states)
         self.current = self.initial
+        # User data kept with the runtime configuration in snapshots.
+        self.context = None
         if set_inital_state:
             self.set_initial_state(states[0])
         else:
@@ -421,61 +1316,287 @@ class FSM(object):
     
     def start(self):
         assert(self.current == self.initial or self.current == self.final)
+        self._hold_states(-1)
         self.current = self.initial
         return self.stimulate(State.EnterEvent)
 
     def stop(self):
-        if self.current != self.final:
-            self.final.add_final_transition_to_other(other=self.current)
-            return self.stimulate(State.ExitEvent)
+        '''stop() -> response, None when called during a macrostep
+
+        Called from a guard, effect or activity, the machine stops once the
+        running macrostep completes.'''
+        if self._busy:
+            return self._request_stop()
+        return self._macrostep(self._stop, None)
+    
+    def _stop(self, event):
+        if self.current == self.final:
+            return NO_RESPONSE
+        tracer = self.tracer
+        if tracer is not None and tracer.countdown <= 1:
+            response, send_unnamed = self._traced_step(
+                                        self._exit_current_to_final, State.ExitEvent)
         else:
-            return StimulusResponse(False, False, None)
+            response, send_unnamed = self._complete_transition(
+                                        self._exit_current_to_final(State.ExitEvent, self))
+            if tracer is not None:
+                tracer.countdown -= 1
+        return self._follow_unnamed_transitions(State.ExitEvent, response,
+                                                send_unnamed)
+    
+    def _exit_current_to_final(self, event, machine):
+        # Behaves as if the current state had one more, last, ExitEvent
+        # transition to the final state, without adding it to the state.
+        # Takes the arguments of State.stimulate() to stand in for it.
+        response = State.stimulate(self.current, event, machine)
+        if response.was_transition_requested():
+            return response
+        return StimulusResponse(response.did_act(), True, self.final)
+    
+    def reset(self):
+        '''Return to the initial configuration without running activities.'''
+        self.clear_queue()
+        self._hold_states(-1)
+        self.current = self.initial
+    
+    def _hold_states(self, count):
+        # Adds count, 1 or -1, to the active count of the states this machine
+        # is in, for machines entering or leaving them without exit() and
+        # enter(): clones, copies and resets.
+        state = self.current
+        if state is not self.initial:
+            state._active = max(0, state._active + count)
+    
+    def clone(self):
+        '''clone() -> new machine in the same configuration, sharing the states
+
+        Copies the current state and, deeply, the context. States and handlers
+        stay shared until either machine changes them through its own add_*
+        or set_initial_state methods, which first gives that machine copies.
+        Handlers added to a shared State directly reach every clone, and
+        State.is_active() is True while any clone is in the state; use
+        is_state_active(state) of the machine for one clone. MachineActivity and
+        MachineTransition handlers are given the clone that runs them.'''
+        machine = object.__new__(self.__class__)
+        machine.__dict__.update(self.__dict__)
+        machine.__dict__.pop('tracer', None)
+        machine.__dict__.pop('trace_id', None)
+        machine._drop_queue()
+        machine.state_change_activities = self.state_change_activities.copy()
+        machine.context = copy.deepcopy(self.context)
+        machine._hold_states(1)
+        self._shared = machine._shared = True
+        return machine
+    
+    def _unshare(self):
+        self._hold_states(-1)
+        copies = copy_states(list(self.index) + [self.initial, self.final])
+        FSM._relink(self, copies)
+        self._hold_states(1)
+        self._shared = False
+        return copies
+    
+    def _relink(self, states):
+        self.index = StateIndex([states.get(state, state) for state in self.index])
+        self.states = self.index.states
+        self.initial = states.get(self.initial, self.initial)
+        self.final = states.get(self.final, self.final)
+        self.current = states.get(self.current, self.current)
+        self.state_change_activities = self.state_change_activities.copy()
+    
+    def memory_report(self):
+        '''memory_report() -> {component: bytes, 'total': bytes}, see MemorySizer'''
+        sizer = MemorySizer()
+        sizer.add_machine(self)
+        for state in [self.initial, self.final] + list(self.index):
+            sizer.add_state(state)
+        return sizer.get_report()
+    
+    def is_state_active(self, state):
+        '''is_state_active(state) -> True if state is the current state of this machine'''
+        return state is self.current and state is not self.initial
+    
+    def get_snapshot(self):
+        '''get_snapshot() -> (current state id, context)'''
+        return (self.get_state_id(self.current), self.context)
+    
+    def restore_snapshot(self, snapshot):
+        '''Restore a get_snapshot() result without running activities.'''
+        state_id, context = snapshot
+        self._hold_states(-1)
+        self.current = self.get_state(state_id)
+        self._hold_states(1)
+        self.context = context
     
     def add_start_activity(self, activity):
+        if self._shared:
+            self._unshare()
         self.initial.add_enter_activity(activity)
     
     def add_stop_activity(self, activity):
+        if self._shared:
+            self._unshare()
         self.final.add_enter_activity(activity)
     
     def add_on_transition_completed_activity(self, activity):
         self.state_change_activities.add_activity(activity)
     
+    def add_state(self, state):
+        '''add_state(state) -> state id'''
+        if self._shared:
+            self._unshare()
+        return self.index.add_state(state)
+    
+    def add_states(self, states):
+        for state in states:
+            self.add_state(state)
+    
+    def get_state_id(self, state):
+        if state is self.initial:
+            return FSM.INITIAL_ID
+        if state is self.final:
+            return FSM.FINAL_ID
+        return self.index.get_id(state)
+    
+    def get_state(self, state_id):
+        if state_id == FSM.INITIAL_ID:
+            return self.initial
+        if state_id == FSM.FINAL_ID:
+            return self.final
+        return self.index.get_state(state_id)
+    
+    def get_state_by_name(self, name):
+        return self.index.find(name)
+    
     def set_initial_state(self, state):
+        if self._shared:
+            state = self._unshare().get(state, state)
         assert(state in self or state == self.final)
         self.initial.set_initial_transition(state)
     
     def stimulate(self, event):
+        '''stimulate(event) -> response, NO_RESPONSE if queued'''
+        if self._busy:
+            self._enqueue(event)
+            return NO_RESPONSE
+        self._busy = True
+        try:
+            response = self._stimulate(event)
+            if self._inbox is not None or self._external_events:
+                self._drain()
+        finally:
+            self._busy = False
+        return response
+    
+    def _stimulate(self, event):
+        response, send_unnamed = self._dipatch_to_current(event)
+        return self._follow_unnamed_transitions(event, response, send_unnamed)
+    
+    def post(self, event):
+        '''post(event) -> current state afterwards
+
+        Same as stimulate() without building responses, for callers that
+        ignore them.'''
+        if self._busy:
+            self._enqueue(event)
+            return self.current
+        self._busy = True
+        try:
+            self._post(event)
+            if self._inbox is not None or self._external_events:
+                self._drain()
+        finally:
+            self._busy = False
+        return self.current
+    
+    def _post(self, event):
+        if self.tracer is not None:
+            if (self._traced_fire(event)
+                or Event.is_same_type(event, State.EnterEvent)):
+                while self._traced_fire(State.UnnamedEvent):
+                    pass
+        elif self._fire(event) or Event.is_same_type(event, State.EnterEvent):
+            while self._fire(State.UnnamedEvent):
+                pass
+    
+    def _traced_fire(self, event):
+        tracer = self.tracer
+        if tracer.countdown > 1:
+            # Not sampled, only count the transition.
+            if not self._fire(event):
+                return False
+            tracer.countdown -= 1
+            return True
+        source = self.current
+        started = tracer.clock()
+        target = source.fire(event, self)
+        if target is None or target is NOT_FIRED:
+            return False
+        reacted = tracer.clock()
+        source.exit(self)
+        self.current = target
+        target.enter(self)
+        self.state_change_activities.fire(Event, self)
+        tracer.record(self, source, event, target, started, reacted)
+        return True
+    
+    def _fire(self, event):
+        target = self.current.fire(event, self)
+        if target is None or target is NOT_FIRED:
+            return False
+        self.current.exit(self)
+        self.current = target
+        target.enter(self)
+        self.state_change_activities.fire(Event, self)
+        return True
+    
+    def _follow_unnamed_transitions(self, event, response, send_unnamed):
         while True:
-            response, send_unnamed = self._dipatch_to_current(event)
-            
-            if send_unnamed or event == State.EnterEvent:
+            if send_unnamed or Event.is_same_type(event, State.EnterEvent):
                 event = State.UnnamedEvent
             elif not response.was_transition_requested():
                 break
+            response, send_unnamed = self._dipatch_to_current(event)
         return response
 
     def _dipatch_to_current(self, event):
+        tracer = self.tracer
+        if tracer is not None and tracer.countdown <= 1:
+            return self._traced_step(self.current.stimulate, event)
+        result = self._complete_transition(self.current.stimulate(event, self))
+        if tracer is not None and result[1]:
+            # Not sampled, only count the transition.
+            tracer.countdown -= 1
+        return result
+    
+    def _traced_step(self, react, event):
+        '''_traced_step(react, event) -> (response, send_unnamed)
 
-        response = self.current.stimulate(event)
-        
-        exit = StimulusResponse(False, False, None)
-        enter = StimulusResponse(False, False, None)
-        unnamed_event_needed = False
-        if    response.was_transition_requested():
-            exit = self.current.exit()
-            self.current = response.get_target()
-            enter = self.current.enter()
-            self.state_change_activities.stimulate(Event)
-            unnamed_event_needed = True
-        
-        agregated_response = StimulusResponse(   response.did_act() or exit.did_act()
-                                              or enter.did_act(),
-                                              response.was_transition_requested(),
-                                              response.get_target())
-        return (agregated_response, unnamed_event_needed)
+        react(event, self) timed, and its transition recorded if it takes one.'''
+        tracer = self.tracer
+        source = self.current
+        started = tracer.clock()
+        response = react(event, self)
+        reacted = tracer.clock()
+        result = self._complete_transition(response)
+        if result[1]:
+            tracer.record(self, source, event, self.current, started, reacted)
+        return result
+    
+    def _complete_transition(self, response):
+        if not response.was_transition_requested():
+            if not response[1]:
+                return (response, False)
+            return (StimulusResponse(response.did_act(), False,
+                                     response.get_target()), False)
+        flags = response.get_flags() | self.current.exit(self).get_flags()
+        self.current = response.get_target()
+        flags |= self.current.enter(self).get_flags()
+        self.state_change_activities.stimulate(Event, self)
+        return (StimulusResponse.from_flags(flags, self.current), True)
     
     def __contains__(self, state):
-        return state in self.states
+        return state in self.index
 
     def name(self):
         return self.__class__.__name__
@@ -0,0 +1,453 @@
+'''
+Differential fuzzing of the dispatch engines
+
+Generates seeded random machines and event streams, runs each through the
+reference engine and an alternative backend, and compares what happened:
+the guard, effect and activity calls in order, the state after every
+event, and the state after stop(). A failing case is shrunk to a small
+reproducer.
+
+    python fuzz.py --seed 1 --runs 500
+    python fuzz.py --backend flat --runs 100
+
+The reference is fsm.FSM.stimulate for flat cases and hsm.HSM.dispatch for
+hierarchical ones. A case is a dict of plain lists:
+
+    parents      parent index of each state, -1 at the top; parents come
+                 before their children and a state with children is an
+                 hsm.CompositeState (hierarchical cases only)
+    transitions  [source, event, target, guard]; event None is an unnamed
+                 transition, target -1 the final state of the source's
+                 container and -2 none, guard None is always true
+    activities   [state, event, guard]; event 'enter', 'exit' or an index
+    events       event type indexes sent after start()
+
+Guards give deterministic pseudo random outcomes, from their seed and the
+number of times they have been called. Unnamed transitions only go to
+states further down the list, so completion chains always end.
+'''
+from __future__ import print_function
+import argparse
+import random
+import fsm
+import flatfsm
+import hsm
+
+NUM_EVENT_TYPES = 4
+
+EVENT_TYPES = [type('E%d' % i, (fsm.Event,), {}) for i in range(NUM_EVENT_TYPES)]
+
+FINAL = -1
+INTERNAL = -2
+TOP = -1
+
+
+def generate_case(rng, hierarchical = False, max_states = 6, max_events = 30):
+    num_states = rng.randint(1, max_states)
+    parents = []
+    for i in range(num_states):
+        if hierarchical and i > 0 and rng.random() < 0.6:
+            parents.append(rng.randint(-1, i - 1))
+        else:
+            parents.append(TOP)
+    transitions = []
+    for source in range(num_states):
+        for j in range(rng.randint(0, 3)):
+            guard = rng.randint(0, 99) if rng.random() < 0.5 else None
+            if rng.random() < 0.25:
+                # Unnamed, forward only.
+                if source + 1 < num_states and rng.random() < 0.8:
+                    target = rng.randint(source + 1, num_states - 1)
+                else:
+                    target = FINAL
+                transitions.append([source, None, target, guard])
+            else:
+                choice = rng.random()
+                if choice < 0.8:
+                    target = rng.randint(0, num_states - 1)
+                else:
+                    target = FINAL if choice < 0.9 else INTERNAL
+                transitions.append([source, rng.randint(0, NUM_EVENT_TYPES - 1),
+                                    target, guard])
+    activities = []
+    for state in range(num_states):
+        for j in range(rng.randint(0, 2)):
+            event = rng.choice(['enter', 'exit', rng.randint(0, NUM_EVENT_TYPES - 1)])
+            guard = rng.randint(0, 99) if rng.random() < 0.3 else None
+            activities.append([state, event, guard])
+    events = [rng.randint(0, NUM_EVENT_TYPES - 1)
+              for i in range(rng.randint(1, max_events))]
+    return {'hierarchical': hierarchical,
+            'parents': parents,
+            'transitions': transitions,
+            'activities': activities,
+            'events': events}
+
+def _make_guard(seed, tag, log):
+    calls = [0]
+    def guard(event):
+        calls[0] += 1
+        outcome = ((seed + 1) * 2654435761 + calls[0] * 40503) % 7 < 4
+        log.append((tag, outcome))
+        return outcome
+    return guard
+
+def _make_action(tag, log):
+    def action(event):
+        log.append(tag)
+    return action
+
+
+class Driver(object):
+    '''One engine running one case, logging into log.'''
+
+    def __init__(self, machine, send, state_name, log):
+        object.__init__(self)
+        self.machine = machine
+        self.send = send
+        self.state_name = state_name
+        self.log = log
+
+
+def _handlers(case, log):
+    '''Yields (kind, index, guard, function) for every handler of case.'''
+    for i, (source, event, target, guard) in enumerate(case['transitions']):
+        yield ('t', i, None if guard is None else _make_guard(guard, 'g%d' % i, log),
+               _make_action('t%d' % i, log))
+    for i, (state, event, guard) in enumerate(case['activities']):
+        yield ('a', i, None if guard is None else _make_guard(guard, 'h%d' % i, log),
+               _make_action('a%d' % i, log))
+
+def build_fsm(case, log):
+    states = [fsm.State('S%d' % i) for i in range(len(case['parents']))]
+    sm = fsm.FSM(states)
+    for kind, i, guard, function in _handlers(case, log):
+        guard = guard or fsm.get_true
+        if kind == 't':
+            source, event, target, _ = case['transitions'][i]
+            target = _target(target, sm.final, states)
+            event = fsm.State.UnnamedEvent if event is None else EVENT_TYPES[event]
+            states[source].add_transition(event, fsm.TransitionWithGuardAndEffect(
+                                                    guard, target, function))
+        else:
+            state, event, _ = case['activities'][i]
+            states[state].add_activity(_activity_event(event),
+                                       fsm.ActivityWithGuard(guard, function))
+    return sm
+
+def _target(target, final, states):
+    if target == INTERNAL:
+        return None
+    return final if target == FINAL else states[target]
+
+def _activity_event(event):
+    if event == 'enter':
+        return fsm.State.EnterEvent
+    if event == 'exit':
+        return fsm.State.ExitEvent
+    return EVENT_TYPES[event]
+
+def _fsm_state_name(sm):
+    if sm.current is sm.initial:
+        return 'initial'
+    if sm.current is sm.final:
+        return 'final'
+    return sm.current.get_name()
+
+def _fsm_driver(sm, send, log):
+    driver = Driver(sm, send, lambda: _fsm_state_name(sm), log)
+    sm.add_on_transition_completed_activity(
+            fsm.Activity(lambda event: log.append(('changed', driver.state_name()))))
+    return driver
+
+def fsm_reference(case, log):
+    sm = build_fsm(case, log)
+    return _fsm_driver(sm, sm.stimulate, log)
+
+def fsm_post(case, log):
+    sm = build_fsm(case, log)
+    return _fsm_driver(sm, sm.post, log)
+
+def fsm_clone(case, log):
+    sm = build_fsm(case, log).clone()
+    return _fsm_driver(sm, sm.stimulate, log)
+
+def flat(case, log):
+    builder = flatfsm.FlatFSMBuilder()
+    states = [builder.add_state('S%d' % i) for i in range(len(case['parents']))]
+    if states:
+        builder.set_initial_state(states[0])
+    for kind, i, guard, function in _handlers(case, log):
+        if kind == 't':
+            source, event, target, _ = case['transitions'][i]
+            target = _target(target, flatfsm.FINAL, states)
+            event = flatfsm.UNNAMED if event is None else EVENT_TYPES[event]
+            builder.add_transition(states[source], event, target, guard, function)
+        else:
+            state, event, _ = case['activities'][i]
+            builder.add_activity(states[state], _activity_event(event), function, guard)
+    built = []
+
+    def state_name():
+        sm = built[0]
+        if sm.current == flatfsm.INITIAL:
+            return 'initial'
+        if sm.current == flatfsm.FINAL:
+            return 'final'
+        return sm.get_state_name(sm.current)
+
+    builder.add_on_transition_completed_activity(
+            lambda event: log.append(('changed', state_name())))
+    built.append(builder.build())
+    return Driver(built[0], built[0].stimulate, state_name, log)
+
+def build_hsm(case, log):
+    parents = case['parents']
+    has_children = set(parent for parent in parents if parent != TOP)
+    states = []
+    sm = hsm.HSM()
+    for i, parent in enumerate(parents):
+        if i in has_children:
+            state = hsm.CompositeState(name='S%d' % i)
+        else:
+            state = hsm.SimpleState('S%d' % i)
+        container = sm.top if parent == TOP else states[parent]
+        container.add_state(state)
+        states.append(state)
+    # The first child is the initial one.
+    for container in [sm.top] + [states[i] for i in sorted(has_children)]:
+        if len(container.states):
+            container.set_initial_state(container.states[0])
+    for kind, i, guard, function in _handlers(case, log):
+        guard = guard or fsm.get_true
+        if kind == 't':
+            source, event, target, _ = case['transitions'][i]
+            source = states[source]
+            target = _target(target, source.parent.final, states)
+            event = fsm.State.UnnamedEvent if event is None else EVENT_TYPES[event]
+            source.add_transition(event, fsm.TransitionWithGuardAndEffect(
+                                                guard, target, function))
+        else:
+            state, event, _ = case['activities'][i]
+            states[state].add_activity(_activity_event(event),
+                                       fsm.ActivityWithGuard(guard, function))
+    return sm
+
+def _hsm_state_name(sm):
+    names = []
+    for state in sm.current.get_parent_stack()[1:]:
+        if isinstance(state, hsm.CompositeState.InitialState):
+            names.append('initial')
+        elif isinstance(state, hsm.CompositeState.FinalState):
+            names.append('final')
+        else:
+            names.append(state.get_name())
+    return '/'.join(names)
+
+def _hsm_driver(sm, send, log):
+    driver = Driver(sm, send, lambda: _hsm_state_name(sm), log)
+    sm.add_on_transition_completed_activity(
+            fsm.Activity(lambda event: log.append(('changed', driver.state_name()))))
+    return driver
+
+def hsm_reference(case, log):
+    sm = build_hsm(case, log)
+    return _hsm_driver(sm, sm.dispatch, log)
+
+def hsm_post(case, log):
+    sm = build_hsm(case, log)
+    return _hsm_driver(sm, sm.post, log)
+
+def hsm_clone(case, log):
+    sm = build_hsm(case, log).clone()
+    return _hsm_driver(sm, sm.dispatch, log)
+
+# name: (runs hierarchical cases, backend)
+BACKENDS = {'post': (False, fsm_post),
+            'clone': (False, fsm_clone),
+            'flat': (False, flat),
+            'hsm': (False, hsm_reference),
+            'hsm_post': (True, hsm_post),
+            'hsm_clone': (True, hsm_clone)}
+
+
+def run_case(case, engine):
+    '''run_case(case, engine) -> trace, the log with the state after each step'''
+    log = []
+    try:
+        driver = engine(case, log)
+        driver.machine.start()
+        log.append(('state', driver.state_name()))
+        for event in case['events']:
+            driver.send(EVENT_TYPES[event]())
+            log.append(('state', driver.state_name()))
+        driver.machine.stop()
+        log.append(('state', driver.state_name()))
+    except Exception as error:
+        log.append(('error', error.__class__.__name__, str(error)))
+    return log
+
+def get_reference(case):
+    return hsm_reference if case['hierarchical'] else fsm_reference
+
+def check_case(case, engine):
+    '''check_case(case, engine) -> None, or the first difference'''
+    expected = run_case(case, get_reference(case))
+    actual = run_case(case, engine)
+    if expected == actual:
+        return None
+    for i, (want, got) in enumerate(zip(expected, actual)):
+        if want != got:
+            return 'step %d: reference %r, backend %r' % (i, want, got)
+    return 'reference has %d steps, backend %d' % (len(expected), len(actual))
+
+
+def _without(items, first, count):
+    return items[:first] + items[first + count:]
+
+def _shrink_list(case, key, fails):
+    items = case[key]
+    chunk = len(items) // 2
+    while chunk >= 1:
+        first = 0
+        while first < len(items):
+            candidate = dict(case)
+            candidate[key] = _without(items, first, chunk)
+            if fails(candidate):
+                case, items = candidate, candidate[key]
+            else:
+                first += chunk
+        chunk //= 2
+    return case
+
+def remove_state(case, state):
+    '''remove_state(case, state) -> case without the leaf state, or None'''
+    parents = case['parents']
+    if len(parents) == 1 or state in parents:
+        return None
+    def index(i):
+        return i - 1 if i > state else i
+    candidate = dict(case)
+    candidate['parents'] = [index(parent)
+                            for i, parent in enumerate(parents) if i != state]
+    candidate['transitions'] = [[index(source), event,
+                                 target if target < 0 else index(target), guard]
+                                for source, event, target, guard in case['transitions']
+                                if source != state and target != state]
+    candidate['activities'] = [[index(owner), event, guard]
+                               for owner, event, guard in case['activities']
+                               if owner != state]
+    return candidate
+
+def _drop_guards(case, fails):
+    for key, position in (('transitions', 3), ('activities', 2)):
+        for i, handler in enumerate(case[key]):
+            if handler[position] is None:
+                continue
+            candidate = dict(case)
+            candidate[key] = [list(h) for h in case[key]]
+            candidate[key][i][position] = None
+            if fails(candidate):
+                case = candidate
+    return case
+
+def shrink(case, engine):
+    '''shrink(case, engine) -> smaller case still failing check_case()'''
+    fails = lambda candidate: check_case(candidate, engine) is not None
+    assert(fails(case))
+    while True:
+        size = case_size(case)
+        for key in ('events', 'transitions', 'activities'):
+            case = _shrink_list(case, key, fails)
+        for state in reversed(range(len(case['parents']))):
+            candidate = remove_state(case, state)
+            if candidate is not None and fails(candidate):
+                case = candidate
+        case = _drop_guards(case, fails)
+        if case_size(case) == size:
+            return case
+
+def case_size(case):
+    guards = sum(1 for handler in case['transitions'] if handler[3] is not None)
+    guards += sum(1 for handler in case['activities'] if handler[2] is not None)
+    return (len(case['parents']) + len(case['transitions'])
+            + len(case['activities']) + len(case['events']) + guards)
+
+def format_case(case):
+    lines = ['hierarchical: %r' % case['hierarchical']]
+    for i, parent in enumerate(case['parents']):
+        lines.append('S%d%s' % (i, '' if parent == TOP else ' in S%d' % parent))
+    for i, (source, event, target, guard) in enumerate(case['transitions']):
+        lines.append('t%d: S%d --%s%s--> %s'
+                     % (i, source, 'unnamed' if event is None else 'E%d' % event,
+                        '' if guard is None else ' [g%d seed %d]' % (i, guard),
+                        _format_target(target)))
+    for i, (state, event, guard) in enumerate(case['activities']):
+        lines.append('a%d: S%d on %s%s'
+                     % (i, state, event if event in ('enter', 'exit') else 'E%d' % event,
+                        '' if guard is None else ' [h%d seed %d]' % (i, guard)))
+    lines.append('events: ' + ' '.join('E%d' % event for event in case['events']))
+    return '\n'.join(lines)
+
+
+def _format_target(target):
+    if target == INTERNAL:
+        return 'internal'
+    return 'final' if target == FINAL else 'S%d' % target
+
+
+class Failure(object):
+
+    def __init__(self, seed, backend, case, message):
+        object.__init__(self)
+        self.seed = seed
+        self.backend = backend
+        self.case = case
+        self.message = message
+
+    def format(self):
+        return 'seed %d, backend %s: %s\n%s' % (self.seed, self.backend,
+                                              self.message, format_case(self.case))
+
+
+def fuzz(seed = 0, runs = 100, backends = None, max_states = 6, max_events = 30):
+    '''fuzz(seed, runs, backends) -> list of shrunk Failures'''
+    if backends is None:
+        backends = sorted(BACKENDS)
+    failures = []
+    for i in range(runs):
+        case_seed = seed * 1000003 + i
+        for hierarchical in (False, True):
+            case = generate_case(random.Random(case_seed), hierarchical,
+                                 max_states, max_events)
+            for name in backends:
+                runs_hierarchical, engine = BACKENDS[name]
+                if runs_hierarchical != hierarchical:
+                    continue
+                if check_case(case, engine) is not None:
+                    small = shrink(case, engine)
+                    failures.append(Failure(case_seed, name, small,
+                                            check_case(small, engine)))
+    return failures
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                        help='default: all')
+    parser.add_argument('--max-states', type=int, default=6)
+    parser.add_argument('--max-events', type=int, default=30)
+    args = parser.parse_args(argv)
+    failures = fuzz(args.seed, args.runs, args.backend, args.max_states,
+                    args.max_events)
+    for failure in failures:
+        print(failure.format())
+        print()
+    print('%d runs, %d failures' % (args.runs, len(failures)))
+    return failures
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 '''
 Hierarchical State Machine
 '''
+import copy
 import fsm
 
 class Event(fsm.Event):
@@ -18,12 +19,24 @@ class TransitionWithEffect(fsm.TransitionWithEffect):
 class Transition(fsm.Transition):
     pass
 
+class MachineTransition(fsm.MachineTransition):
+    pass
+
+class TransitionWithAsyncEffect(fsm.TransitionWithAsyncEffect):
+    pass
+
 class ActivityWithGuard(fsm.ActivityWithGuard):
     pass
 
 class Activity(fsm.Activity):
     pass
 
+class MachineActivity(fsm.MachineActivity):
+    pass
+
+class IndependentActivity(fsm.IndependentActivity):
+    pass
+
 
 class OldTransition(fsm.Transition):
 
@@ -78,6 +91,13 @@ class StimulusResponse(fsm.StimulusResponse):
     pass
 
 class StimulusResponseDict(dict):
+    '''Responses by state, with the or of their flags kept up to date.
+
+    Adding a response ors in its flags, replacing or removing one
+    recomputes them from all the responses. Every mutating dict method goes
+    through __setitem__ or recomputes.'''
+    
+    flags = 0
     
     def __init__(self, init_dict):
         dict.__init__(self)
@@ -88,49 +108,123 @@ class StimulusResponseDict(dict):
     def __setitem__(self, key, value):
         assert(isinstance(key, (SimpleState)))
         assert(isinstance(value, (fsm.StimulusResponse)))
+        replaced = key in self
         dict.__setitem__(self, key, value)
+        if replaced:
+            self._update_flags()
+        else:
+            self.flags |= value.get_flags()
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._update_flags()
+    
+    def pop(self, key, *default):
+        value = dict.pop(self, key, *default)
+        self._update_flags()
+        return value
+    
+    def popitem(self):
+        item = dict.popitem(self)
+        self._update_flags()
+        return item
+    
+    def clear(self):
+        dict.clear(self)
+        self.flags = 0
+    
+    def setdefault(self, key, default = None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+    
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+    
+    def __ior__(self, other):
+        self.update(other)
+        return self
     
     def add_response_dict(self, res_dict):
         assert(isinstance(res_dict, (StimulusResponseDict)))
-        self.update(res_dict)
+        replaced = any(key in self for key in res_dict)
+        dict.update(self, res_dict)
+        if replaced:
+            self._update_flags()
+        else:
+            self.flags |= res_dict.flags
+    
+    def _update_flags(self):
+        flags = 0
+        for response in self.values():
+            flags |= response.get_flags()
+        self.flags = flags
     
     def did_act_or_requested_transition(self):
-        return self.did_act() or self.was_transition_requested()
+        return self.flags != 0
     
     def did_act(self):
-        for key in self:
-            if self[key].did_act():
-                return True
-        return False
+        return bool(self.flags & fsm.ACTED)
     
     def was_transition_requested(self):
-        for key in self:
-            if self[key].was_transition_requested():
-                return True
-        return False
+        return bool(self.flags & fsm.TRANSITION_REQUESTED)
 
 
 class SimpleState(fsm.State):
+    
+    # Set by StateNumbering, see is_parent().
+    numbering = None
+    pre = None
+    post = None
+    depth = None
 
     def __init__(self, name = ''):
         fsm.State.__init__(self, name = name)
         self.parent = None
     
-    def stimulate(self, event):
-        single_response = fsm.State.stimulate(self, event)
-        if not single_response.did_act_or_requested_transition() and self.has_parent():
-            return self.parent.stimulate(event)
+    def stimulate(self, event, machine = None):
+        single_response = fsm.State.stimulate(self, event, machine)
+        # Passed up when nothing acted and no transition was requested, a
+        # transition without target included. The shared NO_RESPONSE is
+        # the common case.
+        if self.parent is not None and (
+                single_response is fsm.NO_RESPONSE
+                or not single_response.did_act_or_requested_transition()):
+            if not issubclass(fsm.get_object_class(event), SimpleState._LOCAL_EVENTS):
+                # The handlers of the parent state, not the machine it contains.
+                return SimpleState.stimulate(self.parent, event, machine)
+        return single_response
+    
+    def fire(self, event, machine = None):
+        # fsm.State.fire() answers None for both an activity and a transition
+        # without target, only the first keeps the event from the parent.
+        acted = self.activities is not None and self.activities.fire(event, machine)
+        if self.transitions is None:
+            target = fsm.NOT_FIRED
         else:
-            return single_response
+            target = self.transitions.fire(event, machine)
+            if target is not None and target is not fsm.NOT_FIRED:
+                return target
+        if acted:
+            return None
+        if self.parent is not None:
+            if not issubclass(fsm.get_object_class(event), SimpleState._LOCAL_EVENTS):
+                return SimpleState.fire(self.parent, event, machine)
+        return target
     
     def start(self):
-        return StimulusResponse(False, False, None)
+        return fsm.NO_RESPONSE
     
     def stop(self):
-        return StimulusResponse(False, False, None)
+        return fsm.NO_RESPONSE
     
     def has_parent(self):
         return None != self.parent
+    
+    def _relink(self, states):
+        fsm.State._relink(self, states)
+        self.parent = states.get(self.parent, self.parent)
 
     def get_parent_stack(self):
         stack = []
@@ -146,18 +240,28 @@ class SimpleState(fsm.State):
         return stack
 
     def is_parent(self, other):
-        if self.parent == None:
-            return False
-    
-        if self.parent == other:
-            return True
-        else:
-            return self.parent.is_parent(other)
+        '''is_parent(other) -> True if other is an ancestor of this state
+
+        Constant time within a numbered tree, see StateNumbering.'''
+        numbering = self.numbering
+        if numbering is not None and numbering is other.numbering:
+            return other.pre < self.pre and self.post < other.post
+        state = self.parent
+        while state is not None:
+            if state is other:
+                return True
+            state = state.parent
+        return False
 
     def __contains__(self, child):
         return False
 
 
+# Enter, exit and completion belong to one state and are never passed up.
+SimpleState._LOCAL_EVENTS = (SimpleState.EnterEvent, SimpleState.ExitEvent,
+                             SimpleState.UnnamedEvent)
+
+
 class CompositeState(fsm.FSM, SimpleState):
     
     class InitialState(SimpleState, fsm.FSM.InitialState):
@@ -170,6 +274,17 @@ class CompositeState(fsm.FSM, SimpleState):
         SimpleState.__init__(self, name = name)
         fsm.FSM.__init__(self, states, initial = CompositeState.InitialState(),
                          final = CompositeState.FinalState())
+        self.initial.parent = self
+        self.final.parent = self
+    
+    def add_state(self, state):
+        state.parent = self
+        state_id = fsm.FSM.add_state(self, state)
+        if self.numbering is not None:
+            self.numbering.add(self, state)
+        elif state.numbering is not None:
+            StateNumbering.clear(state)
+        return state_id
     
     def start(self):
         return fsm.FSM.start(self)
@@ -179,79 +294,420 @@ class CompositeState(fsm.FSM, SimpleState):
     
     def __contains__(self, other):
         return fsm.FSM.__contains__(self, other)
+    
+    def _relink(self, states):
+        SimpleState._relink(self, states)
+        fsm.FSM._relink(self, states)
+    
+    def get_children(self):
+        return [self.initial] + list(self.states) + [self.final]
+    
+    def get_all_states(self):
+        '''get_all_states() -> this state and every state nested in it'''
+        all_states = [self, self.initial, self.final]
+        for state in self.states:
+            if isinstance(state, CompositeState):
+                all_states.extend(state.get_all_states())
+            else:
+                all_states.append(state)
+        return all_states
+
+
+def get_children(state):
+    if isinstance(state, CompositeState):
+        return state.get_children()
+    return []
+
+def get_common_ancestor(state, other):
+    '''get_common_ancestor(state, other) -> deepest state containing both
+
+    Either state itself counts as containing itself. Takes a constant time
+    check per level from state up to the result in a numbered tree.'''
+    while state is not None and state is not other and not other.is_parent(state):
+        state = state.parent
+    return state
+
+
+class StateNumbering(object):
+    '''Euler tour numbers of a tree of states.
+
+    Every state gets pre, post and depth. A state is an ancestor of another
+    when its pre and post numbers enclose the other's, leaves have pre equal
+    to post. A composite state leaves gap numbers spare at the end of its
+    range, so that a state added to it later is numbered in place; when a
+    range is full the whole tree is numbered again.'''
+    
+    gap = 8
+    
+    def __init__(self, root):
+        object.__init__(self)
+        self.root = root
+        self.renumbered = 0
+        self.renumber()
+    
+    def renumber(self):
+        self.renumbered += 1
+        self._number(self.root, 0, 0, self.gap)
+    
+    def add(self, composite, state):
+        '''Number state, just added to composite.'''
+        last = composite.pre
+        for child in get_children(composite):
+            if child is not state and child.numbering is self:
+                last = max(last, child.post)
+        if last + StateNumbering.get_size(state) < composite.post:
+            self._number(state, last + 1, composite.depth + 1, 0)
+        else:
+            self.renumber()
+    
+    def _number(self, state, first, depth, gap):
+        # Returns the first number after the range of state.
+        state.numbering = self
+        state.pre = first
+        state.depth = depth
+        if not isinstance(state, CompositeState):
+            state.post = first
+            return first + 1
+        number = first + 1
+        for child in state.get_children():
+            number = self._number(child, number, depth + 1, gap)
+        state.post = number + gap
+        return state.post + 1
+    
+    @staticmethod
+    def get_size(state):
+        '''get_size(state) -> numbers state and its descendants need, no gaps'''
+        if not isinstance(state, CompositeState):
+            return 1
+        return 2 + sum(StateNumbering.get_size(child) for child in state.get_children())
+    
+    @staticmethod
+    def clear(state):
+        state.numbering = None
+        for child in get_children(state):
+            StateNumbering.clear(child)
 
 
-class HSM(object):
+class HSM(fsm.EventQueue):
     
     class TopState(CompositeState):
         pass
     
+    # Set by tracing.TransitionTracer.attach().
+    tracer = None
+    
+    # True while the states are shared with a clone, see clone().
+    _shared = False
+    
     def __init__(self, states = []):
         object.__init__(self)
         self.top = HSM.TopState()
+        self.current = self.top.initial
+        self.state_change_activities = fsm.ActivityList()
+        # User data kept with the runtime configuration in snapshots.
+        self.context = None
     
     def start(self):
+        if self.top.numbering is None:
+            self.number_states()
+        self._hold_states(-1)
         self.current = self.top.initial
         return self.dispatch(SimpleState.EnterEvent)
     
+    def number_states(self):
+        '''number_states() -> StateNumbering of top, done by start()
+
+        States added afterwards are numbered as they are added.'''
+        return StateNumbering(self.top)
+    
     def stop(self):
-        self.top.final.add_final_transition_to_other(other=self.current)
-        return self.dispatch(SimpleState.ExitEvent)
+        '''As fsm.FSM.stop().'''
+        if self._busy:
+            return self._request_stop()
+        return self._macrostep(self._stop, None)
+    
+    def _stop(self, event):
+        if self.current == self.top.final:
+            return self._dispatch(SimpleState.ExitEvent)
+        tracer = self.tracer
+        if tracer is not None and tracer.countdown <= 1:
+            response = self._traced_step(self._exit_current_to_final,
+                                         SimpleState.ExitEvent)
+        else:
+            response = self._complete_transition(
+                self._exit_current_to_final(SimpleState.ExitEvent, self))
+            if tracer is not None:
+                tracer.countdown -= 1
+                response = self._through_initial(response)
+        return self._run_to_completion(SimpleState.ExitEvent, response)
+    
+    def _exit_current_to_final(self, event, machine):
+        # Same outcome as a last ExitEvent transition to the final state on
+        # the current state, without adding one on every stop.
+        response = fsm.State.stimulate(self.current, event, machine)
+        if not response.was_transition_requested():
+            response = StimulusResponse(response.did_act(), True, self.top.final)
+        return response
+    
+    def reset(self):
+        '''Return to the initial configuration without running activities.'''
+        self.clear_queue()
+        self._hold_states(-1)
+        self.current = self.top.initial
+    
+    def _hold_states(self, count):
+        # As fsm.FSM._hold_states(), for current and the composites above it.
+        for state in self.current.get_parent_stack():
+            if self.is_state_active(state):
+                state._active = max(0, state._active + count)
+    
+    def get_active_path(self):
+        '''get_active_path() -> state ids from the top state down to current
+
+        Each id is relative to the composite state containing that state.'''
+        path = []
+        for state in self.current.get_parent_stack():
+            if state is self.top:
+                continue
+            container = state.parent if state.has_parent() else self.top
+            path.append(container.get_state_id(state))
+        return tuple(path)
+    
+    def clone(self):
+        '''clone() -> new machine in the same configuration, sharing the states
+
+        As fsm.FSM.clone(): add_start_activity and add_stop_activity give the
+        machine its own copy of the states first, states added to top do not.'''
+        machine = object.__new__(self.__class__)
+        machine.__dict__.update(self.__dict__)
+        machine.__dict__.pop('tracer', None)
+        machine.__dict__.pop('trace_id', None)
+        machine._drop_queue()
+        machine.state_change_activities = self.state_change_activities.copy()
+        machine.context = copy.deepcopy(self.context)
+        machine._hold_states(1)
+        self._shared = machine._shared = True
+        return machine
+    
+    def _unshare(self):
+        self._hold_states(-1)
+        copies = fsm.copy_states(self.top.get_all_states())
+        self.top = copies[self.top]
+        self.current = copies[self.current]
+        self._hold_states(1)
+        if self.top.numbering is not None:
+            # The copies carry the numbering of the originals.
+            self.number_states()
+        self._shared = False
+        return copies
+    
+    def memory_report(self):
+        '''memory_report() -> {component: bytes, 'total': bytes}, see fsm.MemorySizer'''
+        sizer = fsm.MemorySizer()
+        sizer.add_machine(self)
+        for state in self.top.get_all_states():
+            sizer.add_state(state)
+        return sizer.get_report()
+    
+    def is_state_active(self, state):
+        '''is_state_active(state) -> True if state is current or one of its parents'''
+        if state is self.top or isinstance(state, CompositeState.InitialState):
+            return False
+        return state is self.current or self.current.is_parent(state)
+    
+    def get_snapshot(self):
+        '''get_snapshot() -> (active path, context)'''
+        return (self.get_active_path(), self.context)
+    
+    def restore_snapshot(self, snapshot):
+        '''Restore a get_snapshot() result without running activities.'''
+        path, context = snapshot
+        self.reset()
+        container = self.top
+        for state_id in path:
+            state = container.get_state(state_id)
+            container = state
+        self.current = state
+        self._hold_states(1)
+        self.context = context
     
     def add_start_activity(self, activity):
+        if self._shared:
+            self._unshare()
         self.top.add_start_activity(activity)
     
     def add_stop_activity(self, activity):
+        if self._shared:
+            self._unshare()
         self.top.add_stop_activity(activity)
     
     def add_on_transition_completed_activity(self, activity):
-        self.top.add_on_transition_completed_activity(activity)
+        self.state_change_activities.add_activity(activity)
     
     def dispatch(self, event):
-        while True:
+        '''dispatch(event) -> response, fsm.NO_RESPONSE if queued'''
+        if self._busy:
+            self._enqueue(event)
+            return fsm.NO_RESPONSE
+        self._busy = True
+        try:
+            response = self._dispatch(event)
+            if self._inbox is not None or self._external_events:
+                self._drain()
+        finally:
+            self._busy = False
+        return response
+    
+    def _dispatch(self, event):
+        response = self._dipatch_to_current(event)
+        return self._run_to_completion(event, response)
+    
+    def post(self, event):
+        '''post(event) -> current state afterwards
+
+        Same as dispatch() without building responses, for callers that
+        ignore them.'''
+        if self._busy:
+            self._enqueue(event)
+            return self.current
+        self._busy = True
+        try:
+            self._post(event)
+            if self._inbox is not None or self._external_events:
+                self._drain()
+        finally:
+            self._busy = False
+        return self.current
+    
+    def _post(self, event):
+        if self.tracer is not None:
+            if (self._traced_fire(event)
+                or fsm.Event.is_same_type(event, SimpleState.EnterEvent)):
+                while self._traced_fire(SimpleState.UnnamedEvent):
+                    pass
+        elif self._fire(event) or fsm.Event.is_same_type(event, SimpleState.EnterEvent):
+            while self._fire(SimpleState.UnnamedEvent):
+                pass
+    
+    def _fire(self, event):
+        target = self.current.fire(event, self)
+        if target is None or target is fsm.NOT_FIRED:
+            return False
+        self._move_to(target)
+        return True
+    
+    def _traced_fire(self, event):
+        tracer = self.tracer
+        if tracer.countdown > 1:
+            # Not sampled, only count the transition.
+            if not self._fire(event):
+                return False
+            tracer.countdown -= 1
+            return self._fire_through_initial()
+        source = self.current
+        started = tracer.clock()
+        target = source.fire(event, self)
+        if target is None or target is fsm.NOT_FIRED:
+            return False
+        reacted = tracer.clock()
+        self._move_to(target)
+        fired = self._fire_through_initial()
+        tracer.record(self, source, event, self.current, started, reacted)
+        return fired
+    
+    def _fire_through_initial(self):
+        # _through_initial() for the fire path, False if stuck on the initial
+        # state.
+        while isinstance(self.current, CompositeState.InitialState):
+            target = self.current.fire(SimpleState.UnnamedEvent, self)
+            if target is None or target is fsm.NOT_FIRED:
+                return False
+            self._move_to(target)
+        return True
+    
+    def _run_to_completion(self, event, response):
+        while (fsm.Event.is_same_type(event, SimpleState.EnterEvent)
+               or response.was_transition_requested()):
+            # Completion transitions of the new state, as in fsm.FSM.
+            event = SimpleState.UnnamedEvent
             response = self._dipatch_to_current(event)
-            
-            if event == SimpleState.EnterEvent:
-                event = SimpleState.UnnamedEvent
-            elif not response.was_transition_requested():
-                break
         return response
 
     def _dipatch_to_current(self, event):
+        tracer = self.tracer
+        if tracer is not None and tracer.countdown <= 1:
+            return self._traced_step(self.current.stimulate, event)
         
-        response = self.current.stimulate(event)
+        response = self.current.stimulate(event, self)
         
         if not response.was_transition_requested():
             return response
-
-        source_stack = self.current.get_parent_stack()
-        source_set = set(source_stack)
-        target_stack = response.get_target().get_parent_stack()
-        target_set = set(target_stack)
-        common_set = target_set & source_set
-        exit_set = source_set - common_set
-        enter_set = target_set - common_set
-        exit_stack = [st for st in source_stack if st in exit_set ]
-        exit_stack.reverse()
-        enter_stack = [st for st in target_stack if st in enter_set ]
-
-        for st in exit_stack:
-            exit_response = st.exit()
-                
-            if exit_response.did_act():
-                activity = True
+        response = self._complete_transition(response)
+        if tracer is not None:
+            # Not sampled, only count the transition.
+            tracer.countdown -= 1
+            response = self._through_initial(response)
+        return response
+    
+    def _traced_step(self, react, event):
+        '''As fsm.FSM._traced_step(), the record names the leaf state entered.'''
+        tracer = self.tracer
+        source = self.current
+        started = tracer.clock()
+        response = react(event, self)
+        if not response.was_transition_requested():
+            return response
+        reacted = tracer.clock()
+        response = self._through_initial(self._complete_transition(response))
+        tracer.record(self, source, event, self.current, started, reacted)
+        return response
+    
+    def _through_initial(self, response):
+        # Traced transitions into a composite state go on through its initial
+        # state, a step _run_to_completion() would take next anyway, so that
+        # one transition is counted and recorded with the state entered.
+        while isinstance(self.current, CompositeState.InitialState):
+            response = self.current.stimulate(SimpleState.UnnamedEvent, self)
+            if not response.was_transition_requested():
+                break
+            response = self._complete_transition(response)
+        return response
+    
+    def _complete_transition(self, response):
+        flags = response.get_flags() | self._move_to(response.get_target())
+        return fsm.StimulusResponse.from_flags(flags, self.current)
+    
+    def _move_to(self, target):
+        '''_move_to(target) -> flags of the exit and enter activities'''
+        flags = 0
+        # Common ancestry short of the source and target themselves, so self
+        # transitions and transitions to an ancestor leave it and enter it
+        # again.
+        common = get_common_ancestor(self.current, target)
+        if common is self.current or common is target:
+            common = common.parent
         
-        for st in enter_stack:
-            enter_response = st.enter()
-
-            if enter_response.did_act():
-                activity = True
+        state = self.current
+        while state is not common:
+            flags |= state.exit(self).get_flags()
+            state = state.parent
         
-        self.current = enter_stack[-1]
-        self.top.state_change_activities.stimulate(Event)
+        entered = []
+        state = target
+        while state is not common:
+            entered.append(state)
+            state = state.parent
+        for state in reversed(entered):
+            flags |= state.enter(self).get_flags()
         
-        start_response = self.current.start()
-        return StimulusResponse(activity or start_response.did_act(), True, self.current)
+        self.current = target
+        if isinstance(self.current, CompositeState):
+            # Continue from the initial state of the composite, its completion
+            # transition leads on to the default child.
+            self.current = self.current.initial
+            flags |= self.current.enter(self).get_flags()
+        self.state_change_activities.fire(Event, self)
+        return flags
 
     def fsm_dipatch_to_current(self, event):
         '''_dipatch_to_state(state, event) -> active_state, did_transition'''
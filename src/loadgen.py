@@ -0,0 +1,193 @@
+'''
+Headless load generator for the soda machine example
+
+Runs N soda.SodaMachine instances with a UI that draws nothing (NullUI) or
+keeps the output lines in memory (BufferingUI), drives them with seeded
+synthetic key sequences and reports event and transition throughput and
+per event latency percentiles.
+
+    python loadgen.py --machines 100 --events 1000 --seed 7
+'''
+from __future__ import print_function
+import argparse
+import bisect
+import math
+import random
+import time
+import fsm
+import soda
+
+clock = getattr(time, 'perf_counter', time.time)
+
+COIN_KEYS = ['1', '2', '5', 'l', 't']
+SELECT_KEY = 's'
+RETURN_KEY = 'r'
+
+DEFAULT_WEIGHTS = {'coin': 0.6, 'select': 0.3, 'return': 0.1}
+
+PERCENTILES = (50, 90, 99)
+
+
+class NullUI(soda.UI):
+
+    def __init__(self):
+        soda.UI.__init__(self, use_ncurses=False)
+
+    def get_key(self):
+        return 'q'
+
+    def set_screen_ready(self):
+        pass
+
+    def display_state(self, state):
+        pass
+
+    def display_msg(self, msg):
+        pass
+
+    def display_msg2(self, msg):
+        pass
+
+    def display_credit(self, credit):
+        pass
+
+
+class BufferingUI(soda.UI):
+    '''Takes the stdout paths of soda.UI, collecting lines instead of printing.'''
+
+    def __init__(self):
+        soda.UI.__init__(self, use_ncurses=False)
+        self.lines = []
+
+    def get_key(self):
+        return 'q'
+
+    def stdout_set_screen_ready(self):
+        self.lines.append('Keys')
+
+    def stdout_display_state(self, state):
+        self.lines.append('New state: ' + state)
+
+    def stdout_display_msg(self, msg):
+        self.lines.append(msg)
+
+    def stdout_display_msg2(self, msg):
+        self.lines.append(msg)
+
+    def stdout_display_credit(self, credit):
+        self.lines.append('Credit: $%.2f' % credit)
+
+
+UIS = {'null': NullUI, 'buffer': BufferingUI}
+
+
+def generate_keys(seed, count, weights = DEFAULT_WEIGHTS):
+    '''generate_keys(seed, count, weights) -> list of soda key presses'''
+    rng = random.Random(seed)
+    kinds = sorted(weights)
+    cumulative = []
+    total = 0.0
+    for kind in kinds:
+        total += weights[kind]
+        cumulative.append(total)
+    keys = []
+    for i in range(count):
+        kind = kinds[bisect.bisect_right(cumulative, rng.random() * total)]
+        if kind == 'coin':
+            keys.append(rng.choice(COIN_KEYS))
+        elif kind == 'select':
+            keys.append(SELECT_KEY)
+        else:
+            keys.append(RETURN_KEY)
+    return keys
+
+def percentile(sorted_values, percent):
+    '''Nearest rank percentile of an already sorted list.'''
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+class LoadReport(object):
+
+    def __init__(self, machines, events, transitions, elapsed, latencies):
+        object.__init__(self)
+        self.machines = machines
+        self.events = events
+        self.transitions = transitions
+        self.elapsed = elapsed
+        latencies = sorted(latencies)
+        self.latency_percentiles = dict((p, percentile(latencies, p))
+                                        for p in PERCENTILES)
+        self.max_latency = latencies[-1] if latencies else 0.0
+
+    def get_events_per_second(self):
+        return self.events / self.elapsed if self.elapsed > 0 else 0.0
+
+    def get_transitions_per_second(self):
+        return self.transitions / self.elapsed if self.elapsed > 0 else 0.0
+
+    def format(self):
+        lines = ['machines:        %d' % self.machines,
+                 'events:          %d' % self.events,
+                 'transitions:     %d' % self.transitions,
+                 'elapsed:         %.3f s' % self.elapsed,
+                 'events/s:        %.0f' % self.get_events_per_second(),
+                 'transitions/s:   %.0f' % self.get_transitions_per_second()]
+        for p in PERCENTILES:
+            lines.append('latency p%-2d:     %.1f us'
+                         % (p, self.latency_percentiles[p] * 1e6))
+        lines.append('latency max:     %.1f us' % (self.max_latency * 1e6))
+        return '\n'.join(lines)
+
+
+def run(num_machines, events_per_machine, seed = 0, ui_factory = NullUI,
+        weights = DEFAULT_WEIGHTS):
+    '''Drive num_machines soda machines round robin. Returns a LoadReport.'''
+    transitions = [0]
+
+    def count_transition(event):
+        transitions[0] += 1
+
+    machines = []
+    for i in range(num_machines):
+        machine = soda.SodaMachine(ui_factory())
+        machine.sm.add_on_transition_completed_activity(fsm.Activity(count_transition))
+        machine.start()
+        machines.append(machine)
+    scripts = [generate_keys(seed * 1000003 + i, events_per_machine, weights)
+               for i in range(num_machines)]
+
+    transitions[0] = 0
+    latencies = []
+    record = latencies.append
+    started = clock()
+    for step in range(events_per_machine):
+        for machine, keys in zip(machines, scripts):
+            before = clock()
+            machine.process_key(keys[step])
+            record(clock() - before)
+    elapsed = clock() - started
+
+    for machine in machines:
+        machine.stop()
+    return LoadReport(num_machines, len(latencies), transitions[0], elapsed,
+                      latencies)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--machines', type=int, default=100)
+    parser.add_argument('--events', type=int, default=1000,
+                        help='events per machine')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ui', choices=sorted(UIS), default='null')
+    args = parser.parse_args(argv)
+    report = run(args.machines, args.events, args.seed, UIS[args.ui])
+    print(report.format())
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+SQLite persistence of machine configurations
+
+SQLitePersistence records the configuration of tracked machines (see
+FSM.get_snapshot and HSM.get_snapshot) in one SQLite table. It hooks into
+the transition completed activities of each machine and only marks the
+machine dirty there. Dirty machines are written in one batched transaction
+every `flush_every` transitions or when `flush_interval` seconds have passed
+since the last flush. The interval is checked on transitions and on poll();
+there is no background thread.
+
+load_all() reads every stored configuration with a single query.
+'''
+import json
+import pickle
+import sqlite3
+import time
+import fsm
+
+clock = getattr(time, 'perf_counter', time.time)
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS machines (
+                 key TEXT PRIMARY KEY,
+                 state TEXT NOT NULL,
+                 context BLOB)'''
+
+
+def _encode_state(state):
+    if isinstance(state, tuple):
+        return json.dumps(list(state))
+    return json.dumps(state)
+
+def _decode_state(text):
+    state = json.loads(text)
+    if isinstance(state, list):
+        return tuple(state)
+    return state
+
+
+class SQLitePersistence(object):
+
+    def __init__(self, path, flush_every = 100, flush_interval = 0.05):
+        object.__init__(self)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(_SCHEMA)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.machines = {}
+        self.dirty = {}
+        self.pending_transitions = 0
+        self.last_flush = self.clock()
+        self.flush_count = 0
+        self.rows_written = 0
+
+    def track(self, key, machine):
+        '''Persist machine under key from now on. Writes it at the next flush.'''
+        self.machines[key] = machine
+        self.dirty[key] = machine
+
+        def on_transition_completed(event):
+            self.mark_dirty(key)
+
+        machine.add_on_transition_completed_activity(
+                                            fsm.Activity(on_transition_completed))
+
+    def mark_dirty(self, key):
+        machine = self.machines.get(key)
+        if machine is None:
+            # Forgotten, the activity is still attached to the machine.
+            return
+        self.dirty[key] = machine
+        self.pending_transitions += 1
+        if self.pending_transitions >= self.flush_every:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        '''Flush if the interval has passed. For callers that go idle.'''
+        if self.dirty and self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        rows = []
+        for key, machine in self.dirty.items():
+            state, context = machine.get_snapshot()
+            rows.append((key, _encode_state(state),
+                         sqlite3.Binary(pickle.dumps(context, 2))))
+        if rows:
+            with self.connection:
+                self.connection.executemany(
+                        'INSERT OR REPLACE INTO machines VALUES (?, ?, ?)', rows)
+            self.flush_count += 1
+            self.rows_written += len(rows)
+        self.dirty.clear()
+        self.pending_transitions = 0
+        self.last_flush = self.clock()
+
+    def load_all(self):
+        '''load_all() -> {key: snapshot} for every stored machine'''
+        cursor = self.connection.execute('SELECT key, state, context FROM machines')
+        return dict((key, (_decode_state(state), pickle.loads(bytes(context))))
+                    for key, state, context in cursor)
+
+    def recover(self, factory):
+        '''recover(factory) -> {key: machine}, tracked again
+
+        factory(key) returns a new machine to restore the snapshot into.'''
+        machines = {}
+        for key, snapshot in self.load_all().items():
+            machine = factory(key)
+            machine.restore_snapshot(snapshot)
+            self.track(key, machine)
+            machines[key] = machine
+        self.dirty.clear()
+        return machines
+
+    def forget(self, key):
+        self.machines.pop(key, None)
+        self.dirty.pop(key, None)
+        with self.connection:
+            self.connection.execute('DELETE FROM machines WHERE key = ?', (key,))
+
+    def close(self):
+        self.flush()
+        self.connection.close()
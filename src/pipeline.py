@@ -0,0 +1,212 @@
+'''
+Streaming event ingestion
+
+Reads events from a byte stream, decodes them in batches and dispatches them
+to machines routed by key:
+
+    reader --(bounded queue per worker)--> worker threads --> machines
+
+The stream carries one event per line:
+
+    <tag> <key> <payload>\\n
+
+The tag selects a decoder in a CodecTable, which turns the payload bytes into
+an fsm.Event. Files, pipes and sockets (through socket.makefile('rb')) all
+work, as does io.BytesIO in tests. All events of one key go to the same
+worker, so a machine only ever runs on one thread, in stream order. The
+queues are bounded and the reader blocks when a worker falls behind, which
+is the backpressure to the producer of the stream.
+
+machine_for_key(key) is called from the worker threads and has to be thread
+safe when there is more than one worker.
+'''
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+clock = getattr(time, 'perf_counter', time.time)
+
+_STOP = None
+
+
+class CodecTable(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self.decoders = {}
+        self.encoders = {}
+
+    def register(self, tag, event_cls, decode = None, encode = None):
+        '''decode(payload) -> event, encode(event) -> payload bytes
+
+        Without a decoder the event class is built without arguments.'''
+        assert(isinstance(tag, bytes) and b' ' not in tag)
+        if decode is None:
+            decode = lambda payload: event_cls()
+        if encode is None:
+            encode = lambda event: b''
+        self.decoders[tag] = decode
+        self.encoders[event_cls] = (tag, encode)
+
+    def decode(self, line):
+        '''decode(line) -> (key, event)'''
+        tag, key, payload = (line.split(b' ', 2) + [b''])[:3]
+        decode = self.decoders.get(tag)
+        if decode is None:
+            raise ValueError('Unknown event tag %r' % (tag,))
+        return key.decode('utf-8'), decode(payload)
+
+    def encode(self, key, event):
+        tag, encode = self.encoders[event.__class__]
+        return b' '.join([tag, key.encode('utf-8'), encode(event)]) + b'\n'
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        object.__init__(self)
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        self.errors = 0
+        self.last_error = None
+        self.started = None
+        self.stopped = None
+
+    def get_wall_time(self):
+        if self.started is None:
+            return 0.0
+        return (self.stopped or clock()) - self.started
+
+    def get_throughput(self):
+        '''Items per second of wall time.'''
+        wall_time = self.get_wall_time()
+        return self.items / wall_time if wall_time > 0 else 0.0
+
+    def as_dict(self):
+        return {'items': self.items,
+                'batches': self.batches,
+                'busy_time': self.busy_time,
+                'blocked_time': self.blocked_time,
+                'errors': self.errors,
+                'wall_time': self.get_wall_time(),
+                'throughput': self.get_throughput()}
+
+    def __repr__(self):
+        return '%s: %r' % (self.name, self.as_dict())
+
+
+class Pipeline(object):
+
+    def __init__(self, codecs, machine_for_key, num_workers = 1, queue_size = 16,
+                 batch_size = 256, read_size = 65536):
+        object.__init__(self)
+        assert(num_workers > 0 and queue_size > 0 and batch_size > 0)
+        self.codecs = codecs
+        self.machine_for_key = machine_for_key
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.read_size = read_size
+        self.read_stats = StageStats('read')
+        self.decode_stats = StageStats('decode')
+        self.dispatch_stats = [StageStats('dispatch%d' % i)
+                               for i in range(num_workers)]
+
+    def run(self, stream):
+        '''Read stream to the end and dispatch every event. Returns the stats.'''
+        queues = [queue.Queue(self.queue_size) for i in range(self.num_workers)]
+        workers = [threading.Thread(target=self._work, args=(q, stats))
+                   for q, stats in zip(queues, self.dispatch_stats)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            self._read(stream, queues)
+        finally:
+            for q in queues:
+                q.put(_STOP)
+            for worker in workers:
+                worker.join()
+        return self.get_stats()
+
+    def get_stats(self):
+        stats = {'read': self.read_stats.as_dict(),
+                 'decode': self.decode_stats.as_dict()}
+        for worker_stats in self.dispatch_stats:
+            stats[worker_stats.name] = worker_stats.as_dict()
+        return stats
+
+    def _read(self, stream, queues):
+        read = getattr(stream, 'read1', stream.read)
+        read_stats = self.read_stats
+        read_stats.started = clock()
+        self.decode_stats.started = read_stats.started
+        tail = b''
+        while True:
+            started = clock()
+            data = read(self.read_size)
+            read_stats.busy_time += clock() - started
+            if not data:
+                break
+            read_stats.batches += 1
+            lines = (tail + data).split(b'\n')
+            tail = lines.pop()
+            for first in range(0, len(lines), self.batch_size):
+                self._route(lines[first:first + self.batch_size], queues)
+        if tail:
+            self._route([tail], queues)
+        read_stats.stopped = clock()
+        self.decode_stats.stopped = read_stats.stopped
+
+    def _route(self, lines, queues):
+        decode_stats = self.decode_stats
+        started = clock()
+        batches = [[] for q in queues]
+        decode = self.codecs.decode
+        for line in lines:
+            if not line:
+                continue
+            try:
+                key, event = decode(line)
+            except ValueError:
+                decode_stats.errors += 1
+                continue
+            batches[hash(key) % len(queues)].append((key, event))
+            decode_stats.items += 1
+        decode_stats.batches += 1
+        decode_stats.busy_time += clock() - started
+        self.read_stats.items += len(lines)
+
+        for q, batch in zip(queues, batches):
+            if batch:
+                started = clock()
+                q.put(batch)
+                self.read_stats.blocked_time += clock() - started
+
+    def _work(self, q, stats):
+        machine_for_key = self.machine_for_key
+        stats.started = clock()
+        while True:
+            started = clock()
+            batch = q.get()
+            stats.blocked_time += clock() - started
+            if batch is _STOP:
+                break
+            started = clock()
+            for key, event in batch:
+                try:
+                    machine_for_key(key).post(event)
+                except Exception as error:
+                    stats.errors += 1
+                    stats.last_error = error
+                stats.items += 1
+            stats.batches += 1
+            stats.busy_time += clock() - started
+        stats.stopped = clock()
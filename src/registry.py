@@ -0,0 +1,143 @@
+'''
+Multi-tenant machine registry
+
+Keeps the machines of many sessions behind one keyed interface. At most
+`capacity` machines stay in memory, least recently used first out. Evicted
+machines are written to a store as snapshots (see FSM.get_snapshot and
+HSM.get_snapshot) and rebuilt with the factory on the next event for their
+key.
+
+The store is any mapping: a dict, or a shelve opened with open_shelf_store()
+to keep cold sessions on local disk. Shelve keys must be strings.
+'''
+import collections
+import shelve
+import time
+import hsm
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def deliver(machine, event):
+    '''Dispatch event to an fsm.FSM or hsm.HSM.'''
+    if isinstance(machine, hsm.HSM):
+        return machine.dispatch(event)
+    return machine.stimulate(event)
+
+def open_shelf_store(path):
+    return shelve.open(path, protocol=2)
+
+
+class RegistryStats(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self.lookups = 0
+        self.hits = 0
+        self.creations = 0
+        self.evictions = 0
+        self.rehydrations = 0
+        self.rehydration_time = 0.0
+        self.max_rehydration_time = 0.0
+
+    def get_hit_rate(self):
+        return float(self.hits) / self.lookups if self.lookups else 0.0
+
+    def get_eviction_rate(self):
+        '''Evictions per lookup.'''
+        return float(self.evictions) / self.lookups if self.lookups else 0.0
+
+    def get_mean_rehydration_time(self):
+        if not self.rehydrations:
+            return 0.0
+        return self.rehydration_time / self.rehydrations
+
+    def as_dict(self):
+        return {'lookups': self.lookups,
+                'hits': self.hits,
+                'creations': self.creations,
+                'evictions': self.evictions,
+                'rehydrations': self.rehydrations,
+                'hit_rate': self.get_hit_rate(),
+                'eviction_rate': self.get_eviction_rate(),
+                'mean_rehydration_time': self.get_mean_rehydration_time(),
+                'max_rehydration_time': self.max_rehydration_time}
+
+    def __repr__(self):
+        return self.as_dict().__repr__()
+
+
+class MachineRegistry(object):
+
+    def __init__(self, factory, capacity = 1024, store = None):
+        '''factory(key) returns a new, not yet started, machine.'''
+        object.__init__(self)
+        assert(capacity > 0)
+        self.factory = factory
+        self.capacity = capacity
+        self.store = {} if store is None else store
+        self.hot = collections.OrderedDict()
+        self.stats = RegistryStats()
+
+    def get(self, key):
+        '''get(key) -> machine, created or rehydrated if needed'''
+        stats = self.stats
+        stats.lookups += 1
+        machine = self.hot.pop(key, None)
+        if machine is not None:
+            stats.hits += 1
+        elif key in self.store:
+            machine = self._rehydrate(key)
+        else:
+            machine = self.factory(key)
+            machine.start()
+            stats.creations += 1
+        # Most recently used last.
+        self.hot[key] = machine
+        while len(self.hot) > self.capacity:
+            self._evict_oldest()
+        return machine
+
+    def dispatch(self, key, event):
+        return deliver(self.get(key), event)
+
+    def _rehydrate(self, key):
+        started = clock()
+        snapshot = self.store.pop(key)
+        machine = self.factory(key)
+        machine.restore_snapshot(snapshot)
+        elapsed = clock() - started
+        stats = self.stats
+        stats.rehydrations += 1
+        stats.rehydration_time += elapsed
+        stats.max_rehydration_time = max(stats.max_rehydration_time, elapsed)
+        return machine
+
+    def _evict_oldest(self):
+        key, machine = self.hot.popitem(last=False)
+        self.store[key] = machine.get_snapshot()
+        self.stats.evictions += 1
+
+    def evict(self, key):
+        machine = self.hot.pop(key)
+        self.store[key] = machine.get_snapshot()
+        self.stats.evictions += 1
+
+    def flush(self):
+        '''Write snapshots of all in-memory machines to the store.'''
+        for key, machine in self.hot.items():
+            self.store[key] = machine.get_snapshot()
+
+    def discard(self, key):
+        self.hot.pop(key, None)
+        if key in self.store:
+            del self.store[key]
+
+    def is_hot(self, key):
+        return key in self.hot
+
+    def __contains__(self, key):
+        return key in self.hot or key in self.store
+
+    def __len__(self):
+        return len(self.hot) + len(self.store)
@@ -3,26 +3,88 @@ A simple program that implements an FSM. Designed after a state machine
 description somewhere in the Web.
 '''
 
+from __future__ import print_function
 import fsm
-import curses, traceback
+import curses, time, traceback
+
+try:
+    read_line = raw_input
+except NameError:
+    read_line = input
 
 
 class UI(object):
     
-    def __init__(self, use_ncurses = False):
+    # Order in which the parts of a coalesced frame are drawn.
+    FRAME_FIELDS = ('screen_ready', 'state', 'msg', 'msg2', 'credit')
+    
+    def __init__(self, use_ncurses = False, max_fps = None):
         self.use_ncurses = use_ncurses
+        # Display updates made between begin_frame() and end_frame() only
+        # keep their last value and are drawn together, at most max_fps
+        # times per second.
+        self.frame_depth = 0
+        self.pending = {}
+        self.min_frame_interval = 1.0 / max_fps if max_fps else 0.0
+        self.last_frame_time = None
+        self.frames_drawn = 0
         if use_ncurses:
             self.init_ncurses()
     
     def get_key(self):
+        self.flush()
         if self.use_ncurses:
             return self.screen.getkey()
         else:
-            return raw_input('> ')
+            return read_line('> ')
     
     def shutdown(self):
+        self.flush()
         if self.use_ncurses:
             self.shutdown_ncurses()
+    
+    def begin_frame(self):
+        self.frame_depth += 1
+    
+    def end_frame(self):
+        assert(self.frame_depth > 0)
+        self.frame_depth -= 1
+        if self.frame_depth == 0:
+            now = time.time()
+            if    self.last_frame_time is None \
+               or now - self.last_frame_time >= self.min_frame_interval:
+                self.flush()
+    
+    def flush(self):
+        '''Draw the pending frame now, regardless of the rate cap.'''
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        for field in UI.FRAME_FIELDS:
+            if field in pending:
+                self.draw(field, pending[field])
+        if self.use_ncurses:
+            self.screen.refresh()
+        self.last_frame_time = time.time()
+        self.frames_drawn += 1
+    
+    def render(self, field, value):
+        if self.frame_depth:
+            self.pending[field] = value
+        else:
+            self.draw(field, value)
+    
+    def draw(self, field, value):
+        if field == 'screen_ready':
+            if self.use_ncurses:
+                self.ncurses_set_screen_ready()
+            else:
+                self.stdout_set_screen_ready()
+        elif self.use_ncurses:
+            getattr(self, 'ncurses_display_' + field)(value)
+        else:
+            getattr(self, 'stdout_display_' + field)(value)
 
     def init_ncurses(self):
         try:
@@ -50,10 +112,7 @@ class UI(object):
         curses.endwin()                 # Terminate curses
     
     def set_screen_ready(self):
-        if self.use_ncurses:
-            self.ncurses_set_screen_ready()
-        else:
-            self.stdout_set_screen_ready()
+        self.render('screen_ready', None)
     
     def ncurses_set_screen_ready(self):
         assert(self.use_ncurses)
@@ -69,10 +128,7 @@ class UI(object):
         self.screen.addstr(14,1, '  q:  Quit')
     
     def display_state(self, state):
-        if self.use_ncurses:
-            self.ncurses_display_state(state)
-        else:
-            self.stdout_display_state(state)
+        self.render('state', state)
 
     def ncurses_display_state(self, state):
         assert(self.use_ncurses)
@@ -80,10 +136,7 @@ class UI(object):
         self.screen.addstr(1,1, state)
     
     def display_msg(self, msg):
-        if self.use_ncurses:
-            self.ncurses_display_msg(msg)
-        else:
-            self.stdout_display_msg(msg)
+        self.render('msg', msg)
         
     def ncurses_display_msg(self, msg):
         assert(self.use_ncurses)
@@ -91,10 +144,7 @@ class UI(object):
         self.screen.addstr(2,1, msg)
     
     def display_msg2(self, msg):
-        if self.use_ncurses:
-            self.ncurses_display_msg2(msg)
-        else:
-            self.stdout_display_msg2(msg)
+        self.render('msg2', msg)
     
     def ncurses_display_msg2(self, msg):
         assert(self.use_ncurses)
@@ -102,10 +152,7 @@ class UI(object):
         self.screen.addstr(3,1, msg)
     
     def display_credit(self, credit):
-        if self.use_ncurses:
-            self.ncurses_display_credit(credit)
-        else:
-            self.stdout_display_credit(credit)
+        self.render('credit', credit)
 
     def ncurses_display_credit(self, credit):
         assert(self.use_ncurses)
@@ -143,7 +190,9 @@ class State(fsm.State):
     pass
 
 class FSM(fsm.FSM):
-    pass
+    
+    # The SodaMachine running this machine, see on_owner().
+    owner = None
 
 
 class CoinDeposited(Event):
@@ -175,6 +224,15 @@ class Dispensing(State):
 class RefundingChange(State):
     pass
 
+def on_owner(method):
+    '''Guard, effect or action of a Machine* handler calling method on the
+    owner of the dispatching machine. Clones share their handlers.'''
+    def handler(machine, event):
+        return method(machine.owner, event)
+    handler.__name__ = method.__name__
+    return handler
+
+
 class SodaMachine(object):
     
     def __init__(self, ui):
@@ -190,27 +248,29 @@ class SodaMachine(object):
 
         self.sm = FSM([self.idle, self.waitingForFunds, self.waitingForSelection,
                        self.dispensing, self.refundingChange])
+        self.sm.owner = self
         
-        do_display_state = fsm.Activity(self.display_state)
+        do_display_state = fsm.MachineActivity(on_owner(SodaMachine.display_state))
         self.sm.add_on_transition_completed_activity(do_display_state)
         
-        do_set_screen_ready = fsm.Activity(self.set_screen_ready)
+        do_set_screen_ready = fsm.MachineActivity(on_owner(SodaMachine.set_screen_ready))
 
         self.idle.add_enter_activity(do_set_screen_ready)
 
-        to_waitingForFunds_while_adding_funds = fsm.TransitionWithEffect(
+        to_waitingForFunds_while_adding_funds = fsm.MachineTransition(
                 target=self.waitingForFunds,
-                effect=self.add_coin_to_bin)
+                effect=on_owner(SodaMachine.add_coin_to_bin))
         self.idle.add_transition(event=CoinDeposited,
                                  transition=to_waitingForFunds_while_adding_funds)
 
-        to_waitingForSelection_if_enough_money = fsm.TransitionWithGuard(
-                guard=self.amount_in_bin_equal_or_greater_than_drink_price,
-                target=self.waitingForSelection)
+        enough_money = on_owner(
+                SodaMachine.amount_in_bin_equal_or_greater_than_drink_price)
+        to_waitingForSelection_if_enough_money = fsm.MachineTransition(
+                guard=enough_money, target=self.waitingForSelection)
         to_refundingChange = fsm.Transition(target=self.refundingChange)
 
-        do_add_coin = fsm.Activity(self.add_coin_to_bin)
-        do_clear_screen_waitForFunds = fsm.Activity(self.wait_for_funds_clear_screen)
+        do_add_coin = fsm.MachineActivity(on_owner(SodaMachine.add_coin_to_bin))
+        do_clear_screen_waitForFunds = fsm.MachineActivity(on_owner(SodaMachine.wait_for_funds_clear_screen))
 
         self.waitingForFunds.add_enter_activity(do_clear_screen_waitForFunds)
         self.waitingForFunds.add_unnamed_transition(to_waitingForSelection_if_enough_money)
@@ -224,13 +284,13 @@ class SodaMachine(object):
         self.waitingForSelection.add_activity(CoinDeposited, do_add_coin)
         self.waitingForSelection.add_transition(DrinkSelected, to_dispensing)
         
-        do_dispense_and_charge_price = fsm.Activity(self.dispense_drink_and_extract_price_from_bin)
+        do_dispense_and_charge_price = fsm.MachineActivity(on_owner(SodaMachine.dispense_drink_and_extract_price_from_bin))
         
         self.dispensing.add_enter_activity(do_dispense_and_charge_price)
         self.dispensing.add_unnamed_transition(to_refundingChange)
         
         to_idle = fsm.Transition(self.idle)
-        do_refund = fsm.Activity(self.refund_change)
+        do_refund = fsm.MachineActivity(on_owner(SodaMachine.refund_change))
         
         self.refundingChange.add_enter_activity(do_refund)
         self.refundingChange.add_unnamed_transition(to_idle)
@@ -281,16 +341,38 @@ class SodaMachine(object):
     def display_amount_in_bin(self):
         self.display_credit()
     
+    def clone(self, ui):
+        '''clone(ui) -> new SodaMachine in the same state, sharing the states'''
+        machine = object.__new__(SodaMachine)
+        machine.__dict__.update(self.__dict__)
+        machine.ui = ui
+        machine.sm = self.sm.clone()
+        machine.sm.owner = machine
+        return machine
+    
     def start(self):
-        self.sm.start()
+        self._run(self.sm.start)
     
     def stop(self):
-        self.sm.stop()
+        self._run(self.sm.stop)
     
     def dispatch(self, event):
         if CoinDeposited == event:
-            self.display_msg('Last amount: $%.2f' % (event.value))
-        self.sm.stimulate(event)
+            self._run(self._show_and_stimulate, event)
+        else:
+            self._run(self.sm.post, event)
+    
+    def _show_and_stimulate(self, event):
+        self.display_msg('Last amount: $%.2f' % (event.value))
+        self.sm.post(event)
+    
+    def _run(self, step, *args):
+        # One coalesced frame per macrostep.
+        self.ui.begin_frame()
+        try:
+            step(*args)
+        finally:
+            self.ui.end_frame()
     
     def process_key(self, key):
         event = None
@@ -313,9 +395,9 @@ class SodaMachine(object):
             self.dispatch(event)
 
 
-def main(use_ncurses = False):
+def main(use_ncurses = False, max_fps = None):
     key = None
-    ui = UI(use_ncurses)
+    ui = UI(use_ncurses, max_fps)
     soda_machine = SodaMachine(ui)
     soda_machine.start()
     while key != 'q':
@@ -0,0 +1,423 @@
+'''
+Declarative machine specifications
+
+load(spec) builds an fsm.FSM or hsm.HSM from a dict, as read from JSON:
+
+    {"type": "fsm",
+     "states": [{"name": "Idle",
+                 "enter": ["soda.show_idle"]},
+                {"name": "Paying",
+                 "activities": [{"event": "soda.CoinDeposited",
+                                 "action": "soda.add_credit"}]}],
+     "initial": "Idle",
+     "transitions": [{"source": "Idle", "event": "soda.CoinDeposited",
+                      "target": "Paying", "guard": "soda.is_valid",
+                      "effect": "soda.add_credit"},
+                     {"source": "Paying", "target": "$final"}],
+     "start": ["soda.power_on"]}
+
+Functions and event classes are given by dotted name. A transition or
+activity without an event is a completion (unnamed) one. The target "$final"
+is the final state of the machine, or of the composite state containing the
+source. In an "hsm" spec a state with "states" is an hsm.CompositeState and
+"initial" names its default child, the first child otherwise. State names
+are unique in a spec.
+
+compile_spec() checks the spec, resolves every name once and turns it into
+flat tables of indexes, build() makes the State and handler objects from
+them. Making the objects is most of the cost of load(), and unpickling them
+is no faster, so there is no cache for it; a process needing many machines
+of one spec clones a loaded one.
+
+load_flat() makes a flatfsm.FlatFSM of an "fsm" spec instead. With a
+cache_dir it keeps the FlatFSM, a few arrays, pickled in a file named after
+the content hash of the spec, and a worker starting with an unchanged spec
+only unpickles it. Functions and event classes are pickled by dotted name,
+so closures and lambdas given by name work.
+
+Only flat "fsm" specs are cached. A FlatFSM has no post(), clone(), inbox or
+tracer; "hsm" specs, and machines from load(), are built on every call.
+'''
+import hashlib
+import importlib
+import io
+import json
+import os
+import tempfile
+import flatfsm
+import fsm
+import hsm
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Python 2 has no os.replace, its os.rename replaces the file on POSIX.
+_replace = getattr(os, 'replace', os.rename)
+
+# Part of the content hash, bump when the compiled tables or the pickled
+# FlatFSM change.
+COMPILER_VERSION = 2
+
+FINAL = '$final'
+
+MACHINE_TYPES = ('fsm', 'hsm')
+MACHINE_ACTIVITIES = ('start', 'stop', 'on_transition_completed')
+
+# Event codes in the compiled tables, symbols are >= 0.
+UNNAMED = -1
+ENTER = -2
+EXIT = -3
+FINAL_TARGET = -1
+NO_SYMBOL = -1
+TOP = -1
+
+_EVENTS = {UNNAMED: fsm.State.UnnamedEvent,
+           ENTER: fsm.State.EnterEvent,
+           EXIT: fsm.State.ExitEvent}
+
+_FLAT_EVENTS = {UNNAMED: flatfsm.UNNAMED,
+                ENTER: flatfsm.ENTER,
+                EXIT: flatfsm.EXIT}
+
+# Named in a pickled FlatFSM besides the symbols of its spec.
+_FIXED_NAMES = {'fsm.get_true': fsm.get_true,
+                'fsm.nop': fsm.nop,
+                'fsm.State.EnterEvent': fsm.State.EnterEvent,
+                'fsm.State.ExitEvent': fsm.State.ExitEvent,
+                'fsm.State.UnnamedEvent': fsm.State.UnnamedEvent}
+
+_resolved = {}
+
+
+class SpecError(ValueError):
+    pass
+
+
+def resolve(dotted_name):
+    '''resolve('package.module.name') -> object, cached per process'''
+    obj = _resolved.get(dotted_name)
+    if obj is None:
+        module_name, _, attr_path = dotted_name.partition('.')
+        module = importlib.import_module(module_name)
+        attrs = attr_path.split('.') if attr_path else []
+        # The longest importable prefix is the module.
+        while attrs:
+            try:
+                module = importlib.import_module(module_name + '.' + attrs[0])
+            except ImportError:
+                break
+            module_name += '.' + attrs.pop(0)
+        obj = module
+        for attr in attrs:
+            obj = getattr(obj, attr)
+        _resolved[dotted_name] = obj
+    return obj
+
+def spec_hash(spec):
+    text = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+    return _content_hash(text.encode('utf-8'))
+
+def _content_hash(data):
+    digest = hashlib.sha256(('%d:' % COMPILER_VERSION).encode('utf-8'))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class _Compiler(object):
+
+    def __init__(self, spec):
+        object.__init__(self)
+        self.spec = spec
+        self.symbols = []
+        self.symbol_ids = {}
+        self.states = []
+        self.state_ids = {}
+        self.initial = []
+        self.activities = []
+        self.transitions = []
+        self.machine_activities = []
+
+    def compile(self):
+        spec = self.spec
+        machine_type = spec.get('type', 'fsm')
+        if machine_type not in MACHINE_TYPES:
+            raise SpecError('Unknown machine type %r' % (machine_type,))
+        self.add_states(spec.get('states', []), TOP, machine_type == 'hsm')
+        self.add_initial(TOP, spec)
+        for state_spec in self.walk(spec.get('states', [])):
+            self.add_state_handlers(state_spec)
+        for transition in spec.get('transitions', []):
+            self.add_transition(transition)
+        for kind in MACHINE_ACTIVITIES:
+            for activity in spec.get(kind, []):
+                action, guard = self.get_action(activity, kind)
+                self.machine_activities.append([kind, action, guard])
+        return {'version': COMPILER_VERSION,
+                'type': machine_type,
+                'symbols': self.symbols,
+                'states': self.states,
+                'initial': self.initial,
+                'activities': self.activities,
+                'transitions': self.transitions,
+                'machine_activities': self.machine_activities}
+
+    def walk(self, state_specs):
+        for state_spec in state_specs:
+            yield state_spec
+            for child in self.walk(state_spec.get('states', [])):
+                yield child
+
+    def add_states(self, state_specs, parent, hierarchical):
+        for state_spec in state_specs:
+            name = state_spec.get('name')
+            if not name or name == FINAL:
+                raise SpecError('Invalid state name %r' % (name,))
+            if name in self.state_ids:
+                raise SpecError('Duplicate state %r' % (name,))
+            children = state_spec.get('states')
+            if children and not hierarchical:
+                raise SpecError('State %r has children in an fsm spec' % (name,))
+            state_id = len(self.states)
+            self.state_ids[name] = state_id
+            self.states.append([name, parent, bool(children)])
+            if children:
+                self.add_states(children, state_id, hierarchical)
+                self.add_initial(state_id, state_spec)
+
+    def add_initial(self, container, container_spec):
+        children = container_spec.get('states', [])
+        if not children:
+            return
+        name = container_spec.get('initial', children[0].get('name'))
+        child = self.get_state(name)
+        if self.states[child][1] != container:
+            raise SpecError('Initial state %r is not a direct child' % (name,))
+        self.initial.append([container, child])
+
+    def add_state_handlers(self, state_spec):
+        state = self.state_ids[state_spec['name']]
+        for key, event in (('enter', ENTER), ('exit', EXIT)):
+            for activity in state_spec.get(key, []):
+                action, guard = self.get_action(activity, key)
+                self.activities.append([state, event, action, guard])
+        for activity in state_spec.get('activities', []):
+            event = self.get_event(activity.get('event'))
+            action, guard = self.get_action(activity, 'activity')
+            self.activities.append([state, event, action, guard])
+
+    def add_transition(self, transition):
+        source = self.get_state(transition.get('source'))
+        target_name = transition.get('target')
+        if target_name == FINAL:
+            target = FINAL_TARGET
+        else:
+            target = self.get_state(target_name)
+        self.transitions.append([source,
+                                 self.get_event(transition.get('event')),
+                                 target,
+                                 self.get_function(transition.get('guard')),
+                                 self.get_function(transition.get('effect'))])
+
+    def get_state(self, name):
+        if name not in self.state_ids:
+            raise SpecError('Unknown state %r' % (name,))
+        return self.state_ids[name]
+
+    def get_action(self, activity, what):
+        '''An activity is a dotted name or {"action": ..., "guard": ...}.'''
+        if not isinstance(activity, dict):
+            activity = {'action': activity}
+        if not activity.get('action'):
+            raise SpecError('%s activity without action' % (what,))
+        return (self.get_function(activity['action']),
+                self.get_function(activity.get('guard')))
+
+    def get_event(self, name):
+        if name is None:
+            return UNNAMED
+        symbol = self.get_symbol(name)
+        event_cls = resolve(name)
+        if not (isinstance(event_cls, type) and issubclass(event_cls, fsm.Event)):
+            raise SpecError('%r is not an fsm.Event class' % (name,))
+        return symbol
+
+    def get_function(self, name):
+        if name is None:
+            return NO_SYMBOL
+        symbol = self.get_symbol(name)
+        if not callable(resolve(name)):
+            raise SpecError('%r is not callable' % (name,))
+        return symbol
+
+    def get_symbol(self, name):
+        symbol = self.symbol_ids.get(name)
+        if symbol is None:
+            try:
+                resolve(name)
+            except (ImportError, AttributeError, ValueError) as error:
+                raise SpecError('Cannot resolve %r: %s' % (name, error))
+            symbol = self.symbol_ids[name] = len(self.symbols)
+            self.symbols.append(name)
+        return symbol
+
+
+def compile_spec(spec):
+    '''compile_spec(spec) -> compiled tables, plain lists ready to pickle'''
+    return _Compiler(spec).compile()
+
+def build(compiled):
+    '''build(compiled) -> new, not yet started, fsm.FSM or hsm.HSM'''
+    symbols = [resolve(name) for name in compiled['symbols']]
+    hierarchical = compiled['type'] == 'hsm'
+    if hierarchical:
+        machine = hsm.HSM()
+        top = machine.top
+    else:
+        machine = top = fsm.FSM()
+
+    states = []
+    for name, parent, composite in compiled['states']:
+        if composite:
+            state = hsm.CompositeState(name=name)
+        elif hierarchical:
+            state = hsm.SimpleState(name=name)
+        else:
+            state = fsm.State(name=name)
+        (top if parent == TOP else states[parent]).add_state(state)
+        states.append(state)
+
+    for container, child in compiled['initial']:
+        (top if container == TOP else states[container]).set_initial_state(
+                                                                states[child])
+
+    def function(symbol):
+        return symbols[symbol]
+
+    def guard(symbol):
+        return fsm.get_true if symbol == NO_SYMBOL else symbols[symbol]
+
+    def event(code):
+        return _EVENTS[code] if code < 0 else symbols[code]
+
+    for state, event_code, action, guard_symbol in compiled['activities']:
+        states[state].add_activity(event(event_code),
+                                   fsm.ActivityWithGuard(guard(guard_symbol),
+                                                         function(action)))
+    for source, event_code, target, guard_symbol, effect in compiled['transitions']:
+        source = states[source]
+        if target == FINAL_TARGET:
+            target = source.parent.final if hierarchical else machine.final
+        else:
+            target = states[target]
+        effect = fsm.nop if effect == NO_SYMBOL else function(effect)
+        source.add_transition(event(event_code),
+                              fsm.TransitionWithGuardAndEffect(guard(guard_symbol),
+                                                               target, effect))
+
+    add = {'start': machine.add_start_activity,
+           'stop': machine.add_stop_activity,
+           'on_transition_completed': machine.add_on_transition_completed_activity}
+    for kind, action, guard_symbol in compiled['machine_activities']:
+        add[kind](fsm.ActivityWithGuard(guard(guard_symbol), function(action)))
+    return machine
+
+def build_flat(compiled):
+    '''build_flat(compiled) -> new, not yet started, flatfsm.FlatFSM'''
+    if compiled['type'] != 'fsm':
+        raise SpecError('Only an fsm spec makes a FlatFSM')
+    symbols = [resolve(name) for name in compiled['symbols']]
+    builder = flatfsm.FlatFSMBuilder()
+    states = [builder.add_state(name) for name, parent, composite in compiled['states']]
+    for container, child in compiled['initial']:
+        builder.set_initial_state(states[child])
+
+    def function(symbol):
+        return None if symbol == NO_SYMBOL else symbols[symbol]
+
+    def event(code):
+        return _FLAT_EVENTS[code] if code < 0 else symbols[code]
+
+    for state, event_code, action, guard in compiled['activities']:
+        builder.add_activity(states[state], event(event_code), function(action),
+                             function(guard))
+    for source, event_code, target, guard, effect in compiled['transitions']:
+        target = flatfsm.FINAL if target == FINAL_TARGET else states[target]
+        builder.add_transition(states[source], event(event_code), target,
+                               function(guard), function(effect))
+    add = {'start': builder.add_start_activity,
+           'stop': builder.add_stop_activity,
+           'on_transition_completed': builder.add_on_transition_completed_activity}
+    for kind, action, guard in compiled['machine_activities']:
+        add[kind](function(action), function(guard))
+    return builder.build()
+
+def dump_flat(machine, symbols):
+    '''dump_flat(machine, dotted names of its functions and events) -> bytes'''
+    names = dict((id(obj), name) for name, obj in _FIXED_NAMES.items())
+    for name in symbols:
+        names[id(resolve(name))] = name
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, 2)
+    pickler.persistent_id = lambda obj: names.get(id(obj))
+    pickler.dump(machine)
+    return f.getvalue()
+
+def load_flat_dump(data):
+    '''load_flat_dump(dump_flat() result) -> new flatfsm.FlatFSM'''
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = resolve
+    return unpickler.load()
+
+def _load_flat_cached(key, cache_dir, make_compiled):
+    path = os.path.join(cache_dir, key + '.pickle')
+    try:
+        with open(path, 'rb') as f:
+            return load_flat_dump(f.read())
+    except (IOError, OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError):
+        # Missing, truncated, or naming functions and classes that are gone
+        # since it was written: rebuilt and replaced.
+        pass
+    compiled = make_compiled()
+    machine = build_flat(compiled)
+    data = dump_flat(machine, compiled['symbols'])
+    # Written aside and renamed, workers starting together never read half
+    # a file.
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        _replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return machine
+
+def load(spec):
+    '''load(spec) -> new, not yet started, fsm.FSM or hsm.HSM'''
+    return build(compile_spec(spec))
+
+def load_file(path):
+    '''Load a JSON spec file.'''
+    with open(path) as f:
+        spec = json.load(f)
+    return load(spec)
+
+def load_flat(spec, cache_dir = None):
+    '''load_flat(spec, cache_dir) -> new, not yet started, flatfsm.FlatFSM
+
+    Raises SpecError for "hsm" specs, which are not flattened or cached.'''
+    if cache_dir is None:
+        return build_flat(compile_spec(spec))
+    return _load_flat_cached(spec_hash(spec), cache_dir, lambda: compile_spec(spec))
+
+def load_flat_file(path, cache_dir = None):
+    '''Load a JSON spec file as a FlatFSM, cached by the hash of its bytes.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    make_compiled = lambda: compile_spec(json.loads(data.decode('utf-8')))
+    if cache_dir is None:
+        return build_flat(make_compiled())
+    return _load_flat_cached(_content_hash(data), cache_dir, make_compiled)
@@ -0,0 +1,251 @@
+'''
+Synthetic machines for scaling benchmarks
+
+Builds fsm.FSM and hsm.HSM instances of a controlled Shape and measures
+dispatch cost and memory while one dimension of the shape is swept:
+
+    python synth.py fsm states 4 16 64 256
+    python synth.py hsm depth 0 2 4 8 --plot depth.png
+
+Shape dimensions:
+
+    states                 leaf states, not counting unnamed chain states
+    event_types            event classes the stream is drawn from
+    transitions_per_state  transitions out of each leaf, on random events
+    guard_density          fraction of transitions with a guard
+    activity_fanout        activities on each event a state handles with one
+    depth                  composite levels above the leaves (hsm only)
+    branching              composites per composite (hsm only)
+    unnamed_chain          unnamed transitions a transition out of S0 goes
+                           through before it settles
+
+In an HSM the leaves are spread over the innermost composites and the
+activities sit on the outermost composite, so every activity event bubbles
+through all the levels. The stream is drawn from every event type, handled
+or not. Memory is what tracemalloc saw allocated while the machine was
+built, None where tracemalloc is missing. Plotting needs matplotlib.
+'''
+from __future__ import print_function
+import argparse
+import random
+import fsm
+import hsm
+from bench import best_of, measure_allocated
+
+
+class Shape(object):
+    states = 8
+    event_types = 4
+    transitions_per_state = 2
+    guard_density = 0.0
+    activity_fanout = 1
+    depth = 0
+    branching = 2
+    unnamed_chain = 0
+    seed = 0
+
+    def __init__(self, **dimensions):
+        object.__init__(self)
+        for name, value in dimensions.items():
+            assert(hasattr(Shape, name))
+            setattr(self, name, value)
+        assert(self.states > 0 and self.event_types > 0 and self.branching > 0)
+
+    def replace(self, **dimensions):
+        values = self.as_dict()
+        values.update(dimensions)
+        return Shape(**values)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in DIMENSIONS + ['seed'])
+
+
+DIMENSIONS = ['states', 'event_types', 'transitions_per_state', 'guard_density',
+              'activity_fanout', 'depth', 'branching', 'unnamed_chain']
+
+_event_types = []
+
+def get_event_types(count):
+    '''get_event_types(count) -> the first count synthetic event classes'''
+    while len(_event_types) < count:
+        _event_types.append(type('Synth%d' % len(_event_types), (fsm.Event,), {}))
+    return _event_types[:count]
+
+def _guard(event):
+    return True
+
+
+class _Builder(object):
+    '''Adds the handlers of shape to a list of leaf states.'''
+
+    def __init__(self, shape):
+        object.__init__(self)
+        self.shape = shape
+        self.rng = random.Random(shape.seed)
+        self.events = get_event_types(shape.event_types)
+
+    def add_transitions(self, leaves, make_state, add_sibling):
+        shape = self.shape
+        rng = self.rng
+        chain = []
+        for i in range(shape.unnamed_chain):
+            state = make_state('C%d' % i)
+            add_sibling(leaves[0], state)
+            chain.append(state)
+        for i, source in enumerate(leaves):
+            for j in range(shape.transitions_per_state):
+                event = rng.choice(self.events)
+                target = rng.choice(leaves)
+                if i == 0 and j == 0 and chain:
+                    target = chain[0]
+                if rng.random() < shape.guard_density:
+                    transition = fsm.TransitionWithGuard(_guard, target)
+                else:
+                    transition = fsm.Transition(target)
+                source.add_transition(event, transition)
+        for state, target in zip(chain, chain[1:] + leaves[:1]):
+            state.add_transition(fsm.State.UnnamedEvent, fsm.Transition(target))
+
+    def add_activities(self, handlers):
+        '''Gives each state of handlers activity_fanout activities on one event.'''
+        for state in handlers:
+            event = self.rng.choice(self.events)
+            for i in range(self.shape.activity_fanout):
+                state.add_activity(event, fsm.Activity(fsm.nop))
+
+
+def build_fsm(shape):
+    '''build_fsm(shape) -> fsm.FSM, not started'''
+    builder = _Builder(shape)
+    leaves = [fsm.State('S%d' % i) for i in range(shape.states)]
+    sm = fsm.FSM(leaves)
+    builder.add_transitions(leaves, fsm.State,
+                            lambda sibling, state: sm.add_state(state))
+    builder.add_activities(leaves)
+    return sm
+
+def build_hsm(shape):
+    '''build_hsm(shape) -> hsm.HSM, not started'''
+    builder = _Builder(shape)
+    sm = hsm.HSM()
+    level = [sm.top]
+    for depth in range(shape.depth):
+        composites = []
+        for parent in level:
+            for i in range(shape.branching):
+                composite = hsm.CompositeState(name='D%dB%d' % (depth, len(composites)))
+                parent.add_state(composite)
+                composites.append(composite)
+            parent.set_initial_state(parent.states[0])
+        level = composites
+    leaves = []
+    for i in range(shape.states):
+        leaf = hsm.SimpleState('S%d' % i)
+        level[i % len(level)].add_state(leaf)
+        leaves.append(leaf)
+    for container in level:
+        if len(container.states):
+            container.set_initial_state(container.states[0])
+    builder.add_transitions(leaves, hsm.SimpleState,
+                            lambda sibling, state: sibling.parent.add_state(state))
+    builder.add_activities(sm.top.states if shape.depth else leaves)
+    return sm
+
+BUILDERS = {'fsm': (build_fsm, 'stimulate'),
+            'hsm': (build_hsm, 'dispatch')}
+
+
+def make_stream(shape, length = 256):
+    '''make_stream(shape, length) -> events drawn from every event type'''
+    rng = random.Random(shape.seed + 1)
+    events = [event_type() for event_type in get_event_types(shape.event_types)]
+    return [rng.choice(events) for i in range(length)]
+
+def measure_memory(build, shape):
+    '''measure_memory(build, shape) -> bytes allocated by build(shape), or None'''
+    return measure_allocated(lambda: build(shape))[1]
+
+def measure(kind, shape, count = 20, repeat = 3, length = 256):
+    '''measure(kind, shape, ...) -> {'dispatch': s per event, 'memory': bytes}'''
+    build, method_name = BUILDERS[kind]
+    sm = build(shape)
+    sm.start()
+    send = getattr(sm, method_name)
+    stream = make_stream(shape, length)
+
+    def run():
+        for event in stream:
+            send(event)
+
+    return {'dispatch': best_of(repeat, count, run) / length,
+            'memory': measure_memory(build, shape)}
+
+def sweep(kind, dimension, values, shape = None, count = 20, repeat = 3):
+    '''sweep(kind, dimension, values, shape) -> [(value, measure() result)]'''
+    assert(dimension in DIMENSIONS)
+    shape = shape or Shape()
+    return [(value, measure(kind, shape.replace(**{dimension: value}), count, repeat))
+            for value in values]
+
+def format_sweep(dimension, results):
+    lines = ['%-12s %12s %12s' % (dimension, 'dispatch us', 'memory KiB')]
+    for value, result in results:
+        memory = result['memory']
+        lines.append('%-12s %12.3f %12s'
+                     % (value, result['dispatch'] * 1e6,
+                        '-' if memory is None else '%.1f' % (memory / 1024.0)))
+    return '\n'.join(lines)
+
+def plot_sweep(kind, dimension, results, path):
+    '''Writes dispatch cost and memory against dimension to path.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    values = [value for value, result in results]
+    figure, (cost_axes, memory_axes) = pyplot.subplots(1, 2, figsize=(10, 4))
+    cost_axes.plot(values, [result['dispatch'] * 1e6 for value, result in results], 'o-')
+    cost_axes.set_xlabel(dimension)
+    cost_axes.set_ylabel('us per event')
+    memory = [result['memory'] for value, result in results]
+    if None not in memory:
+        memory_axes.plot(values, [bytes / 1024.0 for bytes in memory], 'o-')
+    memory_axes.set_xlabel(dimension)
+    memory_axes.set_ylabel('KiB built')
+    figure.suptitle('%s: %s' % (kind, dimension))
+    figure.tight_layout()
+    figure.savefig(path)
+    pyplot.close(figure)
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('kind', choices=sorted(BUILDERS))
+    parser.add_argument('dimension', choices=DIMENSIONS)
+    parser.add_argument('values', type=_number, nargs='+')
+    for name in DIMENSIONS + ['seed']:
+        parser.add_argument('--' + name.replace('_', '-'), type=_number,
+                            default=getattr(Shape, name))
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--plot', metavar='PATH', help='needs matplotlib')
+    args = parser.parse_args(argv)
+    shape = Shape(**dict((name, getattr(args, name)) for name in DIMENSIONS + ['seed']))
+    results = sweep(args.kind, args.dimension, args.values, shape,
+                    args.count, args.repeat)
+    print(format_sweep(args.dimension, results))
+    if args.plot:
+        try:
+            plot_sweep(args.kind, args.dimension, results, args.plot)
+        except ImportError:
+            parser.error('--plot needs matplotlib')
+    return results
+
+
+if __name__ == '__main__':
+    main()
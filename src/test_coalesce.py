@@ -0,0 +1,84 @@
+import unittest
+import coalesce
+import fsm
+import loadgen
+import soda
+
+
+class Level(fsm.Event):
+
+    def __new__(cls, value):
+        ev = fsm.Event.__new__(cls)
+        ev.value = value
+        return ev
+
+
+class Ping(fsm.Event): pass
+
+
+class Test(unittest.TestCase):
+
+    def test01_MergeAdjacent(self):
+        sent = []
+        coalescer = coalesce.Coalescer(sent.append, max_events=100)
+        coalescer.add_rule(soda.CoinDeposited, coalesce.sum_field('value'))
+        coalescer.add_rule(Level, coalesce.keep_last)
+        coalescer.add_rule(Ping, coalesce.drop_duplicates)
+        coins = [soda.CoinDeposited(0.25) for i in range(4)]
+        for event in coins + [Level(1), Level(3), Ping(), Ping(),
+                              soda.CoinDeposited(1.0), Ping('other')]:
+            coalescer.post(event)
+        assert(sent == [])
+        coalescer.flush()
+
+        assert([event.__class__ for event in sent] ==
+               [soda.CoinDeposited, Level, Ping, soda.CoinDeposited, Ping])
+        assert(sent[0].value == 1.0)
+        # The posted events are left as they were.
+        assert(coins[0].value == 0.25)
+        assert(sent[1].value == 3)
+        assert(sent[3].value == 1.0)
+        assert(coalescer.posted == 10 and coalescer.sent == 5)
+        assert(coalescer.get_merge_ratio() == 2.0)
+
+    def test02_Windows(self):
+        sent = []
+        coalescer = coalesce.Coalescer(sent.append, max_events=3, max_delay=1.0)
+        now = [0.0]
+        coalescer.clock = lambda: now[0]
+        coalescer.add_rule(Level, coalesce.keep_last)
+        coalescer.post(Level(1))
+        coalescer.post(Level(2))
+        assert(sent == [])
+        coalescer.post(Level(3))
+        # Count window closed.
+        assert([event.value for event in sent] == [3])
+
+        coalescer.post(Level(4))
+        now[0] = 0.5
+        coalescer.poll()
+        assert(len(sent) == 1)
+        now[0] = 1.0
+        coalescer.poll()
+        assert([event.value for event in sent] == [3, 4])
+
+    def test03_SodaBurst(self):
+        transitions = []
+        machine = soda.SodaMachine(loadgen.NullUI())
+        machine.sm.add_on_transition_completed_activity(
+                fsm.Activity(lambda event: transitions.append(machine.sm.current)))
+        machine.start()
+        coalescer = coalesce.Coalescer(machine.dispatch)
+        coalescer.add_rule(soda.CoinDeposited, coalesce.sum_field('value'))
+        for i in range(30):
+            coalescer.post(soda.CoinDeposited(0.05))
+        coalescer.post(soda.DrinkSelected())
+        coalescer.flush()
+        assert([state.get_name() for state in transitions] ==
+               ['Idle', 'WaitingForFunds', 'WaitingForSelection',
+                'Dispensing', 'RefundingChange', 'Idle'])
+        assert(machine.coin_bin == 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
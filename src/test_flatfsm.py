@@ -0,0 +1,131 @@
+import unittest
+import fsm
+import flatfsm
+
+
+class Event1(fsm.Event): pass
+class Event2(fsm.Event): pass
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.cntr = 0
+
+    def logger(self, tag):
+        def log(event=None):
+            self.log.append(tag)
+        log.__name__ = 'log_' + tag
+        return log
+
+    def incr_cntr(self, event=None):
+        self.cntr += 1
+
+    def is_cntr_gt_one(self, event=None):
+        return self.cntr > 1
+
+    def build_flat(self):
+        builder = flatfsm.FlatFSMBuilder()
+        first = builder.add_states(3, names=['S1', 'S2', 'S3'])
+        s1, s2, s3 = first, first + 1, first + 2
+        builder.set_initial_state(s1)
+        builder.add_start_activity(self.logger('start'))
+        builder.add_stop_activity(self.logger('stop'))
+        builder.add_on_transition_completed_activity(self.logger('changed'))
+        builder.add_enter_activity(s1, self.logger('enter1'))
+        builder.add_exit_activity(s1, self.logger('exit1'))
+        builder.add_enter_activity(s2, self.logger('enter2'))
+        builder.add_exit_activity(s2, self.logger('exit2'))
+        builder.add_enter_activity(s3, self.logger('enter3'))
+        builder.add_activity(s1, Event1, self.incr_cntr)
+        builder.add_transition(s1, Event1, s2, guard=self.is_cntr_gt_one,
+                               effect=self.logger('effect12'))
+        builder.add_transition(s2, Event2, s3)
+        builder.add_unnamed_transition(s3, s1)
+        return builder.build(), (s1, s2, s3)
+
+    def build_reference(self):
+        s1, s2, s3 = fsm.State('S1'), fsm.State('S2'), fsm.State('S3')
+        sm = fsm.FSM([s1, s2, s3])
+        sm.add_start_activity(fsm.Activity(self.logger('start')))
+        sm.add_stop_activity(fsm.Activity(self.logger('stop')))
+        sm.add_on_transition_completed_activity(fsm.Activity(self.logger('changed')))
+        s1.add_enter_activity(fsm.Activity(self.logger('enter1')))
+        s1.add_exit_activity(fsm.Activity(self.logger('exit1')))
+        s2.add_enter_activity(fsm.Activity(self.logger('enter2')))
+        s2.add_exit_activity(fsm.Activity(self.logger('exit2')))
+        s3.add_enter_activity(fsm.Activity(self.logger('enter3')))
+        s1.add_activity(Event1, fsm.Activity(self.incr_cntr))
+        s1.add_transition(Event1, fsm.TransitionWithGuardAndEffect(
+                                        guard=self.is_cntr_gt_one, target=s2,
+                                        effect=self.logger('effect12')))
+        s2.add_transition(Event2, fsm.Transition(s3))
+        s3.add_unnamed_transition(fsm.Transition(s1))
+        return sm, (s1, s2, s3)
+
+    def run_script(self, sm, states):
+        trace = []
+        def step(response):
+            activity, transition, target = response
+            if target is not None:
+                target = 'target'
+            current = states.index(sm.current) if sm.current in states else -1
+            trace.append((activity, transition, target, current, list(self.log)))
+        step(sm.start())
+        for event in [Event2(), Event1(), Event1(), Event2(), Event1()]:
+            step(sm.stimulate(event))
+        step(sm.stop())
+        return trace
+
+    def test01_CsrLayout(self):
+        machine, (s1, s2, s3) = self.build_flat()
+        assert(machine.num_states == 5)
+        assert(len(machine.t_offsets) == machine.num_states + 1)
+        assert(machine.t_offsets[-1] == len(machine.t_event))
+        assert(machine.a_offsets[-1] == len(machine.a_event))
+        rows = range(machine.t_offsets[s1], machine.t_offsets[s1 + 1])
+        assert([machine.t_target[i] for i in rows] == [s2])
+        rows = range(machine.t_offsets[flatfsm.INITIAL],
+                     machine.t_offsets[flatfsm.INITIAL + 1])
+        assert([machine.t_target[i] for i in rows] == [s1])
+        assert(machine.get_state_name(s3) == 'S3')
+
+    def test02_StartStop(self):
+        machine, (s1, s2, s3) = self.build_flat()
+        activity, transition, target = machine.start()
+        assert(not transition)
+        assert(None == target)
+        assert(machine.current == s1)
+        assert(self.log == ['start', 'enter1', 'changed'])
+
+        machine.stop()
+        assert(machine.current == flatfsm.FINAL)
+        assert(self.log[-2:] == ['stop', 'changed'])
+
+        response = machine.stop()
+        assert(not response.did_act_or_requested_transition())
+
+    def test03_MatchesReferenceFsm(self):
+        machine, states = self.build_flat()
+        flat_trace = self.run_script(machine, (flatfsm.INITIAL, flatfsm.FINAL) + states)
+
+        self.setUp()
+        sm, states = self.build_reference()
+        reference_trace = self.run_script(sm, (sm.initial, sm.final) + states)
+
+        assert(flat_trace == reference_trace)
+
+    def test04_UnknownEvent(self):
+        class Unknown(fsm.Event): pass
+        machine, (s1, s2, s3) = self.build_flat()
+        machine.start()
+        del self.log[:]
+        response = machine.stimulate(Unknown())
+        assert(not response.did_act_or_requested_transition())
+        assert(machine.current == s1)
+        assert(self.log == [])
+
+
+if __name__ == "__main__":
+    unittest.main()
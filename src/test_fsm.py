@@ -1,3 +1,4 @@
+import threading
 import unittest
 import fsm
 
@@ -89,6 +90,30 @@ class Test(unittest.TestCase):
         instance = fsm.Event()
         assert(fsm.Event.is_event_or_event_type(instance))
     
+    def test002_EventTypeId(self):
+        class Event1(fsm.Event): pass
+        class Event2(Event1): pass
+        ev1 = Event1()
+        ev2 = Event2()
+        
+        assert(fsm.get_event_type_id(Event1) == fsm.get_event_type_id(ev1))
+        assert(fsm.get_event_type_id(Event2) == fsm.get_event_type_id(ev2))
+        assert(fsm.get_event_type_id(ev1) != fsm.get_event_type_id(ev2))
+        assert(fsm.get_event_type(fsm.get_event_type_id(ev2)) is Event2)
+        
+        assert(fsm.get_object_class(ev1) is Event1)
+        assert(fsm.get_object_class(Event1) is Event1)
+        assert(fsm.get_object_class(None) is type(None))
+        
+        # Equality keeps subclass matching, identity does not.
+        assert(ev2 == Event1)
+        assert(ev1 == ev2)
+        assert(not ev1 == None)
+        assert(fsm.Event.is_same_type(ev1, Event1))
+        assert(fsm.Event.is_same_type(Event1, Event1))
+        assert(not fsm.Event.is_same_type(ev2, Event1))
+        assert(len(set([ev1, ev2])) == 2)
+    
     def test01_Transition(self):
         event = fsm.Event()
         state = fsm.State()
@@ -760,7 +785,590 @@ class Test(unittest.TestCase):
         assert(self.is_C_set() and self.is_D_set())
         assert(self.is_E_set() and self.is_F_set())
 
+    def test20_StateLazyHandlers(self):
+        event = fsm.Event()
+        state = fsm.State()
+        assert('activities' not in state.__dict__)
+        assert('transitions' not in state.__dict__)
+        assert(not state.has_activities_for(event))
+        assert(not state.has_transition_for(event))
+
+        activity, transition, target = state.stimulate(event)
+        assert(not activity)
+        assert(not transition)
+        assert(None == target)
+
+        state.add_activity(event, fsm.Activity(self.set_A))
+        assert(state.has_activities_for(event))
+        assert(not state.has_transition_for(event))
+        assert('transitions' not in state.__dict__)
+
+        activity, transition, target = state.stimulate(event)
+        assert(activity)
+        assert(not transition)
+        assert(self.is_A_set())
+
+    def test21_FsmStateIndex(self):
+        states = [fsm.State('S%d' % i) for i in range(1000)]
+        sm = fsm.FSM(states)
+        other = fsm.State('S0')
+        
+        assert(len(sm.states) == 1000)
+        assert(list(sm.states) == states)
+        assert(states[0] in sm and states[999] in sm)
+        assert(other not in sm)
+        assert(sm.initial not in sm and sm.final not in sm)
+        
+        assert(sm.get_state_id(states[0]) == 0)
+        assert(sm.get_state_id(states[999]) == 999)
+        assert(sm.get_state(999) is states[999])
+        assert(sm.get_state_id(sm.initial) == fsm.FSM.INITIAL_ID)
+        assert(sm.get_state(fsm.FSM.FINAL_ID) is sm.final)
+        assert(sm.get_state_by_name('S500') is states[500])
+        
+        # Registration is idempotent and ids are stable.
+        assert(sm.add_state(states[10]) == 10)
+        assert(sm.add_state(other) == 1000)
+        assert(sm.get_state_by_name('S0') is states[0])
+        assert(other in sm)
+        sm.set_initial_state(other)
+
+    def test22_FsmOwnPseudoStates(self):
+        sm1 = fsm.FSM([fsm.State()])
+        sm2 = fsm.FSM([fsm.State()])
+        assert(sm1.initial is not sm2.initial)
+        assert(sm1.final is not sm2.final)
+        
+        sm1.add_start_activity(fsm.Activity(self.set_A))
+        sm2.start()
+        assert(self.is_A_clr())
+        assert(sm2.current == sm2.states[0])
+
+    def test23_FsmStartStopCycles(self):
+        set_A = fsm.Activity(self.set_A)
+        state = fsm.State()
+        state.add_exit_activity(set_A)
+        sm = fsm.FSM([state])
+        
+        for i in range(100):
+            sm.start()
+            assert(sm.current == state)
+            self.clr_A()
+            sm.stop()
+            assert(sm.current == sm.final)
+            assert(self.is_A_set())
+        
+        # Stopping must not add transitions to the stopped state.
+        assert(state.transitions is None)
+        assert(not state.has_transition_for(fsm.State.ExitEvent))
 
+    def test24_FsmReset(self):
+        set_B = fsm.Activity(self.set_B)
+        event = fsm.Event()
+        state1 = fsm.State()
+        state2 = fsm.State()
+        state1.add_transition(event, fsm.Transition(state2))
+        state2.add_exit_activity(set_B)
+        sm = fsm.FSM([state1, state2])
+        
+        sm.start()
+        sm.stimulate(event)
+        assert(sm.current == state2)
+        assert(state2.is_active())
+        
+        sm.reset()
+        assert(sm.current == sm.initial)
+        assert(not state2.is_active())
+        assert(self.is_B_clr())
+        
+        sm.start()
+        assert(sm.current == state1)
+    
+    def test25_FsmClone(self):
+        set_A = fsm.Activity(self.set_A)
+        event = fsm.Event()
+        state1 = fsm.State('state1')
+        state2 = fsm.State('state2')
+        state1.add_transition(event, fsm.Transition(state2))
+        state2.add_transition(event, fsm.Transition(state1))
+        prototype = fsm.FSM([state1, state2])
+        prototype.context = {'count': 1}
+        prototype.start()
+        
+        sm = prototype.clone()
+        assert(sm.current == state1)
+        assert(sm.states is prototype.states)
+        assert(sm.context == prototype.context)
+        assert(sm.context is not prototype.context)
+        
+        sm.stimulate(event)
+        assert(sm.current == state2)
+        assert(prototype.current == state1)
+        assert(sm.is_state_active(state2) and not sm.is_state_active(state1))
+        assert(prototype.is_state_active(state1) and not prototype.is_state_active(state2))
+        # Active while any clone is in the state, a reset only takes its own
+        # machine out.
+        assert(state1.is_active() and state2.is_active())
+        other = prototype.clone()
+        other.reset()
+        assert(state1.is_active() and prototype.current is state1)
+        
+        # Changed through the machine, the clone gets its own states.
+        sm.add_on_transition_completed_activity(set_A)
+        assert(sm.states is prototype.states)
+        sm.add_stop_activity(set_A)
+        assert(sm.states is not prototype.states)
+        assert(not state2.is_active() and sm.current.is_active())
+        assert(sm.current is sm.get_state_by_name('state2'))
+        assert(sm.current is not state2)
+        
+        sm.stimulate(event)
+        assert(sm.current is sm.get_state_by_name('state1'))
+        assert(self.is_A_set())
+        self.clr_A()
+        prototype.stimulate(event)
+        prototype.stop()
+        assert(self.is_A_clr())
+        assert(prototype.current == prototype.final)
+        assert(sm.current is sm.get_state_by_name('state1'))
+
+    
+    def test26_SharedResponses(self):
+        set_A = fsm.Activity(self.set_A)
+        event = fsm.Event()
+        state1 = fsm.State()
+        state2 = fsm.State()
+        assert(state1.stimulate(event) is fsm.NO_RESPONSE)
+        state1.add_activity(event, set_A)
+        assert(state1.stimulate(event) is fsm.ACTED_RESPONSE)
+        state1.add_transition(event, fsm.Transition(state2))
+        response = state1.stimulate(event)
+        assert(response == (True, True, state2))
+        assert(response.get_flags() == fsm.ACTED | fsm.TRANSITION_REQUESTED)
+        assert(fsm.NO_RESPONSE.get_flags() == 0)
+        assert(fsm.StimulusResponse.from_flags(fsm.ACTED) is fsm.ACTED_RESPONSE)
+        assert(fsm.StimulusResponse.from_flags(fsm.TRANSITION_REQUESTED, state2)
+               == (False, True, state2))
+
+    
+    def test27_FsmPost(self):
+        class Go(fsm.Event): pass
+        class Count(fsm.Event): pass
+        log = []
+        
+        def build():
+            state1 = fsm.State('state1')
+            state2 = fsm.State('state2')
+            state3 = fsm.State('state3')
+            state1.add_transition(Go, fsm.TransitionWithEffect(
+                    target=state2, effect=lambda event: log.append('effect')))
+            state2.add_enter_activity(fsm.Activity(lambda event: log.append('enter2')))
+            state2.add_unnamed_transition(fsm.Transition(state3))
+            state3.add_activity(Count, fsm.Activity(lambda event: log.append('count')))
+            state3.add_transition(Go, fsm.TransitionWithGuard(guard=fsm.get_false,
+                                                              target=state1))
+            sm = fsm.FSM([state1, state2, state3])
+            sm.add_on_transition_completed_activity(
+                    fsm.Activity(lambda event: log.append('changed')))
+            return sm
+        
+        expected = []
+        sm = build()
+        sm.start()
+        for event in [Go(), Count(), Go(), fsm.Event()]:
+            sm.stimulate(event)
+        sm.stop()
+        expected = list(log)
+        
+        del log[:]
+        sm = build()
+        assert(sm.post(fsm.State.EnterEvent) is sm.get_state_by_name('state1'))
+        assert(sm.post(Go()) is sm.get_state_by_name('state3'))
+        assert(sm.post(Count()) is sm.get_state_by_name('state3'))
+        sm.post(Go())
+        sm.post(fsm.Event())
+        sm.stop()
+        assert(log == expected)
+        assert(log == ['changed', 'effect', 'enter2', 'changed', 'changed',
+                       'count', 'changed'])
+
+    
+    def test28_FsmInternalQueue(self):
+        class Go(fsm.Event): pass
+        class Next(fsm.Event): pass
+        class Outside(fsm.Event): pass
+        log = []
+        state1 = fsm.State('state1')
+        state2 = fsm.State('state2')
+        state3 = fsm.State('state3')
+        sm = fsm.FSM([state1, state2, state3])
+        
+        def go_effect(event):
+            # Neither runs before the transition to state2 completes.
+            sm.stimulate(Outside())
+            sm.self_post(Next())
+            log.append(('effect', sm.get_queued_count()))
+        
+        state1.add_transition(Go, fsm.TransitionWithEffect(target=state2,
+                                                           effect=go_effect))
+        state2.add_enter_activity(fsm.Activity(lambda event: log.append('enter2')))
+        state2.add_transition(Next, fsm.Transition(state3))
+        state2.add_activity(Outside, fsm.Activity(lambda event: log.append('outside2')))
+        state3.add_activity(Outside, fsm.Activity(lambda event: log.append('outside3')))
+        state3.add_enter_activity(fsm.Activity(lambda event: log.append('enter3')))
+        
+        sm.start()
+        sm.stimulate(Go())
+        assert(sm.current == state3)
+        assert(sm.get_queued_count() == 0)
+        # FIFO: Outside was sent first.
+        assert(log == [('effect', 2), 'enter2', 'outside2', 'enter3'])
+        
+        # Self posted events first.
+        sm.reset()
+        sm.internal_first = True
+        del log[:]
+        sm.start()
+        assert(sm.post(Go()) == state3)
+        assert(log == [('effect', 2), 'enter2', 'enter3', 'outside3'])
+        
+        # Outside of a macrostep self_post runs at once.
+        sm.reset()
+        sm.start()
+        assert(sm.self_post(Next()) == state1)
+
+    
+    def test29_FsmPriorityInbox(self):
+        class Data(fsm.Event):
+            priority = fsm.LOW_PRIORITY
+        class Cancel(fsm.Event):
+            priority = fsm.HIGH_PRIORITY
+        log = []
+        running = fsm.State('running')
+        cancelled = fsm.State('cancelled')
+        running.add_activity(Data, fsm.Activity(lambda event: log.append(event.name)))
+        running.add_transition(Cancel, fsm.Transition(cancelled))
+        sm = fsm.FSM([running, cancelled])
+        sm.start()
+        
+        for i in range(3):
+            sm.enqueue(Data('d%d' % i))
+        sm.enqueue(fsm.Event('e'))
+        sm.enqueue(Cancel())
+        assert(sm.get_inbox().get_depths() == [1, 1, 3])
+        assert(sm.get_queued_count() == 5)
+        assert(sm.run_queued() == cancelled)
+        assert(log == [])
+        assert(sm.get_queued_count() == 0)
+        stats = sm.get_inbox().as_dict()
+        assert(stats['max_depths'] == [1, 1, 3])
+        assert(stats['enqueued'] == [1, 1, 3])
+        
+        # Per event priority, and one lower lane event after every two.
+        sm.reset()
+        sm.configure_inbox(lanes=2, bursts=[2, 1])
+        sm.start()
+        for name in ['l1', 'l2', 'l3']:
+            sm.enqueue(Data(name))
+        for name in ['h1', 'h2', 'h3', 'h4', 'h5']:
+            sm.enqueue(Data(name, priority=fsm.HIGH_PRIORITY))
+        sm.run_queued()
+        assert(log == ['h1', 'h2', 'l1', 'h3', 'h4', 'l2', 'h5', 'l3'])
+        
+        # No lane waits for more than one round of bursts.
+        inbox = fsm.Inbox(3, [2, 2, 2])
+        for lane in (0, 1, 2):
+            for i in range(4):
+                inbox.append(fsm.Event('%d%d' % (lane, i), priority=lane))
+        served = [inbox.popleft().name for i in range(12)]
+        assert(served == ['00', '01', '10', '11', '20', '21',
+                          '02', '03', '12', '13', '22', '23'])
+
+
+    def test30_FsmMemoryReport(self):
+        class Go(fsm.Event): pass
+        one = fsm.State('one')
+        two = fsm.State('two')
+        sm = fsm.FSM([one, two])
+        report = sm.memory_report()
+        assert(set(report) == set(fsm.MEMORY_COMPONENTS + ('total',)))
+        assert(report['total'] == sum(report[name] for name in fsm.MEMORY_COMPONENTS))
+        assert(report['handlers'] > 0 and report['events'] == 0)
+        
+        # Handlers added, queued events and ExitEvent transitions to final
+        # each show in their component.
+        one.add_activity(Go, fsm.Activity(fsm.nop))
+        sm.final.add_final_transition_to_other(two)
+        sm.enqueue(Go())
+        grown = sm.memory_report()
+        assert(grown['handlers'] > report['handlers'])
+        assert(grown['handler_dicts'] > report['handler_dicts'])
+        assert(grown['final_transitions'] > 0)
+        assert(grown['events'] > 0)
+        assert(sm.memory_report() == grown)
+
+    def test31_FsmExclusiveTransitions(self):
+        class Reading(fsm.Event): pass
+        low = fsm.State('low')
+        high = fsm.State('high')
+        levels = []
+        for state in (low, high):
+            state.add_transition(Reading, fsm.TransitionWithGuard(
+                    lambda event: event.name == 'low', low))
+            state.add_transition(Reading, fsm.TransitionWithGuard(
+                    lambda event: event.name == 'high', high))
+            state.set_exclusive_transitions(Reading, resort_every=4)
+            state.add_enter_activity(fsm.Activity(
+                    lambda event, state=state: levels.append(state.name)))
+        sm = fsm.FSM([low, high])
+        sm.start()
+        transitions = low.transitions.list_dict[Reading]
+        assert(isinstance(transitions, fsm.ExclusiveTransitionList))
+        assert([t.target for t in transitions] == [low, high])
+        
+        for name in ['high'] * 5:
+            sm.stimulate(Reading(name))
+        sm.post(Reading('low'))
+        sm.post(Reading('none'))
+        # Taken most, tried first, with the same outcomes.
+        transitions = high.transitions.list_dict[Reading]
+        assert([t.target for t in transitions] == [high, low])
+        assert(levels == ['low'] + ['high'] * 5 + ['low'])
+        assert(sm.current == low)
+        
+        copy = transitions.copy()
+        copy.hits[0] = 0
+        assert(transitions.hits[0] > 0)
+
+    def test32_FsmIndependentActivities(self):
+        class Done(object):
+            def __init__(self, error): self.error = error
+            def result(self):
+                if self.error is not None:
+                    raise self.error
+            def exception(self): return self.error
+            def add_done_callback(self, callback): callback(self)
+        class InlineExecutor(object):
+            def submit(self, fn, *args):
+                try:
+                    fn(*args)
+                except Exception as error:
+                    return Done(error)
+                return Done(None)
+        def fail(event):
+            raise ValueError(event)
+        log = []
+        executor = InlineExecutor()
+        idle = fsm.State('idle')
+        busy = fsm.State('busy')
+        busy.add_enter_activity(fsm.Activity(lambda event: log.append('inline')))
+        busy.add_enter_activity(fsm.IndependentActivity(
+                lambda event: log.append(event), executor))
+        busy.add_enter_activity(fsm.IndependentActivity(fail, executor))
+        busy.add_enter_activity(fsm.IndependentActivity(fail, executor,
+                                                        guard=fsm.get_false))
+        forgotten = fsm.IndependentActivity(fail, executor, wait=False)
+        busy.add_exit_activity(forgotten)
+        class Go(fsm.Event): pass
+        idle.add_transition(Go, fsm.Transition(busy))
+        sm = fsm.FSM([idle, busy])
+        sm.start()
+        
+        # Every activity ran before the errors came out together.
+        try:
+            sm.stimulate(Go())
+            assert(False)
+        except fsm.ActivityErrors as errors:
+            assert([e.__class__ for e in errors.errors] == [ValueError])
+        assert(log[0] == 'inline' and len(log) == 2)
+        assert(sm.current == busy)
+        assert(busy.exit() is fsm.ACTED_RESPONSE)
+        assert(len(forgotten.errors) == 1)
+        assert(forgotten.errors.maxlen == fsm.IndependentActivity.max_errors)
+        # In a machine the error goes to the machine that ran the activity.
+        failures = []
+        class Back(fsm.Event): pass
+        busy.add_transition(Back, fsm.Transition(idle))
+        idle.add_activity(fsm.ActivityFailed,
+                          fsm.Activity(lambda event: failures.append(event)))
+        clone = sm.clone()
+        clone.stimulate(Back())
+        # Taken in by the macrostep that ran the activity.
+        assert(clone.get_queued_count() == 0 and sm.get_queued_count() == 0)
+        assert(len(forgotten.errors) == 1)
+        assert(len(failures) == 1 and isinstance(failures[0].error, ValueError))
+        assert(failures[0].event is fsm.State.ExitEvent)
+        # Handed over between macrosteps, by another thread, the next one
+        # takes it in.
+        clone.post_threadsafe(fsm.ActivityFailed(ValueError(), Back))
+        clone.post(Back())
+        assert(len(failures) == 2 and clone.get_queued_count() == 0)
+        
+        # A failed enter activity does not stop the transition half way, the
+        # errors come out once the macrostep is complete.
+        completed = []
+        a, b, c = fsm.State('a'), fsm.State('b'), fsm.State('c')
+        a.add_transition(Go, fsm.Transition(b))
+        b.add_enter_activity(fsm.IndependentActivity(fail, executor))
+        b.add_unnamed_transition(fsm.Transition(c))
+        sm = fsm.FSM([a, b, c])
+        sm.add_on_transition_completed_activity(
+                fsm.Activity(lambda event: completed.append(sm.current)))
+        for send in ('stimulate', 'post'):
+            sm.reset()
+            sm.start()
+            del completed[:]
+            self.assertRaises(fsm.ActivityErrors, getattr(sm, send), Go())
+            assert(sm.current == c and completed == [b, c])
+            assert(not sm._busy)
+        
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            return
+        # Three activities that can only finish together.
+        barrier = threading.Barrier(3, timeout=5)
+        pool = ThreadPoolExecutor(3)
+        ready = fsm.State('ready')
+        for i in range(3):
+            ready.add_enter_activity(fsm.IndependentActivity(
+                    lambda event: log.append(barrier.wait()), pool))
+        sm = fsm.FSM([ready])
+        sm.start()
+        assert(sorted(log[-3:]) == [0, 1, 2])
+        pool.shutdown()
+
+    def test33_FsmAsyncEffect(self):
+        class Later(object):
+            '''Runs the submitted calls when told to.'''
+            def __init__(self): self.calls = []
+            def submit(self, fn, *args):
+                future = Done(fn, args)
+                self.calls.append(future)
+                return future
+        class Done(object):
+            def __init__(self, fn, args):
+                self.fn, self.args, self.callbacks = fn, args, []
+            def add_done_callback(self, callback): self.callbacks.append(callback)
+            def run(self):
+                for callback in self.callbacks:
+                    callback(self)
+            def result(self): return self.fn(*self.args)
+        class Fetch(fsm.Event): pass
+        class Ping(fsm.Event): pass
+        def fetch(event):
+            if event.name == 'bad':
+                raise IOError('unreachable')
+            return 42
+        log = []
+        executor = Later()
+        idle = fsm.State('idle')
+        fetching = fsm.State('fetching')
+        sm = fsm.FSM([idle, fetching])
+        idle.add_transition(Fetch, fsm.TransitionWithAsyncEffect(
+                fetching, fetch, sm.post_threadsafe, executor))
+        fetching.add_activity(Ping, fsm.Activity(lambda event: log.append('ping')))
+        fetching.add_transition(fsm.EffectDone, fsm.TransitionWithEffect(
+                idle, lambda event: log.append(event.result)))
+        fetching.add_transition(fsm.EffectFailed, fsm.TransitionWithEffect(
+                idle, lambda event: log.append(event.error.__class__)))
+        sm.start()
+        
+        # The machine moves on and handles events while fetch is pending.
+        assert(sm.post(Fetch()) == fetching)
+        assert(sm.stimulate(Ping()) is fsm.ACTED_RESPONSE)
+        executor.calls.pop().run()
+        assert(sm.current == fetching and sm.get_queued_count() == 1)
+        assert(sm.run_queued() == idle)
+        sm.post(Fetch('bad'))
+        executor.calls.pop().run()
+        assert(sm.run_queued() == idle)
+        assert(log == ['ping', 42, IOError])
+        
+        # Without send, each clone gets the completions of its own effects.
+        idle.clear_transitions(Fetch)
+        idle.add_transition(Fetch, fsm.TransitionWithAsyncEffect(fetching, fetch,
+                                                                 executor=executor))
+        clone = sm.clone()
+        assert(clone.post(Fetch()) == fetching and sm.current == idle)
+        executor.calls.pop().run()
+        assert(clone.get_queued_count() == 1 and sm.get_queued_count() == 0)
+        assert(clone.run_queued() == idle and log[-1] == 42)
+        
+        try:
+            import asyncio
+        except ImportError:
+            return
+        loop = asyncio.new_event_loop()
+        transition = fsm.TransitionWithAsyncEffect(
+                fetching, lambda event: asyncio.sleep(0, result=7))
+        idle.clear_transitions(Fetch)
+        idle.add_transition(Fetch, transition)
+        loop.call_soon(sm.post, Fetch())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert(sm.current == idle and log[-1] == 7)
+        
+        # A cancelled effect fails.
+        pending = loop.create_future()
+        idle.clear_transitions(Fetch)
+        idle.add_transition(Fetch, fsm.TransitionWithAsyncEffect(
+                fetching, lambda event: pending))
+        loop.call_soon(sm.post, Fetch())
+        loop.call_soon(pending.cancel)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert(sm.current == idle and issubclass(log[-1], asyncio.CancelledError))
+        loop.close()
+        
+        # Outside a running loop the effect could never run.
+        self.assertRaises(RuntimeError, sm.post, Fetch())
+        assert(sm.current == idle and not sm._busy)
+
+    def test34_FsmMachineHandlers(self):
+        class Coin(fsm.Event): pass
+        def count(machine, event):
+            machine.context['coins'] += 1
+        def full(machine, event):
+            return machine.context['coins'] >= 2
+        empty = fsm.State('empty')
+        paid = fsm.State('paid')
+        prototype = fsm.FSM([empty, paid])
+        prototype.context = {'coins': 0}
+        empty.add_activity(Coin, fsm.MachineActivity(count))
+        empty.add_transition(Coin, fsm.MachineTransition(paid, guard=full))
+        prototype.start()
+        
+        sm = prototype.clone()
+        sm.stimulate(Coin())
+        assert(sm.context == {'coins': 1} and prototype.context == {'coins': 0})
+        sm.post(Coin())
+        assert(sm.current == paid and prototype.current == empty)
+        # A state stimulated on its own is given the machine explicitly.
+        response = empty.stimulate(Coin(), prototype)
+        assert(response.did_act() and not response.was_transition_requested())
+        assert(prototype.context == {'coins': 1})
+
+    def test35_FsmStopDuringMacrostep(self):
+        class Halt(fsm.Event): pass
+        class Later(fsm.Event): pass
+        log = []
+        def halt(machine, event):
+            machine.self_post(Later())
+            assert(machine.stop() is None)
+            # Still in the macrostep, nothing stopped yet.
+            assert(machine.current is running)
+        running = fsm.State('running')
+        running.add_activity(Halt, fsm.MachineActivity(halt))
+        running.add_activity(Later, fsm.Activity(lambda event: log.append('later')))
+        running.add_exit_activity(fsm.Activity(lambda event: log.append('exit')))
+        for send in ('stimulate', 'post'):
+            del log[:]
+            sm = fsm.FSM([running])
+            sm.start()
+            getattr(sm, send)(Halt())
+            # Stopped once the macrostep completed, before the queued event.
+            assert(sm.current is sm.final)
+            assert(log[0] == 'exit' and 'later' not in log)
+            assert(not sm.get_queued_count())
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,40 @@
+import random
+import unittest
+import fuzz
+
+
+class Test(unittest.TestCase):
+
+    def test01_BackendsAgree(self):
+        assert(fuzz.fuzz(seed=1, runs=30) == [])
+
+    def test02_Shrink(self):
+        # A backend dropping every E2 must be caught and cut down to the
+        # one activity it skips.
+        def broken(case, log):
+            driver = fuzz.fsm_post(case, log)
+            send = driver.send
+            driver.send = lambda event: (None if isinstance(event, fuzz.EVENT_TYPES[2])
+                                         else send(event))
+            return driver
+        case = fuzz.generate_case(random.Random(3), max_events=50)
+        case['activities'].append([0, 2, None])
+        case['events'].append(2)
+        assert(fuzz.check_case(case, broken) is not None)
+        small = fuzz.shrink(case, broken)
+        assert(fuzz.check_case(small, broken) is not None)
+        assert(small['events'] == [2])
+        assert(len(small['activities']) == 1 and small['transitions'] == [])
+        assert(fuzz.case_size(small) < fuzz.case_size(case))
+
+    def test03_CaseRoundTrip(self):
+        case = fuzz.generate_case(random.Random(7), hierarchical=True)
+        trace = fuzz.run_case(case, fuzz.hsm_reference)
+        assert(trace == fuzz.run_case(case, fuzz.hsm_reference))
+        assert(trace[-1][0] == 'state')
+        assert(fuzz.remove_state(case, len(case['parents']) - 1) is not None)
+        assert('events:' in fuzz.format_case(case))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import fsm
 import hsm
 
 class HSMTester(unittest.TestCase):
@@ -281,6 +282,202 @@ class HSMTester(unittest.TestCase):
         assert(None == response.get_target())
         assert(self.is_A_set() and self.is_B_set())
         
+
+    def test05_HsmStartStopCycles(self):
+        set_A = hsm.Activity(self.set_A)
+        sm = hsm.HSM()
+        sm.add_stop_activity(set_A)
+        
+        for i in range(100):
+            self.clr_A()
+            sm.start()
+            assert(sm.current == sm.top.final)
+            assert(self.is_A_set())
+            sm.stop()
+            assert(sm.current == sm.top.final)
+        
+        assert(not sm.top.final.has_transition_for(hsm.SimpleState.ExitEvent))
+        
+        sm.reset()
+        assert(sm.current == sm.top.initial)
+        assert(not sm.top.final.is_active())
+    
+    def test06_HsmClone(self):
+        set_A = hsm.Activity(self.set_A)
+        event = hsm.Event()
+        state1 = hsm.SimpleState('state1')
+        state2a = hsm.SimpleState('state2a')
+        state2 = hsm.CompositeState(name='state2')
+        state2.add_state(state2a)
+        state2.set_initial_state(state2a)
+        prototype = hsm.HSM()
+        prototype.top.add_states([state1, state2])
+        prototype.top.set_initial_state(state1)
+        state1.add_transition(event, hsm.Transition(state2))
+        prototype.start()
+        assert(prototype.current == state1)
+        
+        sm = prototype.clone()
+        sm.dispatch(event)
+        assert(sm.current == state2a)
+        assert(sm.is_state_active(state2) and sm.is_state_active(state2a))
+        assert(not sm.is_state_active(state1) and not sm.is_state_active(sm.top))
+        assert(prototype.current == state1)
+        assert(prototype.is_state_active(state1) and not prototype.is_state_active(state2))
+        # The state level query of a composite is not shadowed by the machine
+        # one, and holds while any clone is in the state.
+        assert(state2.is_active() and state1.is_active())
+        other = prototype.clone()
+        other.reset()
+        assert(state1.is_active() and prototype.is_state_active(state1))
+        other.start()
+        other.dispatch(event)
+        other.reset()
+        # Resetting one clone leaves the composite the other is in as it was.
+        assert(state2.is_active() and state2a.is_active())
+        assert(sm.current is state2a and sm.is_state_active(state2))
+        
+        sm.add_stop_activity(set_A)
+        assert(sm.top is not prototype.top)
+        assert(sm.current is not state2a)
+        assert(sm.current.parent is sm.top.get_state_by_name('state2'))
+        assert(sm.get_active_path() == (1, 0))
+        sm.stop()
+        assert(self.is_A_set())
+        assert(sm.current == sm.top.final)
+        self.clr_A()
+        prototype.stop()
+        assert(self.is_A_clr())
+    
+    def test07_HsmResponseFlags(self):
+        state1 = hsm.SimpleState()
+        state2 = hsm.SimpleState()
+        responses = hsm.StimulusResponseDict({state1: fsm.NO_RESPONSE})
+        assert(not responses.did_act_or_requested_transition())
+        responses[state2] = fsm.ACTED_RESPONSE
+        assert(responses.did_act() and not responses.was_transition_requested())
+        other = hsm.StimulusResponseDict({state1: fsm.StimulusResponse(False, True,
+                                                                       state2)})
+        responses.add_response_dict(other)
+        assert(responses.did_act() and responses.was_transition_requested())
+        # Replacing a response takes its flags back.
+        responses[state2] = fsm.NO_RESPONSE
+        assert(not responses.did_act() and responses.was_transition_requested())
+        responses.add_response_dict(hsm.StimulusResponseDict({state1: fsm.ACTED_RESPONSE}))
+        assert(responses.did_act() and not responses.was_transition_requested())
+        del responses[state1]
+        assert(not responses.did_act_or_requested_transition())
+        # The other mutating dict methods keep the flags as well.
+        requested = fsm.StimulusResponse(False, True, state2)
+        responses.update({state1: requested})
+        assert(responses.was_transition_requested())
+        assert(responses.pop(state1) is requested)
+        assert(not responses.did_act_or_requested_transition())
+        assert(responses.setdefault(state1, fsm.ACTED_RESPONSE) is fsm.ACTED_RESPONSE)
+        assert(responses.setdefault(state1, requested) is fsm.ACTED_RESPONSE)
+        assert(responses.did_act() and not responses.was_transition_requested())
+        responses.update([(state2, requested)])
+        assert(responses.did_act() and responses.was_transition_requested())
+        responses.popitem()
+        responses.popitem()
+        assert(not responses.did_act_or_requested_transition())
+        responses.update({state1: requested})
+        responses.clear()
+        assert(not responses.did_act_or_requested_transition())
+    
+    def test08_HsmSelfAndParentTransitions(self):
+        set_A = hsm.Activity(self.set_A)
+        set_B = hsm.Activity(self.set_B)
+        set_C = hsm.Activity(self.set_C)
+        class Again(hsm.Event): pass
+        class Up(hsm.Event): pass
+        again = Again()
+        up = Up()
+        child = hsm.SimpleState('child')
+        parent = hsm.CompositeState(name='parent')
+        parent.add_state(child)
+        parent.set_initial_state(child)
+        sm = hsm.HSM()
+        sm.top.add_state(parent)
+        sm.top.set_initial_state(parent)
+        child.add_transition(again, hsm.Transition(child))
+        child.add_transition(up, hsm.Transition(parent))
+        child.add_exit_activity(set_A)
+        parent.add_exit_activity(set_B)
+        parent.add_enter_activity(set_C)
+        sm.start()
+        assert(sm.current == child)
+        
+        # Self transition: child is left and entered again.
+        self.clr_C()
+        activity, transition, target = sm.dispatch(again)
+        assert(sm.current == child)
+        assert(self.is_A_set() and self.is_B_clr() and self.is_C_clr())
+        
+        # To the parent: both are left, the parent is entered again and
+        # continues to its initial child.
+        self.clr_A()
+        sm.dispatch(up)
+        assert(sm.current == child)
+        assert(self.is_A_set() and self.is_B_set() and self.is_C_set())
+    
+    def test09_HsmPost(self):
+        class Tick(hsm.Event): pass
+        class Toggle(hsm.Event): pass
+        set_A = hsm.Activity(self.set_A)
+        set_B = hsm.Activity(self.set_B)
+        left = hsm.SimpleState('left')
+        right = hsm.SimpleState('right')
+        inner = hsm.CompositeState(name='inner')
+        inner.add_states([left, right])
+        inner.set_initial_state(left)
+        sm = hsm.HSM()
+        sm.top.add_state(inner)
+        sm.top.set_initial_state(inner)
+        inner.add_activity(Tick, set_A)
+        left.add_transition(Toggle, hsm.Transition(right))
+        right.add_exit_activity(set_B)
+        right.add_unnamed_transition(hsm.TransitionWithGuard(guard=self.is_A_set,
+                                                             target=left))
+        
+        assert(sm.post(hsm.SimpleState.EnterEvent) is left)
+        self.clr_A()
+        self.clr_B()
+        assert(sm.post(Toggle()) is right)
+        assert(self.is_B_clr())
+        # Bubbles to the activity of inner, no transition.
+        assert(sm.post(Tick()) is right)
+        assert(self.is_A_set())
+        # The completion transition only runs after a transition.
+        assert(sm.post(hsm.Event()) is right)
+        sm.dispatch(hsm.SimpleState.UnnamedEvent)
+        assert(sm.current is left)
+        assert(self.is_B_set())
+    
+    def test10_HsmInternalQueue(self):
+        class Go(hsm.Event): pass
+        class Back(hsm.Event): pass
+        state1 = hsm.SimpleState('state1')
+        state2 = hsm.SimpleState('state2')
+        sm = hsm.HSM()
+        sm.top.add_states([state1, state2])
+        sm.top.set_initial_state(state1)
+        visits = []
+        
+        def bounce(event):
+            visits.append(sm.current.get_name())
+            if len(visits) < 5:
+                sm.self_post(Go() if sm.current is state1 else Back())
+        
+        state1.add_transition(Go, hsm.Transition(state2))
+        state2.add_transition(Back, hsm.Transition(state1))
+        sm.add_on_transition_completed_activity(hsm.Activity(bounce))
+        sm.start()
+        # The transition from the initial state starts the bouncing, each
+        # step runs after the previous one completed, without nesting.
+        assert(visits == ['state1', 'state2', 'state1', 'state2', 'state1'])
+        assert(sm.current is state1)
+        assert(sm.get_queued_count() == 0)
     
     def _test02_FsmInitWithSingleChild(self):
         set_A = hsm.Activity(self.set_A)
@@ -436,6 +633,211 @@ class HSMTester(unittest.TestCase):
         assert(not state.is_active())
 
 
+    def test11_HsmMemoryReport(self):
+        inner = hsm.CompositeState(name='inner')
+        leaf = hsm.SimpleState('leaf')
+        inner.add_state(leaf)
+        inner.set_initial_state(leaf)
+        sm = hsm.HSM()
+        sm.top.add_state(inner)
+        sm.top.set_initial_state(inner)
+        flat = hsm.HSM()
+        flat.top.add_state(hsm.SimpleState('leaf'))
+        sm.start()
+        flat.start()
+        report = sm.memory_report()
+        assert(report['total'] == sum(report[name] for name in fsm.MEMORY_COMPONENTS))
+        # The composite brings pseudo states, an index and handlers.
+        assert(report['states'] > flat.memory_report()['states'])
+        sm.stop()
+        sm.start()
+        assert(sm.memory_report()['total'] == report['total'])
+
+    def test12_HsmStateNumbering(self):
+        def composite(name, children):
+            state = hsm.CompositeState(name=name)
+            for child in children:
+                state.add_state(child)
+            state.set_initial_state(children[0])
+            return state
+        a1 = hsm.SimpleState('a1')
+        a2 = hsm.SimpleState('a2')
+        b1 = hsm.SimpleState('b1')
+        a = composite('a', [a1, a2])
+        b = composite('b', [b1])
+        sm = hsm.HSM()
+        sm.top.add_state(a)
+        sm.top.add_state(b)
+        sm.top.set_initial_state(a)
+        # Unnumbered until started, answers are the same either way.
+        assert(a1.numbering is None and a1.is_parent(a) and a1.is_parent(sm.top))
+        sm.start()
+        numbering = sm.top.numbering
+        assert(numbering is not None and a1.numbering is numbering)
+        assert(a1.is_parent(a) and a1.is_parent(sm.top) and a.initial.is_parent(a))
+        assert(not a1.is_parent(b) and not a.is_parent(a1) and not a1.is_parent(a1))
+        assert(a1.depth == 2 and hsm.get_common_ancestor(a1, a2) is a)
+        assert(hsm.get_common_ancestor(a1, b1) is sm.top)
+        assert(hsm.get_common_ancestor(a1, a) is a)
+        assert(sm.is_state_active(a1) and sm.is_state_active(a) and not sm.is_state_active(b))
+        
+        # Added states fit in the gap, until it is used up.
+        added = []
+        while numbering.renumbered == 1:
+            state = hsm.SimpleState('b%d' % (len(added) + 2))
+            b.add_state(state)
+            added.append(state)
+            assert(state.is_parent(b) and not state.is_parent(a))
+        assert(len(added) > 1)
+        for state in added:
+            assert(state.is_parent(b) and not state.is_parent(a) and state.depth == 2)
+        
+        # States of another tree are never taken for relatives.
+        other = hsm.HSM()
+        other.top.add_state(hsm.SimpleState('a1'))
+        other.start()
+        assert(not other.current.is_parent(a) and not a1.is_parent(other.top))
+
+    def test13_HsmDispatchRules(self):
+        class Ping(hsm.Event): pass
+        class Go(hsm.Event): pass
+        log = []
+        def record(text):
+            return hsm.Activity(lambda event=None: log.append(text))
+        child = hsm.SimpleState('child')
+        parent = hsm.CompositeState(name='parent')
+        parent.add_state(child)
+        parent.set_initial_state(child)
+        first = hsm.SimpleState('first')
+        second = hsm.SimpleState('second')
+        other = hsm.CompositeState(name='other')
+        other.add_states([first, second])
+        other.set_initial_state(first)
+        sm = hsm.HSM()
+        sm.top.add_states([parent, other])
+        sm.top.set_initial_state(parent)
+        parent.add_activity(Ping, record('parent ping'))
+        parent.add_transition(Go, hsm.Transition(other))
+        parent.add_enter_activity(record('parent enter'))
+        parent.add_exit_activity(record('parent exit'))
+        child.add_enter_activity(record('child enter'))
+        child.add_exit_activity(record('child exit'))
+        # Only taken when the composite itself is current, never bubbled to.
+        parent.add_unnamed_transition(hsm.Transition(other))
+        first.add_enter_activity(record('first enter'))
+        first.add_unnamed_transition(hsm.Transition(second))
+        second.add_enter_activity(record('second enter'))
+        
+        # Entering a composite continues to its initial child, the enter
+        # and unnamed events of the child do not reach the parent.
+        sm.start()
+        assert(sm.current is child)
+        assert(log == ['parent enter', 'child enter'])
+        
+        # An event the child ignores bubbles to the parent.
+        del log[:]
+        assert(sm.dispatch(Ping()) == (True, False, None))
+        assert(sm.current is child and log == ['parent ping'])
+        
+        # A transition bubbled to the parent exits the child first, enters
+        # the target composite and runs to completion through unnamed
+        # transitions.
+        del log[:]
+        sm.dispatch(Go())
+        assert(sm.current is second)
+        assert(log == ['child exit', 'parent exit', 'first enter', 'second enter'])
+        
+        # Nothing left to bubble to.
+        del log[:]
+        assert(sm.dispatch(Ping()) == fsm.NO_RESPONSE and log == [])
+
+    def test14_HsmInternalTransitionBubbles(self):
+        class Ping(hsm.Event): pass
+        log = []
+        child = hsm.SimpleState('child')
+        parent = hsm.CompositeState(name='parent')
+        parent.add_state(child)
+        parent.set_initial_state(child)
+        sm = hsm.HSM()
+        sm.top.add_state(parent)
+        sm.top.set_initial_state(parent)
+        # A transition without target neither acts nor requests a
+        # transition, the parent still gets the event.
+        child.add_transition(Ping, hsm.TransitionWithGuardAndEffect(
+                guard=self.is_A_clr, target=None,
+                effect=lambda event: log.append('child effect')))
+        parent.add_activity(Ping, hsm.Activity(lambda event: log.append('parent activity')))
+        sm.start()
+        assert(sm.dispatch(Ping()) == (True, False, None))
+        assert(log == ['child effect', 'parent activity'])
+        del log[:]
+        assert(sm.post(Ping()) is child)
+        assert(log == ['child effect', 'parent activity'])
+        # An activity of the child does keep it.
+        del log[:]
+        child.add_activity(Ping, hsm.Activity(lambda event: log.append('child activity')))
+        response = sm.dispatch(Ping())
+        assert(response.did_act() and not response.was_transition_requested())
+        assert(log == ['child activity', 'child effect'])
+        del log[:]
+        sm.post(Ping())
+        assert(log == ['child activity', 'child effect'])
+
+    def test15_HsmHierarchyWiring(self):
+        class Go(hsm.Event): pass
+        log = []
+        def record(text):
+            return hsm.Activity(lambda event=None: log.append(text))
+        first = hsm.SimpleState('first')
+        second = hsm.SimpleState('second')
+        parent = hsm.CompositeState(name='parent')
+        parent.add_states([first, second])
+        parent.set_initial_state(first)
+        sm = hsm.HSM()
+        sm.top.add_state(parent)
+        sm.top.set_initial_state(parent)
+        # Children, and the pseudo states of the composite, know their parent.
+        for state in (first, second, parent.initial, parent.final):
+            assert(state.parent is parent)
+        assert(parent.parent is sm.top)
+        
+        parent.add_exit_activity(record('parent exit'))
+        first.add_exit_activity(record('first exit'))
+        second.add_enter_activity(record('second enter'))
+        first.add_transition(Go, hsm.Transition(second))
+        # Not taken by the same Go, the machine goes on with completion
+        # transitions only.
+        second.add_transition(Go, hsm.Transition(first))
+        sm.start()
+        sm.dispatch(Go())
+        # The exit event of the child is not passed up to the parent.
+        assert(sm.current is second)
+        assert(log == ['first exit', 'second enter'])
+        del log[:]
+        sm.post(Go())
+        assert(sm.current is first and log == [])
+
+    def test16_HsmStopDuringMacrostep(self):
+        class Halt(hsm.Event): pass
+        log = []
+        def halt(machine, event):
+            assert(machine.stop() is None)
+            assert(machine.current is child)
+        child = hsm.SimpleState('child')
+        parent = hsm.CompositeState(name='parent')
+        parent.add_state(child)
+        parent.set_initial_state(child)
+        sm = hsm.HSM()
+        sm.top.add_state(parent)
+        sm.top.set_initial_state(parent)
+        parent.add_activity(Halt, hsm.MachineActivity(halt))
+        child.add_exit_activity(hsm.Activity(lambda event: log.append('child exit')))
+        parent.add_exit_activity(hsm.Activity(lambda event: log.append('parent exit')))
+        sm.start()
+        sm.dispatch(Halt())
+        assert(sm.current is sm.top.final)
+        assert(log[0] == 'child exit' and 'parent exit' in log)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
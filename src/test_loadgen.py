@@ -0,0 +1,48 @@
+import unittest
+import loadgen
+
+
+class Test(unittest.TestCase):
+
+    def test01_GenerateKeys(self):
+        keys = loadgen.generate_keys(3, 2000)
+        assert(keys == loadgen.generate_keys(3, 2000))
+        assert(keys != loadgen.generate_keys(4, 2000))
+        coins = len([k for k in keys if k in loadgen.COIN_KEYS])
+        selects = keys.count(loadgen.SELECT_KEY)
+        returns = keys.count(loadgen.RETURN_KEY)
+        assert(coins + selects + returns == 2000)
+        assert(coins > selects > returns > 0)
+
+        only_coins = loadgen.generate_keys(3, 100, {'coin': 1.0})
+        assert(all(k in loadgen.COIN_KEYS for k in only_coins))
+
+    def test02_Percentile(self):
+        values = list(range(1, 101))
+        assert(loadgen.percentile(values, 50) == 50)
+        assert(loadgen.percentile(values, 99) == 99)
+        assert(loadgen.percentile([], 50) == 0.0)
+
+    def test03_Run(self):
+        report = loadgen.run(5, 200, seed=1)
+        assert(report.machines == 5)
+        assert(report.events == 1000)
+        assert(report.transitions > 0)
+        assert(report.get_events_per_second() > 0)
+        assert(report.latency_percentiles[50] <= report.latency_percentiles[99])
+        assert(report.latency_percentiles[99] <= report.max_latency)
+        assert('transitions/s' in report.format())
+
+        again = loadgen.run(5, 200, seed=1)
+        assert(again.transitions == report.transitions)
+
+    def test04_BufferingUI(self):
+        ui = loadgen.BufferingUI()
+        report = loadgen.run(1, 50, seed=2, ui_factory=lambda: ui)
+        assert(report.events == 50)
+        assert('Keys' in ui.lines)
+        assert(any(line.startswith('New state: ') for line in ui.lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+import fsm
+import hsm
+import persistence
+
+
+class Toggle(fsm.Event): pass
+
+
+def build_toggle(key):
+    off = fsm.State('Off')
+    on = fsm.State('On')
+    sm = fsm.FSM([off, on])
+    sm.context = {'flips': 0}
+
+    def flip(event):
+        sm.context['flips'] += 1
+
+    off.add_transition(Toggle, fsm.TransitionWithEffect(target=on, effect=flip))
+    on.add_transition(Toggle, fsm.TransitionWithEffect(target=off, effect=flip))
+    return sm
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'machines.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test01_BatchedWrites(self):
+        store = persistence.SQLitePersistence(self.path, flush_every=10,
+                                              flush_interval=3600)
+        machines = {}
+        for key in ['a', 'b', 'c']:
+            machines[key] = build_toggle(key)
+            store.track(key, machines[key])
+            machines[key].start()
+        # Three starts, one transition each.
+        assert(store.flush_count == 0)
+        assert(store.load_all() == {})
+
+        for i in range(7):
+            machines['a'].stimulate(Toggle())
+        # Ten transitions: one transaction for the three dirty machines.
+        assert(store.flush_count == 1)
+        assert(store.rows_written == 3)
+        assert(store.load_all() == {'a': (1, {'flips': 7}),
+                                    'b': (0, {'flips': 0}),
+                                    'c': (0, {'flips': 0})})
+
+        machines['b'].stimulate(Toggle())
+        store.close()
+
+        store = persistence.SQLitePersistence(self.path)
+        recovered = store.recover(build_toggle)
+        assert(sorted(recovered.keys()) == ['a', 'b', 'c'])
+        assert(recovered['b'].current.get_name() == 'On')
+        assert(recovered['b'].context == {'flips': 1})
+
+        # Recovered machines are tracked again.
+        recovered['c'].stimulate(Toggle())
+        store.flush()
+        assert(store.load_all()['c'] == (1, {'flips': 1}))
+
+        store.forget('a')
+        recovered['a'].stimulate(Toggle())
+        store.close()
+        assert('a' not in persistence.SQLitePersistence(self.path).load_all())
+
+    def test02_FlushInterval(self):
+        store = persistence.SQLitePersistence(self.path, flush_every=1000,
+                                              flush_interval=0.5)
+        now = [0.0]
+        store.clock = lambda: now[0]
+        store.last_flush = 0.0
+        sm = build_toggle('x')
+        store.track('x', sm)
+        sm.start()
+        assert(store.flush_count == 0)
+        now[0] = 1.0
+        store.poll()
+        assert(store.flush_count == 1)
+        assert(store.load_all() == {'x': (0, {'flips': 0})})
+        store.close()
+
+    def test03_HsmActivePath(self):
+        store = persistence.SQLitePersistence(self.path)
+        sm = hsm.HSM()
+        store.track('h', sm)
+        sm.start()
+        store.flush()
+        assert(store.load_all() == {'h': ((fsm.FSM.FINAL_ID,), None)})
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
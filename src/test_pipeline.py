@@ -0,0 +1,118 @@
+import io
+import os
+import threading
+import time
+import unittest
+import fsm
+import pipeline
+
+
+class Deposit(fsm.Event):
+
+    def __new__(cls, value):
+        ev = fsm.Event.__new__(cls)
+        ev.value = value
+        return ev
+
+
+class Refund(fsm.Event): pass
+
+
+def make_codecs():
+    codecs = pipeline.CodecTable()
+    codecs.register(b'D', Deposit,
+                    decode=lambda payload: Deposit(int(payload)),
+                    encode=lambda event: str(event.value).encode('ascii'))
+    codecs.register(b'R', Refund)
+    return codecs
+
+
+class Till(object):
+
+    def __init__(self, key, delay = 0.0):
+        self.key = key
+        self.delay = delay
+        self.deposits = []
+        self.refunds = 0
+        idle = fsm.State('Idle')
+        self.sm = fsm.FSM([idle])
+        idle.add_activity(Deposit, fsm.Activity(self.deposit))
+        idle.add_activity(Refund, fsm.Activity(self.refund))
+        self.sm.start()
+
+    def deposit(self, event):
+        if self.delay:
+            time.sleep(self.delay)
+        self.deposits.append(event.value)
+
+    def refund(self, event):
+        self.refunds += 1
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tills = {}
+        self.lock = threading.Lock()
+
+    def till_for_key(self, key, delay = 0.0):
+        with self.lock:
+            if key not in self.tills:
+                self.tills[key] = Till(key, delay)
+            return self.tills[key].sm
+
+    def test01_CodecRoundTrip(self):
+        codecs = make_codecs()
+        line = codecs.encode('k1', Deposit(25))
+        assert(line == b'D k1 25\n')
+        key, event = codecs.decode(line.rstrip(b'\n'))
+        assert(key == 'k1')
+        assert(isinstance(event, Deposit) and event.value == 25)
+        key, event = codecs.decode(b'R k2')
+        assert(key == 'k2' and isinstance(event, Refund))
+        self.assertRaises(ValueError, codecs.decode, b'X k1 1')
+
+    def test02_RouteAndDispatch(self):
+        codecs = make_codecs()
+        data = b''.join(codecs.encode('k%d' % (i % 5), Deposit(i))
+                        for i in range(1000))
+        data += b'R k1\nbogus line\nR k3'
+        stages = pipeline.Pipeline(codecs, self.till_for_key, num_workers=3,
+                                   batch_size=64, read_size=1000)
+        stats = stages.run(io.BytesIO(data))
+
+        assert(sorted(self.tills.keys()) == ['k0', 'k1', 'k2', 'k3', 'k4'])
+        for i in range(5):
+            # Per key order is preserved.
+            assert(self.tills['k%d' % i].deposits == list(range(i, 1000, 5)))
+        assert(self.tills['k1'].refunds == 1 and self.tills['k3'].refunds == 1)
+        assert(stats['decode']['items'] == 1002)
+        assert(stats['decode']['errors'] == 1)
+        assert(sum(stats['dispatch%d' % i]['items'] for i in range(3)) == 1002)
+        assert(stats['read']['throughput'] > 0)
+
+    def test03_Backpressure(self):
+        codecs = make_codecs()
+        read_fd, write_fd = os.pipe()
+        data = b''.join(codecs.encode('slow', Deposit(i)) for i in range(20))
+
+        def produce():
+            os.write(write_fd, data)
+            os.close(write_fd)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        stages = pipeline.Pipeline(codecs,
+                                   lambda key: self.till_for_key(key, 0.005),
+                                   queue_size=1, batch_size=1)
+        with os.fdopen(read_fd, 'rb') as stream:
+            stats = stages.run(stream)
+        producer.join()
+
+        assert(self.tills['slow'].deposits == list(range(20)))
+        # The reader waited on the full queue of the slow worker.
+        assert(stats['read']['blocked_time'] > 0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
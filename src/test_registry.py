@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+import fsm
+import hsm
+import registry
+
+
+class Coin(fsm.Event):
+
+    def __new__(cls, value):
+        ev = fsm.Event.__new__(cls)
+        ev.value = value
+        return ev
+
+
+class Reset(fsm.Event): pass
+
+
+def build_counter(key):
+    empty = fsm.State('Empty')
+    holding = fsm.State('Holding')
+    sm = fsm.FSM([empty, holding])
+    sm.context = {'total': 0}
+
+    def add(event):
+        sm.context['total'] += event.value
+
+    def clear(event):
+        sm.context['total'] = 0
+
+    empty.add_transition(Coin, fsm.TransitionWithEffect(target=holding, effect=add))
+    holding.add_activity(Coin, fsm.Activity(add))
+    holding.add_transition(Reset, fsm.TransitionWithEffect(target=empty, effect=clear))
+    return sm
+
+
+class Test(unittest.TestCase):
+
+    def test01_LruEviction(self):
+        machines = registry.MachineRegistry(build_counter, capacity=2)
+        machines.dispatch('a', Coin(1))
+        machines.dispatch('b', Coin(2))
+        machines.dispatch('a', Coin(3))
+        machines.dispatch('c', Coin(4))
+
+        # 'b' was the least recently used one.
+        assert(machines.is_hot('a') and machines.is_hot('c'))
+        assert(not machines.is_hot('b'))
+        assert('b' in machines)
+        assert(len(machines) == 3)
+        assert(machines.store['b'] == (1, {'total': 2}))
+
+        sm = machines.get('b')
+        assert(sm.current.get_name() == 'Holding')
+        assert(sm.current.is_active())
+        assert(sm.context == {'total': 2})
+        machines.dispatch('b', Coin(5))
+        assert(sm.context == {'total': 7})
+        machines.dispatch('b', Reset())
+        assert(sm.current.get_name() == 'Empty')
+
+        stats = machines.stats
+        assert(stats.lookups == 7)
+        assert(stats.hits == 3)
+        assert(stats.creations == 3)
+        assert(stats.rehydrations == 1)
+        assert(stats.evictions == 2)
+        assert(stats.get_hit_rate() == 3.0 / 7)
+        assert(stats.as_dict()['mean_rehydration_time'] >= 0.0)
+
+    def test02_ShelfStore(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'sessions')
+            store = registry.open_shelf_store(path)
+            machines = registry.MachineRegistry(build_counter, capacity=1,
+                                                store=store)
+            for i in range(10):
+                machines.dispatch('session%d' % i, Coin(i))
+            machines.flush()
+            store.close()
+
+            store = registry.open_shelf_store(path)
+            machines = registry.MachineRegistry(build_counter, capacity=1,
+                                                store=store)
+            assert(machines.get('session7').context == {'total': 7})
+            assert(machines.get('session0').current.get_name() == 'Holding')
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test03_HsmSnapshot(self):
+        sm = hsm.HSM()
+        sm.context = 'ctx'
+        sm.start()
+        snapshot = sm.get_snapshot()
+        assert(snapshot == ((fsm.FSM.FINAL_ID,), 'ctx'))
+
+        other = hsm.HSM()
+        other.restore_snapshot(snapshot)
+        assert(other.current is other.top.final)
+        assert(other.context == 'ctx')
+
+
+if __name__ == "__main__":
+    unittest.main()
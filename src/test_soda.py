@@ -0,0 +1,113 @@
+import unittest
+import soda
+
+
+class RecordingUI(soda.UI):
+
+    def __init__(self, max_fps = None):
+        soda.UI.__init__(self, use_ncurses=False, max_fps=max_fps)
+        self.lines = []
+
+    def stdout_set_screen_ready(self):
+        self.lines.append('Keys')
+
+    def stdout_display_state(self, state):
+        self.lines.append('state ' + state)
+
+    def stdout_display_msg(self, msg):
+        self.lines.append('msg ' + msg)
+
+    def stdout_display_msg2(self, msg):
+        self.lines.append('msg2 ' + msg)
+
+    def stdout_display_credit(self, credit):
+        self.lines.append('credit %.2f' % credit)
+
+
+class Test(unittest.TestCase):
+
+    def test01_ImmediateOutsideFrames(self):
+        ui = RecordingUI()
+        ui.display_msg('a')
+        ui.display_msg('b')
+        assert(ui.lines == ['msg a', 'msg b'])
+        assert(ui.frames_drawn == 0)
+
+    def test02_OneFramePerDispatch(self):
+        ui = RecordingUI()
+        machine = soda.SodaMachine(ui)
+        machine.start()
+        assert(ui.lines == ['Keys', 'state Idle'])
+        assert(ui.frames_drawn == 1)
+
+        del ui.lines[:]
+        machine.process_key('t')
+        # Idle -> WaitingForFunds -> WaitingForSelection, each state change
+        # and credit update coalesced to its last value.
+        assert(ui.frames_drawn == 2)
+        assert(ui.lines == ['state WaitingForSelection', 'msg Last amount: $2.00',
+                            'msg2  ', 'credit 2.00'])
+
+        del ui.lines[:]
+        machine.process_key('s')
+        # Dispensing -> RefundingChange -> Idle in a single frame.
+        assert(ui.frames_drawn == 3)
+        assert(ui.lines == ['Keys', 'state Idle', 'msg Drink dispensed ($1.50)',
+                            'msg2 Refunding change $0.50', 'credit 0.00'])
+
+    def test03_RateCap(self):
+        ui = RecordingUI(max_fps=0.001)
+        machine = soda.SodaMachine(ui)
+        machine.start()
+        assert(ui.frames_drawn == 1)
+        machine.process_key('1')
+        machine.process_key('2')
+        # Held back by the rate cap and merged.
+        assert(ui.frames_drawn == 1)
+        del ui.lines[:]
+        ui.flush()
+        assert(ui.frames_drawn == 2)
+        assert(ui.lines == ['state WaitingForFunds', 'msg Last amount: $0.25',
+                            'msg2  ', 'credit 0.35'])
+
+    def test04_Clone(self):
+        prototype_ui = RecordingUI()
+        prototype = soda.SodaMachine(prototype_ui)
+        prototype.start()
+        prototype.process_key('l')
+
+        ui = RecordingUI()
+        machine = prototype.clone(ui)
+        assert(machine.sm.states is prototype.sm.states)
+        assert(machine.sm.current.get_name() == 'WaitingForFunds')
+        del prototype_ui.lines[:]
+        machine.process_key('l')
+        assert(prototype_ui.lines == [])
+        assert(ui.lines == ['state WaitingForSelection', 'msg Last amount: $1.00',
+                            'credit 2.00'])
+        assert(machine.coin_bin == 2.0 and prototype.coin_bin == 1.0)
+        assert(prototype.sm.current.get_name() == 'WaitingForFunds')
+
+    def test05_DriveFsmDirectly(self):
+        prototype = soda.SodaMachine(RecordingUI())
+        prototype.start()
+        ui = RecordingUI()
+        machine = prototype.clone(ui)
+        # The handlers act on the machine that dispatches, however it is
+        # driven, completion transitions included.
+        machine.sm.stimulate(soda.CoinDeposited(1.0))
+        assert(machine.coin_bin == 1.0 and prototype.coin_bin == 0.0)
+        assert(machine.sm.current.get_name() == 'WaitingForFunds')
+        machine.sm.enqueue(soda.CoinDeposited(1.0))
+        machine.sm.run_queued()
+        assert(machine.sm.current.get_name() == 'WaitingForSelection')
+        machine.sm.post(soda.DrinkSelected())
+        assert(machine.sm.current.get_name() == 'Idle')
+        assert('msg2 Refunding change $0.50' in ui.lines)
+        assert(ui.lines[-1] == 'state Idle')
+        assert(machine.coin_bin == 0.0 and prototype.coin_bin == 0.0)
+        assert(prototype.sm.current.get_name() == 'Idle')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import fsm
+import hsm
+import spec
+
+
+class Coin(fsm.Event): pass
+
+
+class Select(fsm.Event): pass
+
+
+class Cancel(fsm.Event): pass
+
+
+# Looked up through spec.resolve(), this file may also run as __main__.
+LOG = []
+
+def log(name):
+    def record(event):
+        spec.resolve('test_spec.LOG').append(name)
+    record.__name__ = name
+    return record
+
+enter_idle = log('enter_idle')
+exit_idle = log('exit_idle')
+enter_paying = log('enter_paying')
+enter_vending = log('enter_vending')
+exit_selling = log('exit_selling')
+count_coin = log('count_coin')
+vend = log('vend')
+power_on = log('power_on')
+power_off = log('power_off')
+
+def never(event):
+    return False
+
+def make(event_name):
+    return spec.resolve('test_spec.' + event_name)()
+
+
+SODA = {'type': 'fsm',
+        'states': [{'name': 'Idle',
+                    'enter': ['test_spec.enter_idle'],
+                    'exit': ['test_spec.exit_idle']},
+                   {'name': 'Paying',
+                    'enter': ['test_spec.enter_paying'],
+                    'activities': [{'event': 'test_spec.Coin',
+                                    'action': 'test_spec.count_coin'}]},
+                   {'name': 'Vending',
+                    'enter': ['test_spec.enter_vending']}],
+        'initial': 'Idle',
+        'transitions': [{'source': 'Idle', 'event': 'test_spec.Coin',
+                         'target': 'Paying', 'effect': 'test_spec.count_coin'},
+                        {'source': 'Paying', 'event': 'test_spec.Select',
+                         'target': 'Idle', 'guard': 'test_spec.never'},
+                        {'source': 'Paying', 'event': 'test_spec.Select',
+                         'target': 'Vending', 'effect': 'test_spec.vend'},
+                        {'source': 'Vending', 'target': 'Idle'}],
+        'start': ['test_spec.power_on'],
+        'stop': ['test_spec.power_off']}
+
+NESTED = {'type': 'hsm',
+          'states': [{'name': 'Idle'},
+                     {'name': 'Selling',
+                      'exit': ['test_spec.exit_selling'],
+                      'initial': 'Paying',
+                      'states': [{'name': 'Vending'},
+                                 {'name': 'Paying'}]}],
+          'transitions': [{'source': 'Idle', 'event': 'test_spec.Coin',
+                           'target': 'Selling'},
+                          {'source': 'Paying', 'event': 'test_spec.Select',
+                           'target': 'Vending'},
+                          {'source': 'Selling', 'event': 'test_spec.Cancel',
+                           'target': 'Idle'},
+                          {'source': 'Vending', 'target': '$final'}]}
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        del spec.resolve('test_spec.LOG')[:]
+
+    def test01_LoadFsm(self):
+        log = spec.resolve('test_spec.LOG')
+        sm = spec.load(SODA)
+        assert(isinstance(sm, fsm.FSM))
+        sm.start()
+        assert(sm.current.get_name() == 'Idle')
+        sm.stimulate(make('Coin'))
+        sm.stimulate(make('Coin'))
+        assert(sm.current.get_name() == 'Paying')
+        sm.stimulate(make('Select'))
+        # Vending completes back to Idle.
+        assert(sm.current.get_name() == 'Idle')
+        sm.stop()
+        # Effects run before the source state is left.
+        assert(log == ['power_on', 'enter_idle', 'count_coin', 'exit_idle',
+                       'enter_paying', 'count_coin', 'vend', 'enter_vending',
+                       'enter_idle', 'exit_idle', 'exit_idle', 'power_off'])
+
+    def test02_LoadHsm(self):
+        log = spec.resolve('test_spec.LOG')
+        sm = spec.load(NESTED)
+        assert(isinstance(sm, hsm.HSM))
+        sm.start()
+        assert(sm.current.get_name() == 'Idle')
+        sm.dispatch(make('Coin'))
+        # Entering the composite continues to its declared initial child.
+        assert(sm.current.get_name() == 'Paying')
+        assert(sm.current.parent.get_name() == 'Selling')
+        # Cancel is handled by the parent of Paying.
+        sm.dispatch(make('Cancel'))
+        assert(sm.current.get_name() == 'Idle')
+        assert(log == ['exit_selling'])
+        sm.dispatch(make('Coin'))
+        sm.dispatch(make('Select'))
+        assert(sm.current is sm.current.parent.final)
+        assert(sm.get_active_path() == (1, fsm.FSM.FINAL_ID))
+
+    def test03_FlatCache(self):
+        log = spec.resolve('test_spec.LOG')
+        directory = tempfile.mkdtemp()
+        try:
+            sm = spec.load_flat(SODA, directory)
+            path = os.path.join(directory, spec.spec_hash(SODA) + '.pickle')
+            assert(os.listdir(directory) == [os.path.basename(path)])
+
+            # The cache is read, not rewritten.
+            with open(path, 'rb') as f:
+                cached = f.read()
+            os.utime(path, (0, 0))
+            cached_sm = spec.load_flat(SODA, directory)
+            with open(path, 'rb') as f:
+                assert(f.read() == cached)
+            assert(os.stat(path).st_mtime == 0)
+
+            # Both run as the object machine does.
+            for machine in (sm, cached_sm):
+                del log[:]
+                machine.start()
+                assert(machine.get_state_name(machine.current) == 'Idle')
+                machine.stimulate(make('Coin'))
+                machine.stimulate(make('Coin'))
+                machine.stimulate(make('Select'))
+                assert(machine.get_state_name(machine.current) == 'Idle')
+                machine.stop()
+                assert(log == ['power_on', 'enter_idle', 'count_coin', 'exit_idle',
+                               'enter_paying', 'count_coin', 'vend', 'enter_vending',
+                               'enter_idle', 'exit_idle', 'exit_idle', 'power_off'])
+
+            changed = dict(SODA, initial='Paying')
+            assert(spec.spec_hash(changed) != spec.spec_hash(SODA))
+            sm = spec.load_flat(changed, directory)
+            sm.start()
+            assert(sm.get_state_name(sm.current) == 'Paying')
+            assert(len(os.listdir(directory)) == 2)
+
+            spec_path = os.path.join(directory, 'soda.json')
+            with open(spec_path, 'w') as f:
+                json.dump(SODA, f)
+            spec.load_flat_file(spec_path, directory)
+            sm = spec.load_flat_file(spec_path, directory)
+            assert(len(os.listdir(directory)) == 4)
+            sm.start()
+            assert(sm.get_state_name(sm.current) == 'Idle')
+            self.assertRaises(spec.SpecError, spec.load_flat, NESTED)
+        finally:
+            shutil.rmtree(directory)
+
+    def test04_Errors(self):
+        bad_specs = [{'type': 'pda'},
+                     {'states': [{'name': 'A'}, {'name': 'A'}]},
+                     {'states': [{'name': 'A', 'states': [{'name': 'B'}]}]},
+                     {'states': [{'name': 'A'}], 'initial': 'B'},
+                     {'states': [{'name': 'A'}],
+                      'transitions': [{'source': 'A', 'target': 'B'}]},
+                     {'states': [{'name': 'A'}],
+                      'transitions': [{'source': 'A', 'target': 'A',
+                                       'event': 'test_spec.vend'}]},
+                     {'states': [{'name': 'A'}],
+                      'transitions': [{'source': 'A', 'target': 'A',
+                                       'guard': 'test_spec.missing'}]}]
+        for bad in bad_specs:
+            self.assertRaises(spec.SpecError, spec.compile_spec, bad)
+
+    def test05_StaleFlatCache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, spec.spec_hash(SODA) + '.pickle')
+            fresh = spec.dump_flat(spec.load_flat(SODA),
+                                   spec.compile_spec(SODA)['symbols'])
+            # Dumps naming what no longer resolves, and a truncated one.
+            for name in ('test_spec.removed_function', 'removed_module.vend'):
+                gone = object()
+                stream = io.BytesIO()
+                pickler = spec.pickle.Pickler(stream, 2)
+                pickler.persistent_id = lambda obj: name if obj is gone else None
+                pickler.dump([gone])
+                for data in (stream.getvalue(), fresh[:len(fresh) // 2]):
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                    sm = spec.load_flat(SODA, directory)
+                    sm.start()
+                    assert(sm.get_state_name(sm.current) == 'Idle')
+                    with open(path, 'rb') as f:
+                        assert(f.read() == fresh)
+                    assert(os.listdir(directory) == [os.path.basename(path)])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
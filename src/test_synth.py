@@ -0,0 +1,43 @@
+import unittest
+import hsm
+import synth
+
+
+class Test(unittest.TestCase):
+
+    def test01_FsmShape(self):
+        shape = synth.Shape(states=10, event_types=3, transitions_per_state=2,
+                            unnamed_chain=3)
+        sm = synth.build_fsm(shape)
+        names = [state.get_name() for state in sm.states]
+        assert(len([name for name in names if name.startswith('S')]) == 10)
+        assert(len([name for name in names if name.startswith('C')]) == 3)
+        sm.start()
+        for event in synth.make_stream(shape, 100):
+            sm.stimulate(event)
+        # Chain states are passed through, never settled in.
+        assert(sm.current.get_name().startswith('S'))
+        assert(shape.replace(states=4).states == 4 and shape.states == 10)
+
+    def test02_HsmShape(self):
+        shape = synth.Shape(states=9, depth=2, branching=3, activity_fanout=2)
+        sm = synth.build_hsm(shape)
+        sm.start()
+        assert(len(sm.current.get_parent_stack()) == 4)
+        assert(isinstance(sm.current, hsm.SimpleState))
+        for event in synth.make_stream(shape, 100):
+            sm.dispatch(event)
+        assert(len(sm.current.get_parent_stack()) == 4)
+
+    def test03_Sweep(self):
+        results = synth.sweep('hsm', 'depth', [0, 1], synth.Shape(states=4),
+                              count=1, repeat=1)
+        assert([value for value, result in results] == [0, 1])
+        for value, result in results:
+            assert(result['dispatch'] > 0)
+            assert(result['memory'] is None or result['memory'] > 0)
+        assert('depth' in synth.format_sweep('depth', results))
+
+
+if __name__ == "__main__":
+    unittest.main()
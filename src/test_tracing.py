@@ -0,0 +1,174 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+import fsm
+import hsm
+import tracing
+
+
+class Toggle(fsm.Event): pass
+
+
+class Test(unittest.TestCase):
+
+    def build_fsm(self):
+        self.on = fsm.State('On')
+        self.off = fsm.State('Off')
+        self.off.add_transition(Toggle, fsm.Transition(self.on))
+        self.on.add_transition(Toggle, fsm.Transition(self.off))
+        return fsm.FSM([self.off, self.on])
+
+    def test01_RecordTransitions(self):
+        sm = self.build_fsm()
+        tracer = tracing.TransitionTracer(capacity=8)
+        machine_id = tracer.attach(sm)
+        sm.start()
+        sm.stimulate(Toggle())
+        sm.stimulate(Toggle())
+
+        records = tracer.get_records()
+        # Initial -> Off on start, then two toggles.
+        assert(len(records) == 3)
+        names = [(tracer.get_state_name(r[2]), tracer.get_state_name(r[4]))
+                 for r in records]
+        assert(names == [('InitialState', 'Off'), ('Off', 'On'), ('On', 'Off')])
+        for (timestamp, mid, source, event_id, target,
+             react_time, transition_time) in records:
+            assert(mid == machine_id)
+            assert(react_time >= 0 and transition_time >= 0)
+        assert(fsm.get_event_type(records[1][3]) is Toggle)
+
+    def test02_RingBufferAndSampling(self):
+        sm = self.build_fsm()
+        tracer = tracing.TransitionTracer(capacity=4, sample_every=2)
+        tracer.attach(sm)
+        sm.start()
+        for i in range(20):
+            sm.stimulate(Toggle())
+
+        # 21 transitions, every second one sampled.
+        assert(tracer.count == 10)
+        assert(tracer.get_dropped_count() == 6)
+        records = tracer.get_records()
+        assert(len(records) == 4)
+        timestamps = [r[0] for r in records]
+        assert(timestamps == sorted(timestamps))
+
+        tracer.detach(sm)
+        sm.stimulate(Toggle())
+        assert(tracer.count == 10)
+
+    def test03_Export(self):
+        sm = self.build_fsm()
+        tracer = tracing.TransitionTracer()
+        tracer.attach(sm)
+        sm.start()
+        sm.stimulate(Toggle())
+
+        trace = tracer.to_chrome_trace()
+        complete = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        assert(len(complete) == 2)
+        assert(complete[1]['name'] == 'Off -> On')
+        assert(complete[1]['cat'] == 'Toggle')
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            tracer.export_chrome_trace(path)
+            with open(path) as stream:
+                assert(json.load(stream) == json.loads(json.dumps(trace)))
+        finally:
+            os.remove(path)
+
+        stream = io.BytesIO()
+        tracer.dump_binary(stream)
+        stream.seek(0)
+        records, names = tracing.load_binary(stream)
+        assert(records == tracer.get_records())
+        assert(names == tracer.state_names)
+
+    def test04_Hsm(self):
+        sm = hsm.HSM()
+        tracer = tracing.TransitionTracer()
+        tracer.attach(sm)
+        sm.start()
+        records = tracer.get_records()
+        assert(len(records) == 1)
+        assert(tracer.get_state_name(records[0][4]) == 'FinalState')
+
+    def test05_LeafTargetsAndStop(self):
+        sm = hsm.HSM()
+        composite = hsm.CompositeState(name='Composite')
+        leaf = hsm.SimpleState('Leaf')
+        composite.add_state(leaf)
+        composite.set_initial_state(leaf)
+        other = hsm.SimpleState('Other')
+        sm.top.add_states([other, composite])
+        sm.top.set_initial_state(other)
+        other.add_transition(Toggle, hsm.Transition(composite))
+        tracer = tracing.TransitionTracer()
+        tracer.attach(sm)
+        sm.start()
+        sm.dispatch(Toggle())
+        sm.stop()
+
+        names = [(tracer.get_state_name(r[2]), tracer.get_state_name(r[4]))
+                 for r in tracer.get_records()]
+        # The composite's initial state is passed through, not recorded.
+        assert(names == [('InitialState', 'Other'), ('Other', 'Leaf'),
+                         ('Leaf', 'FinalState')])
+        assert(sm.current is leaf.parent.parent.final)
+
+        sm = self.build_fsm()
+        tracer = tracing.TransitionTracer(sample_every=2)
+        tracer.attach(sm)
+        sm.start()
+        sm.stimulate(Toggle())
+        sm.stimulate(Toggle())
+        sm.stop()
+        # The stop transition is counted and sampled as any other.
+        records = tracer.get_records()
+        assert(len(records) == 2)
+        assert(tracer.get_state_name(records[1][2]) == 'Off')
+        assert(tracer.get_state_name(records[1][4]) == 'FinalState')
+        assert(fsm.get_event_type(records[1][3]) is fsm.State.ExitEvent)
+
+    def test06_Post(self):
+        sm = self.build_fsm()
+        tracer = tracing.TransitionTracer(sample_every=2)
+        tracer.attach(sm)
+        sm.start()
+        for i in range(4):
+            sm.post(Toggle())
+        # post() counts and samples as stimulate() does.
+        names = [(tracer.get_state_name(r[2]), tracer.get_state_name(r[4]))
+                 for r in tracer.get_records()]
+        assert(names == [('Off', 'On'), ('Off', 'On')])
+        assert(tracer.get_records()[0][5] >= 0)
+
+        sm = hsm.HSM()
+        composite = hsm.CompositeState(name='Composite')
+        leaf = hsm.SimpleState('Leaf')
+        composite.add_state(leaf)
+        composite.set_initial_state(leaf)
+        other = hsm.SimpleState('Other')
+        sm.top.add_states([other, composite])
+        sm.top.set_initial_state(other)
+        other.add_transition(Toggle, hsm.Transition(composite))
+        leaf.add_transition(Toggle, hsm.Transition(other))
+        tracer = tracing.TransitionTracer()
+        tracer.attach(sm)
+        sm.start()
+        sm.post(Toggle())
+        sm.post(Toggle())
+        names = [(tracer.get_state_name(r[2]), tracer.get_state_name(r[4]))
+                 for r in tracer.get_records()]
+        assert(names == [('InitialState', 'Other'), ('Other', 'Leaf'),
+                         ('Leaf', 'Other')])
+        assert(sm.current is other)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+'''
+Transition tracing
+
+A TransitionTracer attached to an fsm.FSM or hsm.HSM records one compact
+tuple per transition into a preallocated ring buffer:
+
+    (timestamp, machine_id, source_id, event_type_id, target_id,
+     react_time, transition_time)
+
+react_time covers the source state's activities, guards and effects for the
+event, transition_time the exit and enter activities and the transition
+completed activities. Times are in seconds. State ids are local to the tracer
+and resolved with get_state_name(); event type ids are fsm.get_event_type_id().
+
+A detached machine pays one attribute test per dispatch, and with 1-in-N
+sampling the skipped transitions only decrement a counter. Sampled ones store
+the states and the event as they are, get_records() turns them into ids. The buffer can be
+exported as Chrome trace event JSON (chrome://tracing, Perfetto) or as a
+binary dump readable with load_binary().
+'''
+import json
+import struct
+import time
+import fsm
+
+clock = getattr(time, 'perf_counter', time.time)
+
+_BINARY_MAGIC = b'FSMT'
+_BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('<4sIII')
+_BINARY_RECORD = struct.Struct('<diiiidd')
+_BINARY_LENGTH = struct.Struct('<I')
+
+
+class TransitionTracer(object):
+
+    def __init__(self, capacity = 65536, sample_every = 1):
+        object.__init__(self)
+        assert(capacity > 0)
+        assert(sample_every > 0)
+        self.clock = clock
+        self.capacity = capacity
+        self.sample_every = sample_every
+        self.records = [None] * capacity
+        self.position = 0
+        self.count = 0
+        self.state_ids = {}
+        self.state_names = []
+        self.machine_names = []
+        # Transitions left until the next sampled one. Machines decrement it
+        # for the transitions they skip, without taking timestamps.
+        self.countdown = sample_every
+
+    def attach(self, machine):
+        '''attach(machine) -> machine id used in the records'''
+        machine.tracer = self
+        if getattr(machine, 'trace_id', None) is None:
+            machine.trace_id = len(self.machine_names)
+            self.machine_names.append(repr(machine))
+        return machine.trace_id
+
+    def detach(self, machine):
+        machine.tracer = None
+
+    def record(self, machine, source, event, target, started, reacted):
+        '''Called by the machines for sampled transitions only.
+
+        Keeps the states and the event as they are; ids are resolved by
+        get_records(), off the dispatch path.'''
+        ended = self.clock()
+        self.countdown = self.sample_every
+        position = self.position
+        self.records[position] = (started, reacted, ended, machine.trace_id,
+                                  source, event, target)
+        position += 1
+        self.position = 0 if position == self.capacity else position
+        self.count += 1
+
+    def _get_state_id(self, state):
+        state_id = self.state_ids.get(state)
+        if state_id is None:
+            state_id = len(self.state_names)
+            self.state_ids[state] = state_id
+            self.state_names.append(state.get_name())
+        return state_id
+
+    def get_records(self):
+        '''get_records() -> retained records, oldest first'''
+        if self.count < self.capacity:
+            raw = self.records[:self.count]
+        else:
+            raw = self.records[self.position:] + self.records[:self.position]
+        get_state_id = self._get_state_id
+        return [(started, machine_id, get_state_id(source),
+                 fsm.get_event_type_id(event), get_state_id(target),
+                 reacted - started, ended - reacted)
+                for (started, reacted, ended, machine_id, source, event, target)
+                in raw]
+
+    def get_state_name(self, state_id):
+        return self.state_names[state_id]
+
+    def get_dropped_count(self):
+        return max(0, self.count - self.capacity)
+
+    def clear(self):
+        self.records = [None] * self.capacity
+        self.position = 0
+        self.count = 0
+
+    def to_chrome_trace(self):
+        events = []
+        for machine_id, name in enumerate(self.machine_names):
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': machine_id,
+                           'tid': 0, 'args': {'name': name}})
+        for (timestamp, machine_id, source_id, event_id, target_id,
+             react_time, transition_time) in self.get_records():
+            source = self.state_names[source_id]
+            target = self.state_names[target_id]
+            event_name = fsm.get_event_type(event_id).__name__
+            events.append({'name': '%s -> %s' % (source, target),
+                           'cat': event_name,
+                           'ph': 'X',
+                           'ts': timestamp * 1e6,
+                           'dur': (react_time + transition_time) * 1e6,
+                           'pid': machine_id,
+                           'tid': 0,
+                           'args': {'event': event_name,
+                                    'react_us': react_time * 1e6,
+                                    'transition_us': transition_time * 1e6}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.to_chrome_trace(), out)
+
+    def dump_binary(self, out):
+        '''Write the retained records and the state name table to a binary
+        file object.'''
+        records = self.get_records()
+        out.write(_BINARY_HEADER.pack(_BINARY_MAGIC, _BINARY_VERSION,
+                                      len(records), len(self.state_names)))
+        for record in records:
+            out.write(_BINARY_RECORD.pack(*record))
+        for name in self.state_names:
+            data = name.encode('utf-8')
+            out.write(_BINARY_LENGTH.pack(len(data)))
+            out.write(data)
+
+
+def load_binary(stream):
+    '''load_binary(stream) -> (records, state_names)'''
+    magic, version, num_records, num_names = _BINARY_HEADER.unpack(
+                                                stream.read(_BINARY_HEADER.size))
+    assert(magic == _BINARY_MAGIC and version == _BINARY_VERSION)
+    records = [_BINARY_RECORD.unpack(stream.read(_BINARY_RECORD.size))
+               for i in range(num_records)]
+    names = []
+    for i in range(num_names):
+        length, = _BINARY_LENGTH.unpack(stream.read(_BINARY_LENGTH.size))
+        names.append(stream.read(length).decode('utf-8'))
+    return records, names